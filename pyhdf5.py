@@ -4,21 +4,70 @@ Pure python read and write for the HDF5 file format.
 Karim Bahgat 2016
 """
 
+import os
+import io
 import struct
 import datetime
+import itertools
+import collections
+import contextlib
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 # Main user interface
 class HDF5(object):
-    def __init__(self, filepath=None):
+    def __init__(self, filepath=None, mode="r", blocksize=64 * 1024, maxblocks=64, checksums="off"):
+        """Opens filepath for reading ("r") or writing ("w"). For reading it may also be
+        an http(s) url, or a storage such as MemoryStorage with a read_range() method.
+        Metadata is read through a cache of up to maxblocks blocks of blocksize bytes,
+        which can be turned off with maxblocks=0.
+
+        Checksums are verified when reading as set by checksums: "off", "metadata" for the
+        lookup3 checksums of the superblock, object headers, btrees and heaps in newer files,
+        or "all" to also verify the fletcher32 checksums of chunks. A mismatch raises IOError."""
+        if checksums not in ("off", "metadata", "all"):
+            raise ValueError("Checksums must be 'off', 'metadata' or 'all', not %r" % checksums)
         if filepath:
             self.filepath = filepath
-            self.fileobj = _FileWrap(open(self.filepath, "rb"))
-            self._read_file_metadata()
-            #self._read_file_infrastructure()
+            self.mode = mode
+
+            if mode == "r":
+                if hasattr(filepath, "read_range"):
+                    storage = filepath
+                elif filepath.startswith(("http://", "https://")):
+                    storage = HTTPStorage(filepath)
+                else:
+                    storage = LocalStorage(filepath)
+                self.fileobj = _FileWrap(_StorageFile(storage), blocksize, maxblocks)
+                self.fileobj.checksums = checksums
+                self._read_file_metadata()
+                #self._read_file_infrastructure()
+
+            elif mode == "w":
+                self.fileobj = _FileWrap(open(self.filepath, "w+b"))
+                self._writer = _FileWriter(self.fileobj)
+
+            else:
+                raise ValueError("Mode must be 'r' or 'w', not %r" % mode)
             
         else:
-            raise NotImplementedError("Only reading is currently supported")
+            raise NotImplementedError("Files must be opened from a filepath")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.mode == "w":
+            self._writer.close()
+        self.fileobj.fileobj.close()
 
     def _read_file_metadata(self):
         # level 0A
@@ -35,10 +84,760 @@ class HDF5(object):
     def get_root(self):
         return self.superblock.get_root()
 
+    def __getitem__(self, path):
+        "Group or dataset at path, reading only the links on the way there"
+        return self.root[path]
+
+    def __contains__(self, path):
+        return path in self.root
+
+    @property
+    def root(self):
+        if not hasattr(self, "_root"):
+            self._root = Group(self, self.get_root(), "/")
+        return self._root
+
+    def _resolve(self, path, group):
+        "Follows path one link at a time, starting at the root if absolute or else at group"
+        obj = self.root if path.startswith("/") else group
+        for name in path.split("/"):
+            if not name or name == ".":
+                continue
+            if not isinstance(obj, Group):
+                raise KeyError("%r is not a group" % obj.name)
+
+            link = obj._header.get_link(name)
+            if link is None:
+                raise KeyError("%r not found in %r" % (name, obj.name))
+
+            if link.linktype == "hard":
+                objpath = obj.name.rstrip("/") + "/" + link.name
+                obj = self._get_object(link.link, objpath)
+            elif link.linktype == "soft":
+                obj = self._resolve(link.link, obj)
+            else:
+                raise NotImplementedError("Following %s links not yet supported" % link.linktype)
+
+        return obj
+
+    def _get_object(self, header, path):
+        if header.has_message(8):
+            return Dataset(self, header, path)
+        else:
+            return Group(self, header, path)
+
+    # writing
+
+    def create_group(self, name):
+        "Creates a new group, along with any missing intermediate groups in name."
+        if self.mode != "w":
+            raise Exception("File must be opened in 'w' mode in order to create groups")
+        return self._writer.root.create_group(name)
+
+    def create_dataset(self, name, data=None, shape=None, dtype=None, chunks=None,
+                       compression=None, compression_opts=None, shuffle=False,
+                       workers=None, executor="thread", maxshape=None):
+        """Creates a new dataset and writes data to it.
+
+        Chunked datasets are split into chunks which are run through the shuffle
+        and deflate filters in a pool of workers (threads by default, or processes
+        with executor="process"), while the compressed chunks are written to file
+        one after the other and indexed by a v1 B-tree when the file is closed.
+        Setting compression or shuffle without chunks picks a chunk shape automatically.
+
+        Dimensions set to None in maxshape are unlimited, allowing the dataset to
+        grow later with append() or resize() on the returned dataset.
+        """
+        if self.mode != "w":
+            raise Exception("File must be opened in 'w' mode in order to create datasets")
+        return self._writer.root.create_dataset(name, data=data, shape=shape, dtype=dtype, chunks=chunks,
+                                                compression=compression, compression_opts=compression_opts,
+                                                shuffle=shuffle, workers=workers, executor=executor,
+                                                maxshape=maxshape)
+
+    def flush(self):
+        """Writes the metadata of everything written so far, so that the file can be read
+        while still open for writing. The previously flushed metadata is left unused."""
+        if self.mode != "w":
+            raise Exception("File must be opened in 'w' mode in order to flush")
+        self._writer.flush()
+
 
 # High level abstract data model objects contained within a HDF5 file
 # Link: https://www.hdfgroup.org/HDF5/doc/UG/HDF5_Users_Guide-Responsive%20HTML5/index.html#t=HDF5_Users_Guide%2FDataModelAndFileStructure%2FThe_HDF5_Data_Model_and_File_Structure.htm
-# ...
+
+class Group(object):
+    "A group of named links to other groups and datasets, like a folder"
+
+    def __init__(self, file, header, name):
+        self.file = file
+        self.name = name
+        self._header = header
+
+    def __repr__(self):
+        return "<HDF5 group %r>" % self.name
+
+    def __reduce__(self):
+        return _restore_object, (Group, _describe_object(self))
+
+    def __getitem__(self, path):
+        "Group or dataset at path, relative to this group unless it starts with a slash"
+        return self.file._resolve(path, self)
+
+    def __contains__(self, path):
+        try:
+            self[path]
+            return True
+        except KeyError:
+            return False
+
+    def get(self, path, default=None):
+        try:
+            return self[path]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [link.name for link in self._header.iter_links()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    @property
+    def attrs(self):
+        if not hasattr(self, "_attrs"):
+            self._attrs = Attributes(self._header)
+        return self._attrs
+
+
+class Dataset(object):
+    "A multidimensional array of data"
+
+    def __init__(self, file, header, name):
+        self.file = file
+        self.name = name
+        self._header = header
+
+    def __repr__(self):
+        return "<HDF5 dataset %r: shape %r>" % (self.name, self.shape)
+
+    def __reduce__(self):
+        """Pickles to the path of the file, the locations of the dataset's messages and its chunk index.
+        Restoring it in another process opens the file only once per process and parses nothing
+        up front, so workers can be sent datasets rather than opening and searching the file."""
+        return _restore_object, (Dataset, _describe_object(self))
+
+    @property
+    def shape(self):
+        return tuple(self._header.get_message(1).dimsizes)
+
+    @property
+    def maxshape(self):
+        dataspace = self._header.get_message(1)
+        if not dataspace.flags["maxdims"]:
+            return self.shape
+        return tuple(None if size == UNDEFINED else size for size in dataspace.maxdimsizes)
+
+    @property
+    def dtype(self):
+        return self._header.get_message(3).get_dtype()
+
+    @property
+    def fillvalue(self):
+        return self._header.get_message(3).decode(self._header.get_message(8).get_fill_value())[0]
+
+    @property
+    def chunks(self):
+        layout = self._header.get_message(8)
+        if layout.layout_class == "chunked":
+            return tuple(layout.properties["dimsizes"][:-1])
+
+    @property
+    def attrs(self):
+        if not hasattr(self, "_attrs"):
+            self._attrs = Attributes(self._header)
+        return self._attrs
+
+    def read_data(self):
+        return self._header.get_message(8).read_data()
+
+    def __getitem__(self, selection):
+        """Reads a selection of integers and slices, such as ds[0, 10:20, :],
+        as a numpy array, only reading the chunks that contain selected values,
+        so that strided overviews such as ds[::10, ::10] skip the chunks in between."""
+        if np is None:
+            raise ImportError("Reading selections requires numpy")
+        slices, dropped = _normalize_selection(selection, self.shape)
+
+        start = [first for first, last, step in slices]
+        stop = [last for first, last, step in slices]
+        step = [step for first, last, step in slices]
+        data = self._header.get_message(8).read_region(start, stop, step)
+
+        if dropped:
+            data = data[tuple(0 if dim in dropped else slice(None) for dim in range(len(slices)))]
+        return data
+
+    def read(self, selection=(), out=None, workers=None, prefetch=None):
+        """Reads the selection into out, or as a new array if out is None. out may be a path, where
+        a .npy file the shape of the selection is created and returned as a memory map, or an array
+        such as a memory map. Chunks are decoded straight into out, in parallel in workers threads
+        with at most twice as many chunks held at a time, while prefetch reads that many chunks
+        ahead, so that selections much larger than memory can be read at the speed of the disk."""
+        if np is None:
+            raise ImportError("Reading selections requires numpy")
+        if out is None:
+            return self[selection]
+        # chunks that were never written are read as the fill value, which a new file of zeros already holds
+        fill = True
+        if isinstance(out, basestring):
+            if self.dtype.hasobject:
+                raise ValueError("Can't read variable length data into a .npy file")
+            slices, dropped = _normalize_selection(selection, self.shape)
+            shape = tuple(len(xrange(*slices[dim])) for dim in range(len(slices)) if dim not in dropped)
+            out = np.lib.format.open_memmap(out, mode="w+", dtype=self.dtype, shape=shape)
+            fill = bool(self._header.get_message(8).get_fill_value().strip(b"\x00"))
+        self._read_into(out, selection, (), None, None, workers, prefetch, fill)
+        if isinstance(out, np.memmap):
+            out.flush()
+        return out
+
+    def read_direct(self, out, source_sel=(), dest_sel=(), scale=None, offset=None, workers=None, prefetch=None):
+        """Reads the selection source_sel into out, a numpy array or a writable buffer holding
+        values of the dataset's dtype, at the selection dest_sel. Chunks are copied straight
+        into out as they are decoded, converting to the dtype of out on the way, and if given,
+        multiplying by scale and adding offset, such as to unpack int16 values to float32.
+        Parts of chunks that were never written are set to the fill value."""
+        self._read_into(out, source_sel, dest_sel, scale, offset, workers, prefetch, True)
+
+    def _read_into(self, out, source_sel, dest_sel, scale, offset, workers, prefetch, fill):
+        "read_direct(), where the parts of out that no stored chunk covers are only set to the fill value if fill"
+        if np is None:
+            raise ImportError("Reading selections requires numpy")
+        slices, dropped = _normalize_selection(source_sel, self.shape)
+        shape = tuple(len(xrange(*slices[dim])) for dim in range(len(slices)) if dim not in dropped)
+        if not isinstance(out, np.ndarray):
+            out = np.frombuffer(out, self.dtype).reshape(shape)
+
+        # only plain slices and integers, so that dest is a view of out
+        destslices, destdropped = _normalize_selection(dest_sel, out.shape)
+        dest = out[tuple(first if dim in destdropped else slice(first, last, step)
+                         for dim, (first, last, step) in enumerate(destslices)) + (Ellipsis,)]
+        if dest.shape != shape:
+            raise ValueError("Can't read selection of shape %r into shape %r" % (shape, dest.shape))
+
+        for region, values in self.iter_chunks(source_sel, workers=workers, prefetch=prefetch, fill=fill):
+            target = dest[region] if region else dest
+            if scale is None and offset is None:
+                target[...] = values
+            else:
+                np.multiply(values, 1 if scale is None else scale, out=target, casting="unsafe")
+                if offset is not None:
+                    np.add(target, offset, out=target, casting="unsafe")
+
+    def export_npy(self, path, workers=None):
+        """Writes the dataset to a .npy file at path, decoding chunks in parallel in workers
+        threads straight into a memory map of the file, so only a few chunks are held at a time"""
+        if np is None:
+            raise ImportError("Exporting requires numpy")
+        if self.dtype.hasobject:
+            raise ValueError("Can't export variable length data to .npy")
+        out = self.read(out=path, workers=workers)
+        del out
+
+    def export_chunks(self, dirpath, workers=None):
+        """Writes each stored chunk to its own file in dirpath, named by its chunk indices joined
+        by dots, along with a .zarray file describing them, as in a zarr version 2 directory store.
+
+        Chunks compressed with deflate, optionally after shuffle and with fletcher32 checksums,
+        are copied as they are without being decoded. Other chunks are decoded and written
+        uncompressed, in parallel in workers threads. Chunks that were never written are left
+        out, to be read as the fill value. Contiguous data is written as a single chunk."""
+        if np is None:
+            raise ImportError("Exporting requires numpy")
+        import json
+        dtype = self.dtype
+        if dtype.hasobject:
+            raise ValueError("Can't export variable length data as chunks")
+        layout = self._header.get_message(8)
+        pipeline = self._header.get_message(11)
+        filters = [(filt.filter_id, filt.client_data) for filt in pipeline.filters] if pipeline else []
+        filterids = [filter_id for filter_id, client_data in filters]
+
+        # an optional shuffle, then deflate, then an optional checksum which is just stripped
+        copyable = filterids in ([1], [2, 1], [1, 3], [2, 1, 3])
+        encoding = [(filter_id, client_data) for filter_id, client_data in filters if filter_id != 3]
+        chunkshape = self.chunks or self.shape
+        fill = None
+        if dtype.kind in "biuf":
+            fill = self.fillvalue.item()
+            if isinstance(fill, float) and (fill != fill or abs(fill) == float("inf")):
+                # json has no nan or infinity, which zarr writes as strings
+                fill = "NaN" if fill != fill else "Infinity" if fill > 0 else "-Infinity"
+        metadata = dict(zarr_format=2, shape=list(self.shape), chunks=list(chunkshape), order="C",
+                        dtype=dtype.descr if dtype.fields else dtype.str, fill_value=fill,
+                        compressor=dict(id="zlib", level=dict(filters)[1][0]) if copyable else None,
+                        filters=[dict(id="shuffle", elementsize=dict(filters)[2][0])] if copyable and 2 in filterids else None)
+
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        with open(os.path.join(dirpath, ".zarray"), "w") as fileobj:
+            json.dump(metadata, fileobj, indent=4, sort_keys=True)
+
+        def export(chunk):
+            offsets, raw, filtermask = chunk
+            if not copyable or any(filtermask):
+                if pipeline:
+                    raw = pipeline.decode(raw, filtermask)
+                if copyable:
+                    raw = _encode_chunk((raw, encoding))
+            elif 3 in filterids:
+                raw = raw[:-4]
+            name = ".".join(str(offset // size) for offset, size in zip(offsets, chunkshape)) or "0"
+            with open(os.path.join(dirpath, name), "wb") as fileobj:
+                fileobj.write(raw)
+
+        if layout.layout_class == "chunked":
+            chunks = layout.read_chunks(layout.iter_chunk_index([0] * len(self.shape), self.shape))
+            for _ in _ordered_map(export, chunks, workers):
+                pass
+        elif layout.properties["address"] != UNDEFINED:
+            # copied in pieces, so the whole dataset is never in memory
+            name = ".".join("0" for _ in self.shape) or "0"
+            with open(os.path.join(dirpath, name), "wb") as fileobj:
+                address, size = layout.properties["address"], layout.properties["size"]
+                for start in range(0, size, CONTIGUOUS_BYTES):
+                    length = min(CONTIGUOUS_BYTES, size - start)
+                    fileobj.write(layout.fileobj.read_ranges([(address + start, length)])[0])
+
+    def iter_chunks(self, selection=(), workers=None, prefetch=None, fill=False):
+        """Yields (region, values) for each stored part of the selection, in the order they
+        are found in the file, where region is the slices that values cover within the
+        selected array. Chunks are decoded in parallel in workers threads, while prefetch
+        is how many chunks to read ahead in the background. With fill, the parts of chunks
+        that were never written follow, as read only arrays of the fill value."""
+        if np is None:
+            raise ImportError("Reading selections requires numpy")
+        slices, dropped = _normalize_selection(selection, self.shape)
+        start = [first for first, last, step in slices]
+        stop = [last for first, last, step in slices]
+        step = [step for first, last, step in slices]
+
+        layout = self._header.get_message(8)
+        for region, values in layout.iter_region(start, stop, workers=workers, step=step, prefetch=prefetch, fill=fill):
+            if dropped:
+                region = tuple(region[dim] for dim in range(len(slices)) if dim not in dropped) if region else ()
+                values = values[tuple(0 if dim in dropped else slice(None) for dim in range(len(slices)))]
+            yield region, values
+
+    def reduce(self, op, axis=None, where=None, workers=None, skip_fill=False, prefetch=None):
+        """Reduces the values with op ("sum", "mean", "min", "max" or "count") along axis,
+        an int, a tuple of ints or None for all axes, optionally only over the selection where.
+
+        Chunks are decoded and reduced one at a time, in parallel in workers threads,
+        and only the partial results are kept, so memory use stays around the size
+        of the result plus a few chunks. NaNs and fill values are left out, as are
+        chunks that were never written. Results are float, or int for count, with
+        NaN where there were no values to reduce. With skip_fill, chunks stored as
+        only fill values are recognized from their bytes and never decoded, and
+        prefetch is how many chunks to read ahead in the background.
+        """
+        if np is None:
+            raise ImportError("Reductions require numpy")
+        if op not in ("sum", "mean", "min", "max", "count"):
+            raise ValueError("Unknown reduction %r" % op)
+
+        slices, dropped = _normalize_selection(() if where is None else where, self.shape)
+        start = [first for first, last, step in slices]
+        stop = [last for first, last, step in slices]
+        step = [step for first, last, step in slices]
+
+        # axes are given for the selected array, where integer selections are dropped
+        kept = [dim for dim in range(len(slices)) if dim not in dropped]
+        if axis is None:
+            axes = range(len(kept))
+        elif isinstance(axis, (tuple, list)):
+            axes = axis
+        else:
+            axes = [axis]
+        for ax in axes:
+            if not -len(kept) <= ax < len(kept):
+                raise ValueError("Axis %s is out of range for %s dimensions" % (ax, len(kept)))
+        axes = tuple(sorted(set(kept[ax] for ax in axes) | set(dropped)))
+        resultdims = [dim for dim in range(len(slices)) if dim not in axes]
+        resultshape = tuple(len(xrange(*slices[dim])) for dim in resultdims)
+
+        fillvalue = self._header.get_message(5)
+        fill = None
+        if fillvalue is not None and fillvalue.fill_value is not None:
+            fill = self._header.get_message(3).decode(fillvalue.fill_value)[0]
+
+        totals = np.zeros(resultshape, "f8")
+        counts = np.zeros(resultshape, "i8")
+        lowest = np.full(resultshape, np.nan)
+        highest = np.full(resultshape, np.nan)
+
+        # skipped chunks must hold values that are left out anyway
+        skip_fill = skip_fill and fill is not None
+        func = lambda values: _reduce_block(values, axes, fill, op)
+        layout = self._header.get_message(8)
+        for region, partial in layout.iter_region(start, stop, func, workers, step, skip_fill, prefetch):
+            region = tuple(region[dim] for dim in resultdims) if region else ()
+            counts[region] += partial["count"]
+            if "sum" in partial:
+                totals[region] += partial["sum"]
+            if "min" in partial:
+                lowest[region] = np.fmin(lowest[region], partial["min"])
+            if "max" in partial:
+                highest[region] = np.fmax(highest[region], partial["max"])
+
+        if op == "count":
+            result = counts
+        elif op == "sum":
+            result = totals
+        elif op == "mean":
+            with np.errstate(invalid="ignore", divide="ignore"):
+                result = np.where(counts > 0, totals / counts, np.nan)
+        elif op == "min":
+            result = lowest
+        elif op == "max":
+            result = highest
+        return result[()] if not resultshape else result
+
+
+class MultiFileDataset(object):
+    """A dataset spread over several files, such as one file per month, that are
+    concatenated along axis and read as if they were a single dataset.
+
+    Files are opened as needed, keeping at most maxopen of them open and closing
+    the least recently used first. The shape and dtype of the dataset in each file
+    are remembered after the file is first opened. Selections only read the files
+    and chunks they overlap, reading from up to workers files at the same time.
+    """
+
+    def __init__(self, paths, name, axis=0, maxopen=32, workers=None):
+        self.paths = list(paths)
+        self.name = name
+        self.axis = axis
+        self.workers = workers
+        self._pool = _FilePool(maxopen)
+        self._metadata = dict()
+        self._datasets = dict() # path -> dataset of the file currently open in the pool
+
+    def __repr__(self):
+        return "<HDF5 multi file dataset %r: %s files>" % (self.name, len(self.paths))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._pool.close()
+
+    @property
+    def shape(self):
+        offsets = self._get_offsets()
+        shape = list(self._get_metadata(self.paths[0])["shape"])
+        shape[self.axis] = offsets[-1]
+        return tuple(shape)
+
+    @property
+    def dtype(self):
+        return self._get_metadata(self.paths[0])["dtype"]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, selection):
+        "Reads a selection of integers and slices across the files, as a numpy array"
+        if np is None:
+            raise ImportError("Reading selections requires numpy")
+        slices, dropped = _normalize_selection(selection, self.shape)
+        offsets = self._get_offsets()
+
+        # the selection within each file it overlaps along axis
+        start, stop, step = slices[self.axis]
+        tasks = []
+        for path, first, last in zip(self.paths, offsets[:-1], offsets[1:]):
+            # first selected index within the file
+            localstart = start if start >= first else start + (first - start + step - 1) // step * step
+            localstop = min(stop, last)
+            if localstart < localstop:
+                localslices = list(slices)
+                localslices[self.axis] = (localstart - first, localstop - first, step)
+                tasks.append((path, localslices))
+
+        if tasks:
+            parts = list(_ordered_map(self._read_part, tasks, self.workers))
+            data = np.concatenate(parts, axis=self.axis)
+        else:
+            data = np.zeros([len(xrange(*dimslice)) for dimslice in slices], dtype=self.dtype)
+
+        if dropped:
+            data = data[tuple(0 if dim in dropped else slice(None) for dim in range(len(slices)))]
+        return data
+
+    def _read_part(self, task):
+        path, localslices = task
+        with self._pool.open(path) as f:
+            dataset = self._get_dataset(f, path)
+            return dataset[tuple(slice(*dimslice) for dimslice in localslices)]
+
+    def _get_dataset(self, f, path):
+        dataset = self._datasets.get(path)
+        if dataset is not None and dataset.file is f:
+            # the header was already parsed for this open file
+            return dataset
+        if path not in self._metadata:
+            dataset = f[self.name]
+            self._metadata[path] = dict(shape=dataset.shape, dtype=dataset.dtype, address=dataset._header.pos)
+        else:
+            # skip looking up the path again when reopening a file
+            f.fileobj.seek(self._metadata[path]["address"])
+            header = _ObjectHeader(parent=f.superblock, fileobj=f.fileobj)
+            dataset = Dataset(f, header, self.name)
+        self._datasets[path] = dataset
+        return dataset
+
+    def _get_metadata(self, path):
+        if path not in self._metadata:
+            with self._pool.open(path) as f:
+                self._get_dataset(f, path)
+        return self._metadata[path]
+
+    def _get_offsets(self):
+        "Where each file starts along axis, followed by the total length"
+        if not hasattr(self, "_offsets"):
+            shapes = list(_ordered_map(lambda path: self._get_metadata(path)["shape"], self.paths, self.workers))
+            for path, shape in zip(self.paths, shapes):
+                othershape = list(shape)
+                othershape[self.axis] = shapes[0][self.axis]
+                if tuple(othershape) != tuple(shapes[0]):
+                    raise ValueError("Dataset in %r has shape %r, which does not match %r outside axis %s" % (path, shape, shapes[0], self.axis))
+            offsets = [0]
+            for shape in shapes:
+                offsets.append(offsets[-1] + shape[self.axis])
+            self._offsets = offsets
+        return self._offsets
+
+
+class Attributes(object):
+    """The attributes of a group or dataset, as a read-only dict.
+    Names, datatypes and shapes are indexed the first time they are needed,
+    while the values themselves are only read when asked for."""
+
+    def __init__(self, header):
+        self._header = header
+        self._index = None
+
+    def __repr__(self):
+        return "<HDF5 attributes %r>" % self.keys()
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = collections.OrderedDict((attr.name, attr) for attr in self._header.iter_attributes())
+        return self._index
+
+    def _get_attribute(self, name):
+        if not isinstance(name, unicode):
+            name = name.decode("utf8")
+        if self._index is not None:
+            attr = self._index.get(name)
+        else:
+            # a single attribute can be looked up without indexing all the others
+            attr = self._header.get_attribute(name)
+        if attr is None:
+            raise KeyError("Attribute %r not found" % name)
+        return attr
+
+    def __getitem__(self, name):
+        return self._get_attribute(name).read_value()
+
+    def __contains__(self, name):
+        try:
+            self._get_attribute(name)
+            return True
+        except KeyError:
+            return False
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def shape(self, name):
+        "Shape of an attribute value, without reading it, or None if it has no value"
+        return self._get_attribute(name).shape
+
+    def dtype(self, name):
+        "Numpy dtype of an attribute value, without reading it"
+        return self._get_attribute(name).datatype.get_dtype()
+
+    def keys(self):
+        return list(self._get_index().keys())
+
+    def values(self):
+        return [attr.read_value() for attr in self._get_index().values()]
+
+    def items(self):
+        return [(name, attr.read_value()) for name, attr in self._get_index().items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._get_index())
+
+
+# Storage to read files from, by byte ranges
+
+class _Storage(object):
+    def read_range(self, offset, length):
+        "Up to length bytes starting at offset, fewer only at the end of the file"
+        raise NotImplementedError
+
+    def read_ranges(self, ranges):
+        "List of bytes read from each (offset, length) in ranges"
+        return [self.read_range(offset, length) for offset, length in ranges]
+
+    def close(self):
+        pass
+
+
+class LocalStorage(_Storage):
+    """Reads a local file with os.pread where available, otherwise from a memory map,
+    neither of which has a shared position, so any number of threads can read at once.
+    Files that can't be memory mapped, such as empty ones, are read with seek and read."""
+
+    def __init__(self, path):
+        import mmap
+        self.path = path
+        self._file = open(path, "rb")
+        self._map = None
+        self._lock = threading.Lock()
+        if not hasattr(os, "pread"):
+            try:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                pass
+
+    def __repr__(self):
+        return "<LocalStorage %r>" % self.path
+
+    def read_range(self, offset, length):
+        if hasattr(os, "pread"):
+            return os.pread(self._file.fileno(), length, offset)
+        if self._map is not None:
+            return self._map[offset:offset + length]
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._file.close()
+
+
+class MemoryStorage(_Storage):
+    def __init__(self, data):
+        self.data = data
+
+    def __repr__(self):
+        return "<MemoryStorage of %s bytes>" % len(self.data)
+
+    def read_range(self, offset, length):
+        return bytes(self.data[offset:offset + length])
+
+
+class HTTPStorage(_Storage):
+    """Reads byte ranges of a file at an http(s) url, reusing up to maxconnections
+    keep-alive connections, which is also how many ranges are requested at once."""
+
+    def __init__(self, url, maxconnections=8, timeout=60):
+        from urlparse import urlsplit
+        parts = urlsplit(url)
+        self.url = url
+        self.maxconnections = maxconnections
+        self.timeout = timeout
+        self._scheme = parts.scheme
+        self._host = parts.netloc
+        self._path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        self._idle = []
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<HTTPStorage %r>" % self.url
+
+    def _connect(self):
+        import httplib
+        if self._scheme == "https":
+            return httplib.HTTPSConnection(self._host, timeout=self.timeout)
+        return httplib.HTTPConnection(self._host, timeout=self.timeout)
+
+    def read_range(self, offset, length):
+        import httplib, socket
+        if length <= 0:
+            return b""
+        headers = {"Range": "bytes=%d-%d" % (offset, offset + length - 1)}
+        while True:
+            with self._lock:
+                connection = self._idle.pop() if self._idle else None
+            reused = connection is not None
+            if not reused:
+                connection = self._connect()
+            try:
+                connection.request("GET", self._path, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused:
+                    # the server may have closed an idle connection, so try again
+                    continue
+                raise
+            break
+
+        with self._lock:
+            if response.will_close or len(self._idle) >= self.maxconnections:
+                connection.close()
+            else:
+                self._idle.append(connection)
+
+        if response.status == 206:
+            return data
+        elif response.status == 200:
+            # the server ignored the range and sent the whole file
+            return data[offset:offset + length]
+        elif response.status == 416:
+            return b""
+        raise IOError("HTTP error %s %s reading %s" % (response.status, response.reason, self.url))
+
+    def read_ranges(self, ranges):
+        if len(ranges) <= 1:
+            return [self.read_range(offset, length) for offset, length in ranges]
+        with self._lock:
+            if self._pool is None:
+                from multiprocessing.pool import ThreadPool
+                self._pool = ThreadPool(self.maxconnections)
+        return self._pool.map(lambda args: self.read_range(*args), ranges)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+            for connection in self._idle:
+                connection.close()
+            self._idle = []
+
 
 
 # "Low level" objects as they actually exist on disk, for reading and writing
@@ -47,6 +846,12 @@ class HDF5(object):
 
 UNDEFINED = struct.unpack('<Q', b'\xff\xff\xff\xff\xff\xff\xff\xff')[0]
 
+# most bytes to read ahead when prefetching chunks
+PREFETCH_BYTES = 64 * 1024 * 1024
+
+# most bytes of contiguous data to read at a time
+CONTIGUOUS_BYTES = 16 * 1024 * 1024
+
 
 def _bitflag(rawbyte, index):
     # loworder first
@@ -68,14 +873,521 @@ def _bitfield(rawbyte, startindex, endindex):
         mult *= 2
 
     return value
-    
+
+
+def _unpack_int(raw):
+    "Little endian unsigned int of any nr of bytes"
+    value = 0
+    for i, char in enumerate(raw):
+        value |= ord(char) << (8 * i)
+    return value
+
+
+def _log2(value):
+    "Integer log2, rounded down"
+    return value.bit_length() - 1
+
+
+def _limit_enc_size(value):
+    "Nr of bytes used by the hdf5 library to encode numbers up to value"
+    return _log2(value) // 8 + 1
+
+
+def _normalize_selection(selection, shape):
+    """Turns a selection of integers, slices and Ellipsis into a (start, stop, step)
+    per dimension, along with the dimensions given as integers, which are dropped"""
+    if not isinstance(selection, tuple):
+        selection = (selection,)
+    if any(sel is Ellipsis for sel in selection):
+        i = [sel is Ellipsis for sel in selection].index(True)
+        selection = selection[:i] + (slice(None),) * (len(shape) - len(selection) + 1) + selection[i+1:]
+    if len(selection) > len(shape):
+        raise IndexError("Too many indices for shape %r" % (shape,))
+    selection = selection + (slice(None),) * (len(shape) - len(selection))
+
+    slices = []
+    dropped = []
+    for dim, (sel, size) in enumerate(zip(selection, shape)):
+        if isinstance(sel, slice):
+            start, stop, step = sel.indices(size)
+            if step < 1:
+                raise NotImplementedError("Negative steps not yet supported")
+            slices.append((start, max(start, stop), step))
+        else:
+            index = int(sel)
+            if index < 0:
+                index += size
+            if not 0 <= index < size:
+                raise IndexError("Index %s is out of range for size %s" % (sel, size))
+            slices.append((index, index + 1, 1))
+            dropped.append(dim)
+    return slices, dropped
+
+
+def _reduce_block(values, axes, fill, op):
+    "Partial aggregates of values along axes needed for op, leaving out NaNs and fill values"
+    valid = np.ones(values.shape, bool)
+    if values.dtype.kind in "fc":
+        valid &= ~np.isnan(values)
+    if fill is not None:
+        valid &= values != fill
+
+    partial = dict(count=valid.sum(axis=axes))
+    if op in ("sum", "mean"):
+        partial["sum"] = np.where(valid, values, 0).sum(axis=axes, dtype="f8")
+    elif op in ("min", "max"):
+        empty = partial["count"] == 0
+        if op == "min":
+            partial["min"] = np.where(empty, np.nan, np.where(valid, values, np.inf).min(axis=axes))
+        else:
+            partial["max"] = np.where(empty, np.nan, np.where(valid, values, -np.inf).max(axis=axes))
+    return partial
+
+
+def _read_linked_header(link):
+    "Reads the object header at the address of a hard link"
+    # always read from the file itself, as the link may have been read from a heap
+    fileobj = link.get_root().parent.fileobj
+    pos = fileobj.tell()
+    fileobj.seek(link.address)
+    header = _ObjectHeader(parent=link, fileobj=fileobj)
+    fileobj.seek(pos) # so remember to return to previous position after
+    return header
+
+
+def _describe_object(obj):
+    """Picklable description of a group or dataset: the path of its file, where its object header
+    and each of its messages are, and for chunked datasets the whole chunk index, so that it can
+    be restored without walking the header or the chunk btree again."""
+    f = obj.file
+    if f.mode != "r" or not isinstance(f.filepath, basestring):
+        raise TypeError("Only objects of files opened for reading from a path or url can be pickled")
+    header = obj._header
+    prefix = dict((key, value) for key, value in vars(header.prefix).items() if key not in ("parent", "fileobj"))
+    messages = [(dict((key, value) for key, value in msg.items() if key != "msgdata"), msg.msgdatapos)
+                for msg in header.messages]
+    state = dict(filepath=f.filepath, name=obj.name, address=header.pos, prefix=prefix, messages=messages)
+    if isinstance(obj, Dataset) and obj.chunks:
+        state["chunk_index"] = header.get_message(8).get_chunk_index()
+    return state
+
+
+def _restore_object(cls, state):
+    "Group or dataset of cls from a description by _describe_object(), in a file opened once per process"
+    f = _get_process_file(state["filepath"])
+    header = _ObjectHeader(f.superblock, pos=state["address"])
+    header.fileobj = f.fileobj
+    header.prefix = _ObjectHeaderPrefix(header, fileobj=None, **state["prefix"])
+    header.prefix.fileobj = f.fileobj
+    header.messages = []
+    for info, msgdatapos in state["messages"]:
+        msg = _MessageEntry(header.prefix)
+        msg.update(info)
+        msg.msgdatapos = msgdatapos
+        header.messages.append(msg)
+    if "chunk_index" in state:
+        # keyed by the offsets of each chunk, without the extra offset of v1 btrees along the element size
+        layout = header.get_message(8)
+        ndims = len(layout.properties["dimsizes"]) - 1
+        layout.chunk_index = dict((tuple(chunk[0][:ndims]), chunk) for chunk in state["chunk_index"])
+    return cls(f, header, state["name"])
+
+
+# files opened by restored groups and datasets, by process id and path
+_process_files = dict()
+_process_files_lock = threading.Lock()
+
+
+def _get_process_file(filepath):
+    key = (os.getpid(), filepath)
+    with _process_files_lock:
+        if key not in _process_files:
+            _process_files[key] = HDF5(filepath)
+        return _process_files[key]
+
+
+def _bitbytes(n, *fields):
+    "Inverse of _bitfield, packs (startindex, value) pairs into n raw bytes, loworder first"
+    value = 0
+    for index, val in fields:
+        value |= int(val) << index
+    return struct.pack("<Q", value)[:n]
+
+
+def _rot(x, k):
+    return ((x << k) | (x >> (32 - k))) & 0xffffffff
+
+
+def _lookup3(data, initval=0):
+    "Bob Jenkins' lookup3 hashlittle(), used by HDF5 for metadata checksums and name hashes"
+    # From: http://burtleburtle.net/bob/c/lookup3.c
+    M = 0xffffffff
+    length = len(data)
+    a = b = c = (0xdeadbeef + length + initval) & M
+    if length == 0:
+        return c
+
+    # all but the last (possibly partial) 12 byte block gets mixed
+    nblocks = (length - 1) // 12
+    words = struct.unpack("<%dI" % (nblocks * 3), data[:nblocks * 12])
+    for i in range(0, nblocks * 3, 3):
+        a = (a + words[i]) & M
+        b = (b + words[i+1]) & M
+        c = (c + words[i+2]) & M
+        a = (a - c) & M; a ^= _rot(c, 4); c = (c + b) & M
+        b = (b - a) & M; b ^= _rot(a, 6); a = (a + c) & M
+        c = (c - b) & M; c ^= _rot(b, 8); b = (b + a) & M
+        a = (a - c) & M; a ^= _rot(c, 16); c = (c + b) & M
+        b = (b - a) & M; b ^= _rot(a, 19); a = (a + c) & M
+        c = (c - b) & M; c ^= _rot(b, 4); b = (b + a) & M
+
+    # zero padding the last block is the same as only adding the bytes that are there
+    tail = data[nblocks * 12:] + b"\x00" * 12
+    ta, tb, tc = struct.unpack("<3I", tail[:12])
+    a = (a + ta) & M
+    b = (b + tb) & M
+    c = (c + tc) & M
+    c ^= b; c = (c - _rot(b, 14)) & M
+    a ^= c; a = (a - _rot(c, 11)) & M
+    b ^= a; b = (b - _rot(a, 25)) & M
+    c ^= b; c = (c - _rot(b, 16)) & M
+    a ^= c; a = (a - _rot(c, 4)) & M
+    b ^= a; b = (b - _rot(a, 14)) & M
+    c ^= b; c = (c - _rot(b, 24)) & M
+    return c
+
+
+def _fletcher32(data):
+    "Fletcher32 checksum as computed by HDF5, over big endian 16 bit words, as used by the fletcher32 filter"
+    if len(data) % 2:
+        # an odd last byte counts as the high byte of a word
+        data = data + b"\x00"
+    if np is not None:
+        words = np.frombuffer(data, ">u2").astype("i8")
+        count = len(words)
+        sum1 = int(words.sum()) % 65535
+        # the second sum weighs each word by how many running sums it is part of
+        sum2 = 0
+        for start in range(0, count, 1 << 20):
+            block = words[start:start + (1 << 20)]
+            weights = (count - np.arange(start, start + len(block), dtype="i8")) % 65535
+            sum2 += int((block * weights % 65535).sum())
+        sum2 %= 65535
+        nonzero = bool(words.any())
+    else:
+        words = struct.unpack(">%dH" % (len(data) // 2), data)
+        count = len(words)
+        sum1 = sum(words) % 65535
+        sum2 = sum((count - i) * word for i, word in enumerate(words)) % 65535
+        nonzero = any(words)
+    # sums are folded the ones' complement way, where a multiple of 65535 other than 0 is 0xffff
+    if nonzero:
+        sum1 = sum1 or 0xffff
+        sum2 = sum2 or 0xffff
+    return (sum2 << 16) | sum1
+
+
+def _verify_lookup3(fileobj, start, what):
+    """Checks the lookup3 checksum just read by fileobj against the bytes from start up to it,
+    if the file checks metadata checksums, raising IOError if they differ"""
+    if fileobj.checksums == "off":
+        return
+    end = fileobj.tell() - 4
+    fileobj.seek(end)
+    stored = fileobj.read_struct_type("I", 1)
+    fileobj.seek(start)
+    data = fileobj.read_bytes(end - start)
+    fileobj.seek(end + 4)
+    if _lookup3(data) != stored:
+        raise IOError("Checksum mismatch in %s at address %s" % (what, start))
+
+
+# long lived pools of workers by (executor, workers), since starting and stopping a pool for each
+# call costs far more than reading a small selection
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def _get_pool(workers, executor="thread"):
+    with _pools_lock:
+        pool = _pools.get((executor, workers))
+        if pool is None:
+            if executor == "thread":
+                from multiprocessing.pool import ThreadPool
+                pool = ThreadPool(workers)
+            elif executor == "process":
+                from multiprocessing import Pool
+                pool = Pool(workers)
+            else:
+                raise ValueError("Executor must be 'thread' or 'process', not %r" % executor)
+            if not _pools:
+                import atexit
+                atexit.register(_close_pools)
+            _pools[(executor, workers)] = pool
+        return pool
+
+
+def _close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.terminate()
+        _pools.clear()
+
+
+def _ordered_map(func, iterable, workers=None, executor="thread"):
+    """Like map() but runs func in a pool of workers, yielding the results in
+    input order while keeping at most 2*workers items in flight at a time.
+    Stopping early leaves the items in flight to finish in the background."""
+    if not workers or workers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+
+    pool = _get_pool(workers, executor)
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
         
 
+def _prefetch(iterable, count, maxbytes=PREFETCH_BYTES, size=len):
+    """Iterates over iterable in a background thread, keeping up to count items, measuring
+    no more than maxbytes together by size, ready ahead of the caller. Stopping early,
+    such as by breaking out of a loop, waits for the background thread to finish its
+    current item, so nothing else is read once this returns."""
+    if not count:
+        for item in iterable:
+            yield item
+        return
+
+    ready = collections.deque()
+    state = dict(nbytes=0, done=False, stop=False, error=None)
+    condition = threading.Condition()
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                nbytes = size(item)
+                with condition:
+                    # always allow one item ahead, even if bigger than maxbytes
+                    while ready and (len(ready) >= count or state["nbytes"] + nbytes > maxbytes) \
+                              and not state["stop"]:
+                        condition.wait()
+                    if state["stop"]:
+                        break
+                    ready.append((item, nbytes))
+                    state["nbytes"] += nbytes
+                    condition.notify_all()
+        except Exception as err:
+            state["error"] = err
+        finally:
+            if hasattr(iterator, "close"):
+                iterator.close()
+            with condition:
+                state["done"] = True
+                condition.notify_all()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            with condition:
+                while not ready and not state["done"]:
+                    condition.wait()
+                if not ready:
+                    break
+                item, nbytes = ready.popleft()
+                state["nbytes"] -= nbytes
+                condition.notify_all()
+            yield item
+        if state["error"] is not None:
+            raise state["error"]
+    finally:
+        with condition:
+            state["stop"] = True
+            condition.notify_all()
+        thread.join()
+
+
+def _shuffle(raw, size):
+    "Shuffle filter, groups together the first bytes of all elements, then the second bytes, etc"
+    if size <= 1:
+        return raw
+    n = len(raw) // size * size
+    # leftover bytes that dont make up a whole element are left as is
+    return b"".join(raw[i:n:size] for i in range(size)) + raw[n:]
+
+
+def _unshuffle(raw, size):
+    if size <= 1:
+        return raw
+    count = len(raw) // size
+    n = count * size
+    out = bytearray(raw)
+    for i in range(size):
+        out[i:n:size] = raw[i*count:(i+1)*count]
+    return bytes(out)
+
+
+def _encode_chunk(args):
+    """Runs raw chunk bytes through a list of (filter_id, client_data) filters.
+    Takes a single tuple and lives at module level so it can be sent to process pools."""
+    raw, filters = args
+    for filter_id, client_data in filters:
+        if filter_id == 1:
+            import zlib
+            raw = zlib.compress(raw, client_data[0])
+        elif filter_id == 2:
+            raw = _shuffle(raw, client_data[0])
+        elif filter_id == 3:
+            raw += struct.pack("<I", _fletcher32(raw))
+        else:
+            raise NotImplementedError("Encoding filter id %s not yet supported" % filter_id)
+    return raw
+
+
+def _decode_chunk(args):
+    "Inverse of _encode_chunk, undoes the filters in reverse order"
+    raw, filters = args
+    for filter_id, client_data in reversed(filters):
+        if filter_id == 1:
+            import zlib
+            raw = zlib.decompress(raw)
+        elif filter_id == 2:
+            raw = _unshuffle(raw, client_data[0])
+        else:
+            raise NotImplementedError("Decoding filter id %s not yet supported" % filter_id)
+    return raw
+
+
+class _LRUCache(object):
+    "Dict like cache that forgets the least recently used items once there are more than maxsize"
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self.items:
+                return default
+            # move to the most recently used end
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+
+class _FilePool(object):
+    """Keeps up to maxopen files open, closing the least recently used first.
+    Files are never closed while in use, so there may be more open for a while."""
+
+    def __init__(self, maxopen):
+        self.maxopen = maxopen
+        self.files = collections.OrderedDict()
+        self.users = collections.defaultdict(int) # nr of readers of each file
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def open(self, path):
+        with self.lock:
+            f = self.files.pop(path, None)
+            if f is not None:
+                self.files[path] = f
+            self.users[path] += 1
+        try:
+            if f is None:
+                # opened outside the lock so other files can be opened meanwhile
+                opened = HDF5(path)
+                with self.lock:
+                    f = self.files.setdefault(path, opened)
+                if f is not opened:
+                    opened.close()
+            yield f
+        finally:
+            with self.lock:
+                self.users[path] -= 1
+                if not self.users[path]:
+                    del self.users[path]
+                self._evict()
+
+    def _evict(self):
+        for path in list(self.files):
+            if len(self.files) <= self.maxopen:
+                break
+            if path not in self.users:
+                self.files.pop(path).close()
+
+    def close(self):
+        with self.lock:
+            for f in self.files.values():
+                f.close()
+            self.files.clear()
+
+
+class _StorageFile(object):
+    """File-like reading from a storage, where each thread has its own position,
+    so that threads reading the same file don't move each other's position."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self._local = threading.local()
+
+    @property
+    def pos(self):
+        return getattr(self._local, "pos", 0)
+
+    @pos.setter
+    def pos(self, pos):
+        self._local.pos = pos
+
+    def read(self, n):
+        pos = self.pos
+        raw = self.storage.read_range(pos, n)
+        self.pos = pos + len(raw)
+        return raw
+
+    def read_range(self, offset, length):
+        return self.storage.read_range(offset, length)
+
+    def read_ranges(self, ranges):
+        return self.storage.read_ranges(ranges)
+
+    def seek(self, pos, whence=0):
+        self.pos = pos if whence == 0 else self.pos + pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.storage.close()
+
+
 class _FileWrap(object):
+    """Reads and writes the basic types of a file. With maxblocks, small reads are served from
+    a cache of up to that many aligned blocks of blocksize bytes, so that parsing metadata
+    fetches a few blocks rather than making many tiny reads, while reads of at least
+    blocksize bytes, such as chunks of raw data, go straight to the file."""
     endian = "<"
+    # which checksums to verify when reading: "off", "metadata" or "all"
+    checksums = "off"
     
-    def __init__(self, fileobj):
+    def __init__(self, fileobj, blocksize=64 * 1024, maxblocks=0):
         self.fileobj = fileobj
+        self.blocksize = blocksize
+        self._blocks = _LRUCache(maxblocks) if maxblocks else None
 
     # Basic reading
 
@@ -89,13 +1401,66 @@ class _FileWrap(object):
         return value
 
     def read_bytes(self, n):
-        raw = self.fileobj.read(n)
+        if self._blocks is None or n >= self.blocksize:
+            return self.fileobj.read(n)
+        if n <= 0:
+            return b""
+
+        pos = self.fileobj.tell()
+        first = pos // self.blocksize
+        last = (pos + n - 1) // self.blocksize
+        raw = b"".join(self._get_block(index) for index in range(first, last + 1))
+        start = pos - first * self.blocksize
+        raw = raw[start:start + n]
+        self.fileobj.seek(pos + len(raw))
         return raw
 
+    def _get_block(self, index):
+        block = self._blocks.get(index)
+        if block is None:
+            block = self.fileobj.read_range(index * self.blocksize, self.blocksize)
+            self._blocks.put(index, block)
+        return block
+
     def read_unknown_nr(self, size, n):
         typ = {1:"B",2:"H",4:"I",8:"Q"}[size]
         return self.read_struct_type(typ, n)
 
+    def read_ranges(self, ranges):
+        "List of bytes read from each (offset, length) in ranges, at once if the storage allows"
+        if hasattr(self.fileobj, "read_ranges"):
+            return self.fileobj.read_ranges(ranges)
+        raws = []
+        for offset, length in ranges:
+            self.fileobj.seek(offset)
+            raws.append(self.fileobj.read(length))
+        return raws
+
+    @property
+    def concurrency(self):
+        "How many ranges the storage reads at once"
+        return getattr(getattr(self.fileobj, "storage", None), "maxconnections", 1)
+
+    # Basic writing
+
+    def write_struct_type(self, struct_type, n, value):
+        fmt = self.endian + bytes(n) + struct_type
+        if not isinstance(value, (tuple, list)):
+            value = (value,)
+        raw = struct.pack(fmt, *value)
+        self.write_bytes(raw)
+
+    def write_bytes(self, raw):
+        self.fileobj.write(raw)
+
+    def write_unknown_nr(self, size, n, value):
+        typ = {1:"B",2:"H",4:"I",8:"Q"}[size]
+        self.write_struct_type(typ, n, value)
+
+    def getvalue(self):
+        "All bytes written so far, only for in-memory buffers"
+        return self.fileobj.getvalue()
+
     # Positioning
 
     def tell(self):
@@ -105,10 +1470,12 @@ class _FileWrap(object):
         self.fileobj.seek(pos)
 
     def set_checkpoint(self):
-        self.pos = self.fileobj.tell()
+        if not hasattr(self, "_checkpoints"):
+            self._checkpoints = threading.local()
+        self._checkpoints.pos = self.fileobj.tell()
 
     def return_to_checkpoint(self):
-        self.fileobj.seek(self.pos, 0) # absolute position
+        self.fileobj.seek(self._checkpoints.pos, 0) # absolute position
 
 
 class _BaseObject(object):
@@ -116,12 +1483,14 @@ class _BaseObject(object):
         self.parent = parent
         
         if fileobj:
+            # kwargs give any extra info needed for reading
+            self.__dict__.update(kwargs)
             self.fileobj = fileobj
             self.pos = fileobj.tell()
             self.read()
         else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
     def __str__(self):
         from pprint import pformat
@@ -135,18 +1504,26 @@ class _BaseObject(object):
         return obj
 
     def _read_reserved(self, n):
-        val = self.fileobj.read_struct_type("B", n) # singlebyte unsigned nr
-        assert val == 0 
+        val = self.fileobj.read_bytes(n)
+        assert val == b"\x00" * n
+
+    def _read_checksum(self):
+        "Lookup3 checksum of everything from the start of the object"
+        self.checksum = self.fileobj.read_struct_type("s", 4)
+        _verify_lookup3(self.fileobj, self.pos, self.__class__.__name__)
         
 
 class _SuperBlock(object):
     def __init__(self, fileobj=None, **kwargs):
+        self._global_heaps = _LRUCache(64)
+        self._shared_messages = dict()
+
         if fileobj:
             self.fileobj = fileobj
             self.read()
         else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
+            # set superblock attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
     def __str__(self):
         from pprint import pformat
@@ -157,6 +1534,8 @@ class _SuperBlock(object):
             raise Exception("Must be initiated with a fileobj in order to call read()")
         
         self._read_format_signature()
+        # after any user block, where the signature was found
+        self.pos = self.fileobj.tell() - 8
         self._read_version()
 
         if self.version in (0,1):
@@ -201,9 +1580,35 @@ class _SuperBlock(object):
 
             self._read_superblock_checksum()
 
+    def write(self, fileobj):
+        if self.version not in (2,3):
+            raise NotImplementedError("Writing superblock version %s not yet supported" % self.version)
+
+        # build in memory first, since the checksum covers all the preceding bytes
+        self.fileobj = _FileWrap(io.BytesIO())
+
+        self._write_format_signature()
+        self._write_version()
+        self._write_offset_size()
+        self._write_length_size()
+        self._write_fileconsflags()
+
+        self._write_base_address()
+        self._write_superblockext_address()
+        self._write_end_address()
+        self._write_rootheader_address()
+
+        self._write_superblock_checksum()
+
+        fileobj.write_bytes(self.fileobj.getvalue())
+        self.fileobj = fileobj
+
     def get_root(self):
         if self.version in (0,1):
-            raise NotImplementedError("Data access for version 0 and 1 not yet supported")
+            offset = self.base_address + self.rootsymtable.header_address
+            self.fileobj.seek(offset)
+            root = _ObjectHeader(parent=self, fileobj=self.fileobj)
+            return root
 
         elif self.version in (2,3):
             offset = self.base_address + self.rootheader_address
@@ -211,6 +1616,56 @@ class _SuperBlock(object):
             root = _ObjectHeader(parent=self, fileobj=self.fileobj)
             return root
 
+    def get_global_heap(self, address):
+        "Global heap collection at address, kept in a cache since neighbouring vlen elements tend to share them"
+        collection = self._global_heaps.get(address)
+        if collection is None:
+            pos = self.fileobj.tell()
+            self.fileobj.seek(address)
+            collection = _GlobalHeapCollection(self, self.fileobj)
+            self.fileobj.seek(pos)
+            self._global_heaps.put(address, collection)
+        return collection
+
+    def get_extension(self):
+        "Superblock extension object header, or None"
+        if self.version < 2 or self.superblockext_address == UNDEFINED:
+            return None
+        if not hasattr(self, "_extension"):
+            pos = self.fileobj.tell()
+            self.fileobj.seek(self.base_address + self.superblockext_address)
+            self._extension = _ObjectHeader(parent=self, fileobj=self.fileobj)
+            self.fileobj.seek(pos)
+        return self._extension
+
+    def get_shared_message_table(self):
+        if not hasattr(self, "_sharedmessagetable"):
+            extension = self.get_extension()
+            tablemsg = extension.get_message(15) if extension else None
+            if tablemsg is None:
+                raise Exception("File has messages in a shared message heap, but no shared message table")
+            pos = self.fileobj.tell()
+            self.fileobj.seek(tablemsg.table_address)
+            self._sharedmessagetable = _SharedMessageTable(self, self.fileobj, nindices=tablemsg.nindices)
+            self.fileobj.seek(pos)
+        return self._sharedmessagetable
+
+    def get_shared_message(self, msgtype, heapid=None, address=None):
+        """Message shared in the shared message heap (heapid) or in another object header (address).
+        Each is only decoded once per file and reused by all the objects that refer to it."""
+        key = (msgtype, heapid, address)
+        if key not in self._shared_messages:
+            pos = self.fileobj.tell()
+            if heapid is not None:
+                data = self.get_shared_message_table().get_message(msgtype, heapid)
+            else:
+                self.fileobj.seek(address)
+                header = _ObjectHeader(parent=self, fileobj=self.fileobj)
+                data = header.get_message(msgtype)
+            self.fileobj.seek(pos)
+            self._shared_messages[key] = data
+        return self._shared_messages[key]
+
     # internal
 
     def _read_extension(self):
@@ -223,6 +1678,8 @@ class _SuperBlock(object):
         # keep looking for formatsign if not found
         byteoffset = 512
         while formatsign != '\x89HDF\r\n\x1a\n':
+            if len(formatsign) < 8:
+                raise IOError("Not an HDF5 file, no superblock signature found")
             self.fileobj.seek(byteoffset)
             formatsign = self.fileobj.read_bytes(8)
             
@@ -244,8 +1701,8 @@ class _SuperBlock(object):
         self.rootsymtable_version = self.fileobj.read_struct_type("B", 1) # singlebyte unsigned nr
 
     def _read_reserved(self, n):
-        val = self.fileobj.read_struct_type("B", n) # singlebyte unsigned nr
-        assert val == 0 
+        val = self.fileobj.read_bytes(n)
+        assert val == b"\x00" * n
 
     def _read_sharedheadermsg_version(self):
         "Shared header message version"
@@ -278,12 +1735,12 @@ class _SuperBlock(object):
 
     def _read_groupleafnodek(self):
         "Group Leaf Node K"
-        self.groupleafnodek = self.fileobj.read_struct_type("B", 1) # singlebyte unsigned nr
+        self.groupleafnodek = self.fileobj.read_struct_type("H", 1) # 2byte unsigned short
         assert self.groupleafnodek > 0
 
     def _read_groupinternalnodek(self):
         "Group Internal Node K"
-        self.groupinternalnodek = self.fileobj.read_struct_type("B", 1) # singlebyte unsigned nr
+        self.groupinternalnodek = self.fileobj.read_struct_type("H", 1) # 2byte unsigned short
         assert self.groupinternalnodek > 0
 
     def _read_indexedstorageinternalnodek(self):
@@ -313,15 +1770,49 @@ class _SuperBlock(object):
         
     def _read_rootsymtable(self):
         "Root group symbol table entry"
-        pass
+        self.rootsymtable = _SymbolTableEntry(self, self.fileobj)
 
     def _read_rootheader_address(self):
         "Start of Root group object header"
         self.rootheader_address = self.fileobj.read_unknown_nr(self.offset_size, 1)
 
     def _read_superblock_checksum(self):
-        # TODO: Not sure how to parse checksum...
         self.superblock_checksum = self.fileobj.read_struct_type("s",4)
+        _verify_lookup3(self.fileobj, self.pos, "superblock")
+
+    # internal writing
+
+    def _write_format_signature(self):
+        self.fileobj.write_bytes('\x89HDF\r\n\x1a\n')
+
+    def _write_version(self):
+        self.fileobj.write_struct_type("B", 1, self.version)
+
+    def _write_offset_size(self):
+        self.fileobj.write_struct_type("B", 1, self.offset_size)
+
+    def _write_length_size(self):
+        self.fileobj.write_struct_type("B", 1, self.length_size)
+
+    def _write_fileconsflags(self):
+        # file is always left closed and consistent
+        self.fileobj.write_struct_type("B", 1, 0)
+
+    def _write_base_address(self):
+        self.fileobj.write_unknown_nr(self.offset_size, 1, self.base_address)
+
+    def _write_superblockext_address(self):
+        self.fileobj.write_unknown_nr(self.offset_size, 1, self.superblockext_address)
+
+    def _write_end_address(self):
+        self.fileobj.write_unknown_nr(self.offset_size, 1, self.end_address)
+
+    def _write_rootheader_address(self):
+        self.fileobj.write_unknown_nr(self.offset_size, 1, self.rootheader_address)
+
+    def _write_superblock_checksum(self):
+        self.superblock_checksum = struct.pack("<I", _lookup3(self.fileobj.getvalue()))
+        self.fileobj.write_bytes(self.superblock_checksum)
 
 
 
@@ -353,17 +1844,13 @@ class _v1BTreeNode(_BaseObject):
         obj = self
         while not isinstance(obj, _ObjectHeader):
             obj = obj.parent
-        for msg in obj.messages:
-            if isinstance(msg["msgdata"], _DataTypeMessage):
-                return msg["msgdata"]
+        return obj.get_message(3)
 
     def get_datafilter_pipeline(self):
         obj = self
         while not isinstance(obj, _ObjectHeader):
             obj = obj.parent
-        for msg in obj.messages:
-            if isinstance(msg["msgdata"], _FilterPipelineMessage):
-                return msg["msgdata"]
+        return obj.get_message(11)
             
     def read(self):
         self.fileobj.seek(self.pos)
@@ -400,6 +1887,72 @@ class _v1BTreeNode(_BaseObject):
         superblock = self.get_root().parent
         self.address_right = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
 
+    def get_node_size(self):
+        "Size on disk of a node with room for all 2K entries, which is what readers expect to find"
+        superblock = self.get_root().parent
+        if self.node_type == 0:
+            K = superblock.groupinternalnodek
+            keysize = superblock.length_size
+        elif self.node_type == 1:
+            K = superblock.indexedstorageinternalnodek
+            keysize = 4 + 4 + 8 * self.get_dimensionality()
+        return 4 + 1 + 1 + 2 + 2 * superblock.offset_size + (2*K + 1) * keysize + 2*K * superblock.offset_size
+
+    def write(self, fileobj):
+        "Writes keys and child_pointers, where there is one more key than child pointers"
+        self.fileobj = fileobj
+        self.pos = fileobj.tell()
+
+        self._write_signature()
+        self._write_node_type()
+        self._write_node_level()
+        self._write_entries_used()
+        self._write_address_left()
+        self._write_address_right()
+        self._write_children()
+
+        # pad to the full node size
+        used = self.fileobj.tell() - self.pos
+        self.fileobj.write_bytes(b"\x00" * (self.get_node_size() - used))
+
+    def _write_signature(self):
+        self.fileobj.write_bytes("TREE")
+
+    def _write_node_type(self):
+        self.fileobj.write_struct_type("B", 1, self.node_type)
+
+    def _write_node_level(self):
+        self.fileobj.write_struct_type("B", 1, self.node_level)
+
+    def _write_entries_used(self):
+        self.fileobj.write_struct_type("H", 1, len(self.child_pointers))
+
+    def _write_address_left(self):
+        superblock = self.get_root().parent
+        self.fileobj.write_unknown_nr(superblock.offset_size, 1, self.address_left)
+
+    def _write_address_right(self):
+        superblock = self.get_root().parent
+        self.fileobj.write_unknown_nr(superblock.offset_size, 1, self.address_right)
+
+    def _write_children(self):
+        superblock = self.get_root().parent
+        if self.node_type == 1:
+            dimensionality = self.get_dimensionality()
+
+            def write_key(key):
+                self.fileobj.write_unknown_nr(4, 1, key["chunksize"])
+                self.fileobj.write_bytes(_bitbytes(4, *enumerate(key["filtermask"])))
+                self.fileobj.write_struct_type("Q", dimensionality, key["offsets"][:dimensionality])
+
+        else:
+            raise NotImplementedError("Writing btree nodes of type %s not yet supported" % self.node_type)
+
+        for key, address in zip(self.keys, self.child_pointers):
+            write_key(key)
+            self.fileobj.write_unknown_nr(superblock.offset_size, 1, address)
+        write_key(self.keys[-1])
+
     def children(self):
         superblock = self.get_root().parent
         self.fileobj.seek(self._children_start)
@@ -446,6 +1999,23 @@ class _v1BTreeNode(_BaseObject):
                 yield prevkey, address, key
                 prevkey = key
 
+    def iter_chunks(self, lower, upper):
+        """Yields (offsets, address, size, filtermask) of the chunks overlapping the box from lower up to upper.
+        Keys are ordered by chunk offsets, so only subtrees that may overlap along the first dimension are visited."""
+        chunkshape = self.get_dimsizes()[:-1]
+        for key, child_pointer, nextkey in list(self.children()):
+            offsets = key["offsets"][:-1]
+            if self.node_level > 0:
+                if key["offsets"][0] >= upper[0] or nextkey["offsets"][0] + chunkshape[0] <= lower[0]:
+                    continue
+                self.fileobj.seek(child_pointer)
+                subnode = _v1BTreeNode(self, self.fileobj)
+                for chunk in subnode.iter_chunks(lower, upper):
+                    yield chunk
+            elif all(offset < up and offset + size > low
+                     for offset, size, low, up in zip(offsets, chunkshape, lower, upper)):
+                yield tuple(offsets), child_pointer, key["chunksize"], key["filtermask"]
+
     def read_data(self):
         # dayalayout retrieves data by calling this method on the top btree node
         # so this should get all data from all subnodes and subtrees readily structured for endusers
@@ -484,7 +2054,6 @@ class _v1BTreeNode(_BaseObject):
                 
         elif self.node_level == 0:
             dtype = self.get_dtype()
-            endian,typ = dtype.get_struct_type()
 
             dimsizes = self.get_dimsizes()
             datafilter_pipeline = self.get_datafilter_pipeline()
@@ -508,13 +2077,7 @@ class _v1BTreeNode(_BaseObject):
                         # TODO: dont use datafilter if skip filter flag is set...
                         raw = datafilter_pipeline.decode(raw)
 
-                    count = int(len(raw) / float(dtype.size))
-                    frmt = endian+bytes(count)+typ
-                    bufsize = struct.calcsize(frmt)
-                    print frmt, bufsize, len(raw)
-                    
-                    flat = struct.unpack(frmt, raw)
-                    print len(flat)
+                    flat = dtype.decode(raw)
                     
 ##                    count = reduce(lambda init,nxt: init * nxt, dimsizes) # multiplying size of all chunk dims gives total chunk number of chunk items
 ##                    frmt = endian+bytes(count)+typ
@@ -530,287 +2093,2097 @@ class _v1BTreeNode(_BaseObject):
                     #start = mainkey['offsets'][:-1] # last one is just junk
                     #region = [slice(i, i+j) for i, j in zip(start, chunk_shape)]
                     
-                    print "###",repr(flat)[:100], "nonmiss", len([v for v in flat if -10 < v < 10]), "max", max(flat), "min", min(flat)
                     data.append(flat)
                     
                 elif self.node_type == 0:
                     # group node (when and why is this used instead of chunk???)
                     mainkey = key_plus_1 # key # describes greatest object in right child??
-                    symtable = _SymbolTable(self, self.fileobj)
+                    symtable = _SymbolTableNode(self, self.fileobj)
                     # TODO: add to data...
                     print "###",symtable
         return data
 
-class _v2BTreeHeader(object):
-    def __init__(self):
-        pass
+class _v2BTreeHeader(_BaseObject):
+    "Version 2 btree, records are read on demand by walking down from the root node. Btrees of chunks require ndims"
 
-class _v2BTreeNode(object):
-    def __init__(self):
-        pass
+    def read(self):
+        self.fileobj.seek(self.pos)
 
-class _v2BTreeLeafNode(object):
-    def __init__(self):
-        pass
+        self._read_signature()
+        self._read_version()
+        self._read_type()
+        self._read_node_size()
+        self._read_record_size()
+        self._read_depth()
+        self._read_split_percent()
+        self._read_merge_percent()
+        self._read_root_address()
+        self._read_root_nrecords()
+        self._read_total_nrecords()
+        self._read_checksum()
+
+        self._init_node_info()
 
+    def _read_signature(self):
+        self.signature = self.fileobj.read_struct_type("s", 4)
+        assert self.signature == "BTHD"
 
-class _HeapBlock(object):
-    def __init__(self):
-        pass
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+        assert self.version == 0
 
+    def _read_type(self):
+        self.type = self.fileobj.read_struct_type("B", 1)
 
-class _ObjectHeader(object):
-    def __init__(self, parent, fileobj=None, **kwargs):
-        "If root object, parent must be the superblock object, otherwise just a parent object"
-        self.parent = parent
-        
-        if fileobj:
-            self.fileobj = fileobj
-            self.read()
-        else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
+    def _read_node_size(self):
+        self.node_size = self.fileobj.read_struct_type("I", 1)
 
-    def __str__(self):
-        from pprint import pformat
-        return "----- \n %r \n %s"%(self, pformat(self.__dict__, indent=4) )
+    def _read_record_size(self):
+        self.record_size = self.fileobj.read_struct_type("H", 1)
 
-    def get_root(self):
-        obj = self
-        while hasattr(obj, "parent") and not isinstance(obj.parent, _SuperBlock):
-            obj = obj.parent
+    def _read_depth(self):
+        self.depth = self.fileobj.read_struct_type("H", 1)
 
-        return obj
-    
-    def read(self):
-        if not hasattr(self, "fileobj"):
-            raise Exception("Must be initiated with a fileobj in order to call read()")
+    def _read_split_percent(self):
+        self.split_percent = self.fileobj.read_struct_type("B", 1)
 
-        self._read_prefix()
-        self._read_messages()
+    def _read_merge_percent(self):
+        self.merge_percent = self.fileobj.read_struct_type("B", 1)
 
-    # internal
+    def _read_root_address(self):
+        superblock = self.get_root().parent
+        self.root_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
 
-    def _read_prefix(self):
-        self.prefix = _ObjectHeaderPrefix(parent=self, fileobj=self.fileobj)
+    def _read_root_nrecords(self):
+        self.root_nrecords = self.fileobj.read_struct_type("H", 1)
 
-    def _read_messages(self):
-        self.messages = self.prefix._read_messages()
+    def _read_total_nrecords(self):
+        superblock = self.get_root().parent
+        self.total_nrecords = self.fileobj.read_unknown_nr(superblock.length_size, 1)
 
+    def _init_node_info(self):
+        # the byte sizes of the record counts in internal nodes depend on how many records
+        # could at most fit below them, computed the same way as the hdf5 library does
+        superblock = self.get_root().parent
+        prefix = 4 + 1 + 1 + 4 # signature, version, type, checksum
+
+        maxrecords = (self.node_size - prefix) // self.record_size
+        self.nrecords_size = _limit_enc_size(maxrecords)
+        self.cum_maxrecords = [maxrecords]
+        self.cum_nrecords_sizes = [0]
+
+        for depth in range(1, self.depth + 1):
+            pointersize = superblock.offset_size + self.nrecords_size
+            if depth > 1:
+                pointersize += self.cum_nrecords_sizes[depth-1]
+            maxrecords = (self.node_size - (prefix + pointersize)) // (self.record_size + pointersize)
+            cum_maxrecords = (maxrecords + 1) * self.cum_maxrecords[depth-1] + maxrecords
+            self.cum_maxrecords.append(cum_maxrecords)
+            self.cum_nrecords_sizes.append(_limit_enc_size(cum_maxrecords))
+
+    def read_node(self, address, nrecords, depth):
+        self.fileobj.seek(address)
+        if depth == 0:
+            return _v2BTreeLeafNode(self, self.fileobj, nrecords=nrecords, depth=depth)
+        else:
+            return _v2BTreeNode(self, self.fileobj, nrecords=nrecords, depth=depth)
+
+    def iter_records(self):
+        "All records in sorted order"
+        if self.root_address == UNDEFINED:
+            return iter([])
+        return self._iter_records(self.root_address, self.root_nrecords, self.depth)
+
+    def _iter_records(self, address, nrecords, depth):
+        node = self.read_node(address, nrecords, depth)
+        for i, record in enumerate(node.records):
+            if depth > 0:
+                for subrecord in self._iter_records(*node.children[i]):
+                    yield subrecord
+            yield record
+        if depth > 0:
+            for subrecord in self._iter_records(*node.children[-1]):
+                yield subrecord
+
+    def find(self, compare):
+        """Yields all records for which compare(record) returns 0, where compare returns
+        a negative or positive number when the wanted record sorts before or after it.
+        Only the nodes on the path to the matching records are read."""
+        if self.root_address == UNDEFINED:
+            return iter([])
+        return self._find(self.root_address, self.root_nrecords, self.depth, compare)
+
+    def _find(self, address, nrecords, depth, compare):
+        node = self.read_node(address, nrecords, depth)
+        records = node.records
+
+        # binary search for the first record not before the wanted one
+        low, high = 0, len(records)
+        while low < high:
+            mid = (low + high) // 2
+            if compare(records[mid]) > 0:
+                low = mid + 1
+            else:
+                high = mid
 
-class _ObjectData(object):
-    def __init__(self):
-        pass
+        i = low
+        if depth > 0:
+            for record in self._find(compare=compare, *node.children[i]):
+                yield record
+        while i < len(records) and compare(records[i]) == 0:
+            yield records[i]
+            i += 1
+            if depth > 0:
+                for record in self._find(compare=compare, *node.children[i]):
+                    yield record
 
 
-class _FreeSpace(object):
-    def __init__(self):
-        pass
+class _v2BTreeLeafNode(_BaseObject):
+    "Requires nrecords and depth to be given when reading"
 
+    def read(self):
+        self.fileobj.seek(self.pos)
 
-# object header components and message types
-# ...
+        self._read_signature()
+        self._read_version()
+        self._read_type()
+        self._read_records()
+        self._read_children()
+        self._read_checksum()
 
-class _ObjectHeaderPrefix(object):
-    def __init__(self, parent, fileobj=None, **kwargs):
-        self.parent = parent
-        
-        if fileobj:
-            self.fileobj = fileobj
-            self.read()
-        else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
+    def _read_signature(self):
+        self.signature = self.fileobj.read_struct_type("s", 4)
+        assert self.signature == self._signature
 
-    def __str__(self):
-        from pprint import pformat
-        return "----- \n %r \n %s"%(self, pformat(self.__dict__, indent=4) )
+    _signature = "BTLF"
 
-    def get_root(self):
-        obj = self
-        while hasattr(obj, "parent") and not isinstance(obj.parent, _SuperBlock):
-            obj = obj.parent
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+        assert self.version == 0
 
-        return obj
-    
-    def read(self):
-        if not hasattr(self, "fileobj"):
-            raise Exception("Must be initiated with a fileobj in order to call read()")
+    def _read_type(self):
+        self.type = self.fileobj.read_struct_type("B", 1)
+        assert self.type == self.parent.type
 
-        self._read_version()
+    def _read_records(self):
+        self.records = []
+        for _ in range(self.nrecords):
+            start = self.fileobj.tell()
+            self.records.append(self._read_record())
+            self.fileobj.seek(start + self.parent.record_size)
 
-        if self.version == 1:
-            raise NotImplementedError("Version 1 of objectheader prefix not yet supported")
+    def _read_record(self):
+        superblock = self.get_root().parent
+        record = dict()
+
+        if self.type == 1:
+            # indirectly accessed, non-filtered huge fractal heap object
+            record["address"] = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+            record["length"] = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+            record["id"] = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+
+        elif self.type == 2:
+            # indirectly accessed, filtered huge fractal heap object
+            record["address"] = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+            record["length"] = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+            raw = self.fileobj.read_bytes(4)
+            record["filtermask"] = [_bitflag(raw, i) for i in range(32)]
+            record["memorysize"] = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+            record["id"] = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+
+        elif self.type == 5:
+            # link name for indexed group
+            record["hash"] = self.fileobj.read_struct_type("I", 1)
+            record["heapid"] = self.fileobj.read_bytes(7)
+
+        elif self.type == 6:
+            # creation order for indexed group
+            record["creationorder"] = self.fileobj.read_struct_type("Q", 1)
+            record["heapid"] = self.fileobj.read_bytes(7)
+
+        elif self.type == 8:
+            # attribute name for indexed attributes
+            record["heapid"] = self.fileobj.read_bytes(8)
+            record["msgflags"] = self.fileobj.read_struct_type("B", 1)
+            record["creationorder"] = self.fileobj.read_struct_type("I", 1)
+            record["hash"] = self.fileobj.read_struct_type("I", 1)
+
+        elif self.type == 9:
+            # creation order for indexed attributes
+            record["heapid"] = self.fileobj.read_bytes(8)
+            record["msgflags"] = self.fileobj.read_struct_type("B", 1)
+            record["creationorder"] = self.fileobj.read_struct_type("I", 1)
+
+        elif self.type in (10, 11):
+            # chunks of a dataset with several unlimited dimensions, sorted by their scaled offsets
+            record["address"] = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+            if self.type == 11:
+                # filtered, where the chunk size takes up whatever is left of the record
+                sizelength = self.parent.record_size - superblock.offset_size - 4 - 8 * self.parent.ndims
+                record["size"] = _unpack_int(self.fileobj.read_bytes(sizelength))
+                raw = self.fileobj.read_bytes(4)
+                record["filtermask"] = [_bitflag(raw, i) for i in range(32)]
+            record["scaled"] = self.fileobj.read_struct_type("Q", self.parent.ndims)
+            if self.parent.ndims == 1:
+                record["scaled"] = (record["scaled"],)
 
-        elif self.version == 2:
-            self._read_flags()
+        else:
+            raise NotImplementedError("Version 2 btree records of type %s not yet supported" % self.type)
 
-            if self.flags["storetimes"]:
-                self._read_accesstime()
-                self._read_modiftime()
-                self._read_changetime()
-                self._read_birthtime()
+        return record
 
-            if self.flags["storenondefattrchange"]:
-                self._read_maxcompattr()
-                self._read_maxdensattr()
+    def _read_children(self):
+        pass
 
-            self._read_chunk0size()
 
-            # start of message headers (is not read automatically, has to be read via _read_messages())
-            self._chunkstart = self.fileobj.tell()
+class _v2BTreeNode(_v2BTreeLeafNode):
+    "Internal node, with one more child than records"
 
-            # skip the gap (seek to end - 4bytes for checksum)
-            self.fileobj.seek(self._chunkstart + self.chunk0size - 4) 
-            self._read_checksum()
+    _signature = "BTIN"
 
-        # ...
+    def _read_children(self):
+        # each child is given as (address, nrecords, depth) ready to be passed to read_node()
+        superblock = self.get_root().parent
+        header = self.parent
+        self.children = []
+        for _ in range(self.nrecords + 1):
+            address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+            nrecords = _unpack_int(self.fileobj.read_bytes(header.nrecords_size))
+            if self.depth > 1:
+                # total nr of records below the child, not needed
+                self.fileobj.read_bytes(header.cum_nrecords_sizes[self.depth-1])
+            self.children.append((address, nrecords, self.depth - 1))
 
-    def _read_version(self):
+
+class _ChunkArray(_BaseObject):
+    """Base of the array indexes of chunks, which hold an entry for each chunk at its place in the
+    chunk grid, so that finding a chunk takes no search. Blocks of entries are read on demand and kept."""
+
+    def _read_signature(self):
+        self.signature = self.fileobj.read_struct_type("s", 4)
+        assert self.signature == self._signature
+
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+        assert self.version == 0
+
+    def _read_client_id(self):
+        # 0 for chunks without filters, 1 for filtered chunks
+        self.client_id = self.fileobj.read_struct_type("B", 1)
+
+    def _read_block(self, address, size):
+        "Bytes of a block or page of entries ending in a checksum"
+        if not hasattr(self, "_blocks"):
+            self._blocks = dict()
+        raw = self._blocks.get(address)
+        if raw is None:
+            self.fileobj.seek(address)
+            raw = self.fileobj.read_bytes(size)
+            if self.fileobj.checksums != "off" and _lookup3(raw[:-4]) != struct.unpack("<I", raw[-4:])[0]:
+                raise IOError("Checksum mismatch in %s block at address %s" % (self.__class__.__name__, address))
+            self._blocks[address] = raw
+        return raw
+
+    def _decode_entry(self, raw):
+        """(address, size, filtermask) of a chunk, where size and filtermask are None for
+        chunks without filters, and address is UNDEFINED if the chunk was never written"""
+        superblock = self.get_root().parent
+        address = _unpack_int(raw[:superblock.offset_size])
+        if self.client_id == 0:
+            return address, None, None
+        size = _unpack_int(raw[superblock.offset_size:-4])
+        mask = raw[-4:]
+        # almost always no filters are skipped
+        return address, size, [0] * 32 if mask == b"\x00" * 4 else [_bitflag(mask, i) for i in range(32)]
+
+
+class _FixedArray(_ChunkArray):
+    """Index of the chunks of a dataset without unlimited dimensions, with an entry for every chunk
+    of the maximum shape. Many entries are split into pages, which are only there once written to."""
+
+    _signature = "FAHD"
+
+    def read(self):
+        self.fileobj.seek(self.pos)
+
+        self._read_signature()
+        self._read_version()
+        self._read_client_id()
+        self._read_entry_size()
+        self._read_page_bits()
+        self._read_nentries()
+        self._read_datablock_address()
+        self._read_checksum()
+
+    def _read_entry_size(self):
+        self.entry_size = self.fileobj.read_struct_type("B", 1)
+
+    def _read_page_bits(self):
+        self.page_bits = self.fileobj.read_struct_type("B", 1)
+
+    def _read_nentries(self):
+        superblock = self.get_root().parent
+        self.nentries = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+
+    def _read_datablock_address(self):
+        superblock = self.get_root().parent
+        self.datablock_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def get_entry(self, index):
+        "(address, size, filtermask) of the chunk at index, as given by _ChunkArray._decode_entry()"
+        superblock = self.get_root().parent
+        # signature, version, client id and header address
+        prefix = 4 + 1 + 1 + superblock.offset_size
+        pagesize = 1 << self.page_bits
+        if self.nentries <= pagesize:
+            raw = self._read_block(self.datablock_address, prefix + self.nentries * self.entry_size + 4)
+            start = prefix + index * self.entry_size
+            return self._decode_entry(raw[start:start + self.entry_size])
+
+        # the prefix ends with a bitmap of the pages written to, highest bit first, and its own checksum
+        npages = -(-self.nentries // pagesize)
+        bitmapsize = -(-npages // 8)
+        raw = self._read_block(self.datablock_address, prefix + bitmapsize + 4)
+        page, i = divmod(index, pagesize)
+        if not ord(raw[prefix + page // 8]) & (0x80 >> page % 8):
+            return UNDEFINED, None, None
+        address = self.datablock_address + prefix + bitmapsize + 4 + page * (pagesize * self.entry_size + 4)
+        nentries = min(pagesize, self.nentries - page * pagesize)
+        raw = self._read_block(address, nentries * self.entry_size + 4)
+        return self._decode_entry(raw[i * self.entry_size:(i + 1) * self.entry_size])
+
+
+class _ExtensibleArray(_ChunkArray):
+    """Index of the chunks of a dataset with one unlimited dimension. The first entries are kept
+    in the index block, and the rest in data blocks that double in size every other block,
+    where the addresses of later data blocks are kept in super blocks."""
+
+    _signature = "EAHD"
+
+    def read(self):
+        self.fileobj.seek(self.pos)
+
+        self._read_signature()
+        self._read_version()
+        self._read_client_id()
+        self._read_parameters()
+        self._read_statistics()
+        self._read_indexblock_address()
+        self._read_checksum()
+
+        self._init_block_info()
+        self._superblocks = dict()
+        if self.indexblock_address != UNDEFINED:
+            self.fileobj.seek(self.indexblock_address)
+            self.indexblock = _ExtensibleArrayIndexBlock(self, self.fileobj)
+
+    def _read_parameters(self):
+        (self.entry_size, self.max_nentries_bits, self.indexblock_nentries, self.datablock_min_nentries,
+         self.superblock_min_pointers, self.page_bits) = self.fileobj.read_struct_type("B", 6)
+
+    def _read_statistics(self):
+        "Nr and size of the super and data blocks, the highest index set and the nr of entries, not needed"
+        superblock = self.get_root().parent
+        self.fileobj.read_unknown_nr(superblock.length_size, 6)
+
+    def _read_indexblock_address(self):
+        superblock = self.get_root().parent
+        self.indexblock_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def _init_block_info(self):
+        # computed the same way as the hdf5 library does, with super block i having 2**(i//2)
+        # data blocks of 2**((i+1)//2) times the smallest data block size each
+        self.superblock_info = []
+        start = startblock = 0
+        for i in range(1 + self.max_nentries_bits - _log2(self.datablock_min_nentries)):
+            nblocks = 2 ** (i // 2)
+            nentries = 2 ** ((i + 1) // 2) * self.datablock_min_nentries
+            self.superblock_info.append((nblocks, nentries, start, startblock))
+            start += nblocks * nentries
+            startblock += nblocks
+        # the data blocks of the first super blocks are pointed to straight from the index block
+        self.direct_superblocks = 2 * _log2(self.superblock_min_pointers)
+        self.blockoffset_size = (self.max_nentries_bits + 7) // 8
+
+    def get_entry(self, index):
+        "(address, size, filtermask) of the chunk at index, as given by _ChunkArray._decode_entry()"
+        if self.indexblock_address == UNDEFINED:
+            return UNDEFINED, None, None
+        if index < self.indexblock_nentries:
+            return self._decode_entry(self.indexblock.entries[index])
+
+        index -= self.indexblock_nentries
+        sblock = _log2(index // self.datablock_min_nentries + 1)
+        nblocks, nentries, start, startblock = self.superblock_info[sblock]
+        block, i = divmod(index - start, nentries)
+        pageinit = None
+        if sblock < self.direct_superblocks:
+            address = self.indexblock.datablock_addresses[startblock + block]
+        else:
+            address = self.indexblock.superblock_addresses[sblock - self.direct_superblocks]
+            if address == UNDEFINED:
+                return UNDEFINED, None, None
+            if address not in self._superblocks:
+                self.fileobj.seek(address)
+                self._superblocks[address] = _ExtensibleArraySuperBlock(self, self.fileobj, index=sblock)
+            superblock = self._superblocks[address]
+            address = superblock.datablock_addresses[block]
+            if superblock.pageinit:
+                pageinit = superblock.pageinit[block]
+        if address == UNDEFINED:
+            return UNDEFINED, None, None
+
+        # signature, version, client id, header address and block offset
+        prefix = 4 + 1 + 1 + self.get_root().parent.offset_size + self.blockoffset_size
+        pagesize = 1 << self.page_bits
+        if nentries <= pagesize:
+            raw = self._read_block(address, prefix + nentries * self.entry_size + 4)
+            start = prefix + i * self.entry_size
+            return self._decode_entry(raw[start:start + self.entry_size])
+
+        # pages follow the checksum of the prefix, and the super block knows which were written to
+        page, i = divmod(i, pagesize)
+        if pageinit is not None and not ord(pageinit[page // 8]) & (0x80 >> page % 8):
+            return UNDEFINED, None, None
+        raw = self._read_block(address + prefix + 4 + page * (pagesize * self.entry_size + 4),
+                               pagesize * self.entry_size + 4)
+        return self._decode_entry(raw[i * self.entry_size:(i + 1) * self.entry_size])
+
+
+class _ExtensibleArrayIndexBlock(_BaseObject):
+
+    def read(self):
+        self.fileobj.seek(self.pos)
+
+        self._read_signature()
+        self._read_version()
+        self._read_client_id()
+        self._read_header_address()
+        self._read_entries()
+        self._read_datablock_addresses()
+        self._read_superblock_addresses()
+        self._read_checksum()
+
+    def _read_signature(self):
+        self.signature = self.fileobj.read_struct_type("s", 4)
+        assert self.signature == "EAIB"
+
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+        assert self.version == 0
+
+    def _read_client_id(self):
+        self.client_id = self.fileobj.read_struct_type("B", 1)
+
+    def _read_header_address(self):
+        superblock = self.get_root().parent
+        self.header_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def _read_entries(self):
+        header = self.parent
+        raw = self.fileobj.read_bytes(header.indexblock_nentries * header.entry_size)
+        self.entries = [raw[i:i + header.entry_size] for i in range(0, len(raw), header.entry_size)]
+
+    def _read_datablock_addresses(self):
+        superblock = self.get_root().parent
+        n = 2 * (self.parent.superblock_min_pointers - 1)
+        self.datablock_addresses = [self.fileobj.read_unknown_nr(superblock.offset_size, 1) for _ in range(n)]
+
+    def _read_superblock_addresses(self):
+        superblock = self.get_root().parent
+        n = len(self.parent.superblock_info) - self.parent.direct_superblocks
+        self.superblock_addresses = [self.fileobj.read_unknown_nr(superblock.offset_size, 1) for _ in range(n)]
+
+
+class _ExtensibleArraySuperBlock(_BaseObject):
+    "Addresses of the data blocks of the super block at index in the extensible array. Requires index"
+
+    def read(self):
+        self.fileobj.seek(self.pos)
+
+        self._read_signature()
+        self._read_version()
+        self._read_client_id()
+        self._read_header_address()
+        self._read_block_offset()
+        self._read_pageinit()
+        self._read_datablock_addresses()
+        self._read_checksum()
+
+    def _read_signature(self):
+        self.signature = self.fileobj.read_struct_type("s", 4)
+        assert self.signature == "EASB"
+
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+        assert self.version == 0
+
+    def _read_client_id(self):
+        self.client_id = self.fileobj.read_struct_type("B", 1)
+
+    def _read_header_address(self):
+        superblock = self.get_root().parent
+        self.header_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def _read_block_offset(self):
+        self.block_offset = _unpack_int(self.fileobj.read_bytes(self.parent.blockoffset_size))
+
+    def _read_pageinit(self):
+        "For paged data blocks, a bitmap of the pages written to for each"
+        nblocks, nentries, start, startblock = self.parent.superblock_info[self.index]
+        npages = nentries >> self.parent.page_bits
+        self.pageinit = []
+        if npages > 1:
+            size = -(-npages // 8)
+            self.pageinit = [self.fileobj.read_bytes(size) for _ in range(nblocks)]
+
+    def _read_datablock_addresses(self):
+        superblock = self.get_root().parent
+        nblocks = self.parent.superblock_info[self.index][0]
+        self.datablock_addresses = [self.fileobj.read_unknown_nr(superblock.offset_size, 1) for _ in range(nblocks)]
+
+
+class _FractalHeap(_BaseObject):
+    "Fractal heap header, objects are looked up by their heap id"
+
+    def read(self):
+        self.fileobj.seek(self.pos)
+
+        self._read_signature()
+        self._read_version()
+        self._read_heapid_length()
+        self._read_filters_length()
+        self._read_flags()
+        self._read_max_managed_size()
+
+        # lengths and addresses describing the state of the heap, mostly needed for writing
+        superblock = self.get_root().parent
+        self.next_huge_id = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+        self.huge_btree_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+        self.managed_free_space = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+        self.freespace_manager_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+        self.managed_space = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+        self.managed_allocated_space = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+        self.managed_iterator_offset = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+        self.managed_count = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+        self.huge_size = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+        self.huge_count = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+        self.tiny_size = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+        self.tiny_count = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+
+        # doubling table
+        self._read_table_width()
+        self._read_starting_block_size()
+        self._read_max_direct_block_size()
+        self._read_max_heap_size()
+        self._read_starting_rows()
+        self._read_root_block_address()
+        self._read_current_rows()
+
+        if self.filters_length:
+            self._read_root_filter_info()
+
+        self._read_checksum()
+
+        # derived sizes
+        self._offset_size = (self.max_heap_size + 7) // 8
+        self._length_size = (_log2(min(self.max_direct_block_size, self.max_managed_size)) + 7) // 8
+        self._max_direct_rows = _log2(self.max_direct_block_size) - _log2(self.starting_block_size) + 2
+
+    def _read_signature(self):
+        self.signature = self.fileobj.read_struct_type("s", 4)
+        assert self.signature == "FRHP"
+
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+        assert self.version == 0
+
+    def _read_heapid_length(self):
+        self.heapid_length = self.fileobj.read_struct_type("H", 1)
+
+    def _read_filters_length(self):
+        self.filters_length = self.fileobj.read_struct_type("H", 1)
+
+    def _read_flags(self):
+        raw = self.fileobj.read_bytes(1)
+        self.flags = dict(hugeidwrapped=_bitflag(raw, 0),
+                          directchecksums=_bitflag(raw, 1))
+
+    def _read_max_managed_size(self):
+        self.max_managed_size = self.fileobj.read_struct_type("I", 1)
+
+    def _read_table_width(self):
+        self.table_width = self.fileobj.read_struct_type("H", 1)
+
+    def _read_starting_block_size(self):
+        superblock = self.get_root().parent
+        self.starting_block_size = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+
+    def _read_max_direct_block_size(self):
+        superblock = self.get_root().parent
+        self.max_direct_block_size = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+
+    def _read_max_heap_size(self):
+        "Log2 of the maximum heap size, ie the nr of bits in heap offsets"
+        self.max_heap_size = self.fileobj.read_struct_type("H", 1)
+
+    def _read_starting_rows(self):
+        self.starting_rows = self.fileobj.read_struct_type("H", 1)
+
+    def _read_root_block_address(self):
+        superblock = self.get_root().parent
+        self.root_block_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def _read_current_rows(self):
+        "Nr of rows in the root indirect block, 0 if the root is a direct block"
+        self.current_rows = self.fileobj.read_struct_type("H", 1)
+
+    def _read_root_filter_info(self):
+        superblock = self.get_root().parent
+        self.root_filtered_size = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+        raw = self.fileobj.read_bytes(4)
+        self.root_filtermask = [_bitflag(raw, i) for i in range(32)]
+        start = self.fileobj.tell()
+        self.filter_pipeline = _FilterPipelineMessage(self, self.fileobj)
+        self.fileobj.seek(start + self.filters_length)
+
+    # object access
+
+    def get_row_block_size(self, row):
+        return self.starting_block_size * 2 ** max(row - 1, 0)
+
+    def get_object(self, heapid):
+        "Raw bytes of the object with the given heap id"
+        flags = ord(heapid[0])
+        version = flags >> 6
+        assert version == 0
+        idtype = (flags >> 4) & 3
+
+        if idtype == 0:
+            # managed, stored in one of the direct blocks
+            offset = _unpack_int(heapid[1:1+self._offset_size])
+            length = _unpack_int(heapid[1+self._offset_size:1+self._offset_size+self._length_size])
+            return self._read_managed(offset, length)
+
+        elif idtype == 1:
+            return self._read_huge(heapid)
+
+        elif idtype == 2:
+            # tiny, stored in the heap id itself
+            if self.heapid_length <= 18:
+                length = (flags & 0x0f) + 1
+                return heapid[1:1+length]
+            else:
+                length = ((flags & 0x0f) << 8 | ord(heapid[1])) + 1
+                return heapid[2:2+length]
+
+        else:
+            raise Exception("Invalid fractal heap id type %s" % idtype)
+
+    def _read_managed(self, offset, length):
+        address, blockoffset, blocksize, filtered = self._find_direct_block(offset)
+        check = self.flags["directchecksums"] and self.fileobj.checksums != "off"
+
+        if filtered is None:
+            if check:
+                self.fileobj.seek(address)
+                self._verify_direct_block(address, self.fileobj.read_bytes(blocksize))
+            self.fileobj.seek(address + offset - blockoffset)
+            return self.fileobj.read_bytes(length)
+
+        else:
+            size, filtermask = filtered
+            self.fileobj.seek(address)
+            raw = self.filter_pipeline.decode(self.fileobj.read_bytes(size))
+            if check:
+                self._verify_direct_block(address, raw)
+            return raw[offset - blockoffset:offset - blockoffset + length]
+
+    def _verify_direct_block(self, address, raw):
+        """Checks the checksum of a direct block the first time it is read, which follows its prefix
+        and is computed over the whole block with the checksum itself set to zero"""
+        if not hasattr(self, "_verified"):
+            self._verified = set()
+        if address in self._verified:
+            return
+        # signature, version, heap header address and block offset
+        start = 4 + 1 + self.get_root().parent.offset_size + self._offset_size
+        stored = struct.unpack("<I", raw[start:start + 4])[0]
+        if _lookup3(raw[:start] + b"\x00" * 4 + raw[start + 4:]) != stored:
+            raise IOError("Checksum mismatch in fractal heap direct block at address %s" % address)
+        self._verified.add(address)
+
+    def _find_direct_block(self, offset):
+        """Walks down the doubling table of indirect blocks to the direct block containing heap offset.
+        Returns its address, heap offset, size, and (filtered size, filtermask) if the heap is filtered."""
+        if self.current_rows == 0:
+            filtered = (self.root_filtered_size, self.root_filtermask) if self.filters_length else None
+            return self.root_block_address, 0, self.starting_block_size, filtered
+
+        address, nrows, blockoffset = self.root_block_address, self.current_rows, 0
+        while True:
+            self.fileobj.seek(address)
+            block = _HeapBlock(self, self.fileobj, nrows=nrows)
+
+            # find the row and column of the block entry spanning the offset
+            rowoffset = blockoffset
+            for row in range(nrows):
+                size = self.get_row_block_size(row)
+                if offset < rowoffset + size * self.table_width:
+                    break
+                rowoffset += size * self.table_width
+            else:
+                raise Exception("Heap offset %s outside of indirect block" % offset)
+            col = (offset - rowoffset) // size
+            childoffset = rowoffset + col * size
+            entry = block.entries[row * self.table_width + col]
+
+            if row < self._max_direct_rows:
+                childaddress, filtered = entry
+                if childaddress == UNDEFINED:
+                    raise Exception("Heap offset %s is in an unallocated block" % offset)
+                return childaddress, childoffset, size, filtered
+
+            else:
+                # an indirect block spanning size bytes has enough rows to add up to that size
+                address = entry
+                nrows = _log2(size) - _log2(self.starting_block_size * self.table_width) + 1
+                blockoffset = childoffset
+
+    def _read_huge(self, heapid):
+        superblock = self.get_root().parent
+        raw = heapid[1:]
+
+        if self.filters_length == 0 and self.heapid_length >= 1 + superblock.offset_size + superblock.length_size:
+            # address and length are stored directly in the heap id
+            address = _unpack_int(raw[:superblock.offset_size])
+            length = _unpack_int(raw[superblock.offset_size:superblock.offset_size + superblock.length_size])
+            filtermask = None
+
+        elif self.filters_length and self.heapid_length >= 1 + superblock.offset_size + 2 * superblock.length_size + 4:
+            # address, filtered length, filter mask and length once decoded
+            address = _unpack_int(raw[:superblock.offset_size])
+            length = _unpack_int(raw[superblock.offset_size:superblock.offset_size + superblock.length_size])
+            maskstart = superblock.offset_size + superblock.length_size
+            filtermask = [_bitflag(raw[maskstart:maskstart + 4], i) for i in range(32)]
+
+        else:
+            # look up the id in the huge object btree
+            hugeid = _unpack_int(raw[:min(self.heapid_length - 1, superblock.length_size)])
+            self.fileobj.seek(self.huge_btree_address)
+            btree = _v2BTreeHeader(self, self.fileobj)
+            for record in btree.find(lambda record: cmp(hugeid, record["id"])):
+                address, length = record["address"], record["length"]
+                filtermask = record["filtermask"] if btree.type == 2 else None
+                break
+            else:
+                raise Exception("Huge fractal heap object %s not found" % hugeid)
+
+        self.fileobj.seek(address)
+        data = self.fileobj.read_bytes(length)
+        if filtermask is not None:
+            data = self.filter_pipeline.decode(data, filtermask)
+        return data
+
+
+class _HeapBlock(_BaseObject):
+    """Fractal heap indirect block, pointing to the direct blocks that store the heap objects.
+    Requires the nr of rows to be given when reading."""
+
+    def read(self):
+        self.fileobj.seek(self.pos)
+
+        self._read_signature()
+        self._read_version()
+        self._read_heap_address()
+        self._read_block_offset()
+        self._read_entries()
+        self._read_checksum()
+
+    def _read_signature(self):
+        self.signature = self.fileobj.read_struct_type("s", 4)
+        assert self.signature == "FHIB"
+
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+        assert self.version == 0
+
+    def _read_heap_address(self):
+        superblock = self.get_root().parent
+        self.heap_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def _read_block_offset(self):
+        self.block_offset = _unpack_int(self.fileobj.read_bytes(self.parent._offset_size))
+
+    def _read_entries(self):
+        # direct block entries are (address, filterinfo), and indirect block entries just an address
+        superblock = self.get_root().parent
+        heap = self.parent
+        self.entries = []
+
+        directrows = min(self.nrows, heap._max_direct_rows)
+        for _ in range(directrows * heap.table_width):
+            address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+            if heap.filters_length:
+                size = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+                raw = self.fileobj.read_bytes(4)
+                self.entries.append((address, (size, [_bitflag(raw, i) for i in range(32)])))
+            else:
+                self.entries.append((address, None))
+
+        for _ in range((self.nrows - directrows) * heap.table_width):
+            self.entries.append(self.fileobj.read_unknown_nr(superblock.offset_size, 1))
+
+
+class _LocalHeap(_BaseObject):
+    "Local heap, storing the names of the members of a symbol table group"
+
+    def read(self):
+        self.fileobj.seek(self.pos)
+
+        self._read_signature()
+        self._read_version()
+        self._read_reserved(3)
+        self._read_data_size()
+        self._read_freelist_offset()
+        self._read_data_address()
+
+    def _read_signature(self):
+        self.signature = self.fileobj.read_struct_type("s", 4)
+        assert self.signature == "HEAP"
+
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+        assert self.version == 0
+
+    def _read_data_size(self):
+        superblock = self.get_root().parent
+        self.data_size = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+
+    def _read_freelist_offset(self):
+        superblock = self.get_root().parent
+        self.freelist_offset = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+
+    def _read_data_address(self):
+        superblock = self.get_root().parent
+        self.data_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def get_string(self, offset):
+        "Null terminated string at offset in the data segment, read a small piece at a time"
+        self.fileobj.seek(self.data_address + offset)
+        pieces = []
+        while True:
+            piece = self.fileobj.read_bytes(min(64, self.data_size - offset))
+            end = piece.find(b"\x00")
+            if end >= 0 or not piece:
+                pieces.append(piece[:end] if end >= 0 else piece)
+                break
+            pieces.append(piece)
+            offset += len(piece)
+        return b"".join(pieces)
+
+
+class _GlobalHeapCollection(_BaseObject):
+    "Collection of the objects that vlen elements point to, read all at once"
+
+    def read(self):
+        self.fileobj.seek(self.pos)
+
+        self._read_signature()
+        self._read_version()
+        self._read_reserved(3)
+        self._read_collection_size()
+        self._read_objects()
+
+    def _read_signature(self):
+        self.signature = self.fileobj.read_struct_type("s", 4)
+        assert self.signature == "GCOL"
+
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+        assert self.version == 1
+
+    def _read_collection_size(self):
+        "Size of the whole collection, including this header"
+        superblock = self.get_root().parent
+        self.collection_size = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+
+    def _read_objects(self):
+        superblock = self.get_root().parent
+        raw = self.fileobj.read_bytes(self.collection_size - (self.fileobj.tell() - self.pos))
+
+        self.objects = dict()
+        headersize = 8 + superblock.length_size
+        pos = 0
+        while pos + headersize <= len(raw):
+            index = struct.unpack("<H", raw[pos:pos+2])[0]
+            if index == 0:
+                # the free space object comes last
+                break
+            size = _unpack_int(raw[pos+8:pos+headersize])
+            start = pos + headersize
+            self.objects[index] = raw[start:start+size]
+            # objects are padded to multiples of 8 bytes
+            pos = start + (size + 7) // 8 * 8
+
+
+class _SharedMessageTable(_BaseObject):
+    "Indexes of the messages shared in the file, each keeping its messages in a fractal heap. Requires nindices"
+
+    def read(self):
+        self.fileobj.seek(self.pos)
+
+        self._read_signature()
+        self._read_indices()
+        self._read_checksum()
+
+    def _read_signature(self):
+        self.signature = self.fileobj.read_struct_type("s", 4)
+        assert self.signature == "SMTB"
+
+    def _read_indices(self):
+        superblock = self.get_root().parent
+        self.indices = []
+        for _ in range(self.nindices):
+            index = dict()
+            index["version"] = self.fileobj.read_struct_type("B", 1)
+            index["type"] = {0:"list", 1:"btree"}[self.fileobj.read_struct_type("B", 1)]
+            # the bit of each message type is its type number
+            flags = self.fileobj.read_struct_type("H", 1)
+            index["msgtypes"] = [msgtype for msgtype in range(16) if flags >> msgtype & 1]
+            index["minsize"] = self.fileobj.read_struct_type("I", 1)
+            index["listcutoff"] = self.fileobj.read_struct_type("H", 1)
+            index["btreecutoff"] = self.fileobj.read_struct_type("H", 1)
+            index["nmessages"] = self.fileobj.read_struct_type("H", 1)
+            index["address"] = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+            index["fractheap_address"] = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+            self.indices.append(index)
+
+    def get_message(self, msgtype, heapid):
+        "Reads a shared message from the fractal heap of the index for msgtype"
+        for index in self.indices:
+            if msgtype in index["msgtypes"]:
+                if "heap" not in index:
+                    self.fileobj.seek(index["fractheap_address"])
+                    index["heap"] = _FractalHeap(self, self.fileobj)
+                raw = index["heap"].get_object(heapid)
+                return _read_message(self, _FileWrap(io.BytesIO(raw)), msgtype)
+        raise Exception("No shared message index for message type %s" % msgtype)
+
+
+class _SymbolTableNode(_BaseObject):
+    "Leaf of a group btree, with the symbol table entries of up to 2K group members sorted by name"
+
+    def read(self):
+        self.fileobj.seek(self.pos)
+
+        self._read_signature()
+        self._read_version()
+        self._read_reserved(1)
+        self._read_nsymbols()
+        self._read_entries()
+
+    def _read_signature(self):
+        self.signature = self.fileobj.read_struct_type("s", 4)
+        assert self.signature == "SNOD"
+
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+        assert self.version == 1
+
+    def _read_nsymbols(self):
+        self.nsymbols = self.fileobj.read_struct_type("H", 1)
+
+    def _read_entries(self):
+        self.entries = [_SymbolTableEntry(self, self.fileobj) for _ in range(self.nsymbols)]
+
+
+class _SymbolTableEntry(_BaseObject):
+    "Link to a group member in older files, with the same name, linktype and link attributes as a link message"
+
+    def read(self):
+        self.fileobj.seek(self.pos)
+
+        self._read_name_offset()
+        self._read_header_address()
+        self._read_cache_type()
+        self._read_reserved(4)
+        self._read_scratchpad()
+
+    def __getattr__(self, name):
+        # hard links are followed lazily, like for link messages
+        if name == "link" and self.__dict__.get("linktype") == "hard":
+            self.link = _read_linked_header(self)
+            return self.link
+        raise AttributeError(name)
+
+    def _read_name_offset(self):
+        "Offset of the name in the local heap of the group"
+        superblock = self.get_root().parent
+        self.name_offset = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def _read_header_address(self):
+        superblock = self.get_root().parent
+        self.header_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+        self.address = superblock.base_address + self.header_address
+
+    def _read_cache_type(self):
+        self.cache_type = self.fileobj.read_struct_type("I", 1)
+        self.linktype = "soft" if self.cache_type == 2 else "hard"
+
+    def _read_scratchpad(self):
+        superblock = self.get_root().parent
+        start = self.fileobj.tell()
+        if self.cache_type == 1:
+            # group entries cache where to find the symbol table
+            self.btree_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+            self.heap_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+        elif self.cache_type == 2:
+            self.link_offset = self.fileobj.read_struct_type("I", 1)
+        self.fileobj.seek(start + 16)
+
+
+class _ObjectHeader(object):
+    def __init__(self, parent, fileobj=None, **kwargs):
+        "If root object, parent must be the superblock object, otherwise just a parent object"
+        self.parent = parent
+        
+        if fileobj:
+            self.fileobj = fileobj
+            self.read()
+        else:
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
+
+    def __str__(self):
+        from pprint import pformat
+        return "----- \n %r \n %s"%(self, pformat(self.__dict__, indent=4) )
+
+    def get_root(self):
+        obj = self
+        while hasattr(obj, "parent") and not isinstance(obj.parent, _SuperBlock):
+            obj = obj.parent
+
+        return obj
+    
+    def read(self):
+        if not hasattr(self, "fileobj"):
+            raise Exception("Must be initiated with a fileobj in order to call read()")
+
+        self.pos = self.fileobj.tell()
+        self._read_prefix()
+        self._read_messages()
+
+    def write(self, fileobj):
+        "Writes the messages list, given in the same format as when read, as a version 2 object header"
+        self.fileobj = fileobj
+        self.pos = fileobj.tell()
+        self.prefix = _ObjectHeaderPrefix(parent=self, version=2)
+        self.prefix.write(fileobj)
+
+    # internal
+
+    def _read_prefix(self):
+        self.prefix = _ObjectHeaderPrefix(parent=self, fileobj=self.fileobj)
+
+    def _read_messages(self):
+        self.messages = self.prefix._read_messages()
+
+    # messages, only the ones asked for are read
+
+    def has_message(self, msgtype):
+        return any(msg["msgtype"] == msgtype for msg in self.messages)
+
+    def get_message(self, msgtype):
+        "The first message of msgtype, or None"
+        for msg in self.messages:
+            if msg["msgtype"] == msgtype:
+                return msg["msgdata"]
+
+    def get_messages(self, msgtype):
+        return [msg["msgdata"] for msg in self.messages if msg["msgtype"] == msgtype]
+
+    # links
+
+    def iter_links(self):
+        """All links of a group, whether stored compactly as messages, densely in a fractal heap,
+        or as symbol table entries in older files"""
+        for msg in self.messages:
+            if msg["msgtype"] == 6:
+                yield msg["msgdata"]
+            elif msg["msgtype"] == 2 and msg["msgdata"].is_dense():
+                for link in msg["msgdata"].iter_links():
+                    yield link
+            elif msg["msgtype"] == 17:
+                for link in msg["msgdata"].iter_links():
+                    yield link
+
+    def get_link(self, name):
+        "Link with the given name, or None if there is no such link"
+        if not isinstance(name, unicode):
+            name = name.decode("utf8")
+        linkinfo = self.get_message(2)
+        if linkinfo is not None and linkinfo.is_dense():
+            return linkinfo.get_link(name)
+        symboltable = self.get_message(17)
+        if symboltable is not None:
+            return symboltable.get_link(name)
+        for msg in self.messages:
+            if msg["msgtype"] == 6 and msg["msgdata"].name == name:
+                return msg["msgdata"]
+
+    # attributes
+
+    def iter_attributes(self):
+        "All attributes, whether stored compactly as messages or densely in a fractal heap"
+        for msg in self.messages:
+            if msg["msgtype"] == 12:
+                yield msg["msgdata"]
+            elif msg["msgtype"] == 21 and msg["msgdata"].is_dense():
+                for attr in msg["msgdata"].iter_attributes():
+                    yield attr
+
+    def get_attribute(self, name):
+        "Attribute with the given name, or None if there is no such attribute"
+        if not isinstance(name, unicode):
+            name = name.decode("utf8")
+        attrinfo = self.get_message(21)
+        if attrinfo is not None and attrinfo.is_dense():
+            return attrinfo.get_attribute(name)
+        for msg in self.messages:
+            if msg["msgtype"] == 12 and msg["msgdata"].name == name:
+                return msg["msgdata"]
+
+
+class _ObjectData(object):
+    def __init__(self):
+        pass
+
+
+class _FreeSpace(object):
+    def __init__(self):
+        pass
+
+
+# object header components and message types
+# ...
+
+class _ObjectHeaderPrefix(object):
+    def __init__(self, parent, fileobj=None, **kwargs):
+        self.parent = parent
+        
+        if fileobj:
+            self.fileobj = fileobj
+            self.read()
+        else:
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
+
+    def __str__(self):
+        from pprint import pformat
+        return "----- \n %r \n %s"%(self, pformat(self.__dict__, indent=4) )
+
+    def get_root(self):
+        obj = self
+        while hasattr(obj, "parent") and not isinstance(obj.parent, _SuperBlock):
+            obj = obj.parent
+
+        return obj
+    
+    def read(self):
+        if not hasattr(self, "fileobj"):
+            raise Exception("Must be initiated with a fileobj in order to call read()")
+
+        self.pos = self.fileobj.tell()
+        self._read_version()
+
+        if self.version == 1:
+            self._read_reserved(1)
+            self._read_nmessages()
+            self._read_refcount()
+            self._read_chunk0size()
+
+            # messages start after padding to align on 8 bytes
+            self._read_reserved(4)
+            self._chunkstart = self.fileobj.tell()
+
+        elif self.version == 2:
+            self._read_flags()
+
+            if self.flags["storetimes"]:
+                self._read_accesstime()
+                self._read_modiftime()
+                self._read_changetime()
+                self._read_birthtime()
+
+            if self.flags["storenondefattrchange"]:
+                self._read_maxcompattr()
+                self._read_maxdensattr()
+
+            self._read_chunk0size()
+
+            # start of message headers (is not read automatically, has to be read via _read_messages())
+            self._chunkstart = self.fileobj.tell()
+
+            # skip the messages (the checksum comes right after chunk0)
+            self.fileobj.seek(self._chunkstart + self.chunk0size)
+            self._read_checksum()
+
+        # ...
+
+    def write(self, fileobj):
+        if self.version != 2:
+            raise NotImplementedError("Writing version %s of objectheader prefix not yet supported" % self.version)
+
+        # messages are encoded first, since the prefix needs to know their total size
+        self.fileobj = _FileWrap(io.BytesIO())
+        self._write_messages(self.parent.messages)
+        rawmessages = self.fileobj.getvalue()
+        self.chunk0size = len(rawmessages)
+
+        chunksizesize = 1
+        while self.chunk0size >= 256 ** chunksizesize:
+            chunksizesize *= 2
+        self.flags = dict(chunksizesize=chunksizesize,
+                          trackattrorder=0,
+                          indexattrorder=0,
+                          storenondefattrchange=0,
+                          storetimes=0,
+                          )
+
+        # the checksum covers everything from the signature onwards
+        self.fileobj = _FileWrap(io.BytesIO())
+        self._write_version()
+        self._write_flags()
+        self._write_chunk0size()
+        self.fileobj.write_bytes(rawmessages)
+        self._write_checksum()
+
+        fileobj.write_bytes(self.fileobj.getvalue())
+        self.fileobj = fileobj
+
+    def _write_version(self):
+        self.fileobj.write_bytes("OHDR")
+        self.fileobj.write_struct_type("B", 1, self.version)
+
+    def _write_flags(self):
+        sizecode = {1:0, 2:1, 4:2, 8:3}[self.flags["chunksizesize"]]
+        self.fileobj.write_bytes(_bitbytes(1, (0, sizecode),
+                                           (2, self.flags["trackattrorder"]),
+                                           (3, self.flags["indexattrorder"]),
+                                           (4, self.flags["storenondefattrchange"]),
+                                           (5, self.flags["storetimes"])))
+
+    def _write_chunk0size(self):
+        self.fileobj.write_unknown_nr(self.flags["chunksizesize"], 1, self.chunk0size)
+
+    def _write_messages(self, messages):
+        for msg in messages:
+            # msg data is encoded first to get its size
+            if msg["msgdata"] is None:
+                raw = b"\x00" * msg["msgdatasize"]
+            else:
+                buf = _FileWrap(io.BytesIO())
+                msg["msgdata"].write(buf)
+                raw = buf.getvalue()
+            msg["msgdatasize"] = len(raw)
+
+            self.fileobj.write_struct_type("B", 1, msg["msgtype"])
+            self.fileobj.write_struct_type("H", 1, msg["msgdatasize"])
+            self._write_msgflags(msg.get("msgflags", {}))
+            self.fileobj.write_bytes(raw)
+
+    def _write_msgflags(self, flags):
+        names = ["const", "sharestore", "noshare", "skipfail", "markfail", "violfail", "sharable", "alwaysfail"]
+        self.fileobj.write_bytes(_bitbytes(1, *[(i, flags.get(name, 0)) for i, name in enumerate(names)]))
+
+    def _write_checksum(self):
+        self.checksum = struct.pack("<I", _lookup3(self.fileobj.getvalue()))
+        self.fileobj.write_bytes(self.checksum)
+
+    def _read_version(self):
         # test for signature which is a sign of version 2
         self.fileobj.set_checkpoint()
         signa = self.fileobj.read_struct_type("s", 4)
 
-        if signa == "OHDR":
-            # v2
-            self.signature = signa
-            self.version = self.fileobj.read_struct_type("B", 1)
-            assert self.version == 2
+        if signa == "OHDR":
+            # v2
+            self.signature = signa
+            self.version = self.fileobj.read_struct_type("B", 1)
+            assert self.version == 2
+
+        else:
+            # v1
+            self.fileobj.return_to_checkpoint()
+            self.version = self.fileobj.read_struct_type("B", 1)
+            assert self.version == 1
+
+    def _read_flags(self):
+        # these are supposed to be 4 different bits that can be turned on or off
+        # TODO: how to extract that from the single byte and represent in Python?
+        # ...
+        raw = self.fileobj.read_bytes(1)
+        self.flags = dict(chunksizesize={0:1, 1:2, 2:4, 3:8}[_bitfield(raw,0,1)],
+                          trackattrorder=_bitflag(raw,2),
+                          indexattrorder=_bitflag(raw,3),
+                          storenondefattrchange=_bitflag(raw,4),
+                          storetimes=_bitflag(raw,5),
+                          )
+
+    def _read_accesstime(self):
+        secs = self.fileobj.read_struct_type("I", 1) # 32 bit unsigned int
+        self.accesstime = datetime.datetime.fromtimestamp(secs)
+
+    def _read_modiftime(self):
+        secs = self.fileobj.read_struct_type("I", 1) # 32 bit unsigned int
+        self.modiftime = datetime.datetime.fromtimestamp(secs)
+
+    def _read_changetime(self):
+        secs = self.fileobj.read_struct_type("I", 1) # 32 bit unsigned int
+        self.changetime = datetime.datetime.fromtimestamp(secs)
+
+    def _read_birthtime(self):
+        secs = self.fileobj.read_struct_type("I", 1) # 32 bit unsigned int
+        self.birthtime = datetime.datetime.fromtimestamp(secs)
+
+    def _read_maxcompattr(self):
+        self.maxcompattr = self.fileobj.read_struct_type("H", 1) # 2-byte nr
+
+    def _read_maxdensattr(self):
+        self.maxdensattr = self.fileobj.read_struct_type("H", 1) # 2-byte nr
+
+    def _read_chunk0size(self):
+        if self.version == 1:
+            self.chunk0size = self.fileobj.read_struct_type("I", 1)
+        else:
+            self.chunk0size = self.fileobj.read_unknown_nr(self.flags["chunksizesize"], 1)
+
+    def _read_reserved(self, n):
+        self.fileobj.read_bytes(n)
+
+    def _read_nmessages(self):
+        "Total nr of messages, across all chunks"
+        self.nmessages = self.fileobj.read_struct_type("H", 1)
+
+    def _read_refcount(self):
+        self.refcount = self.fileobj.read_struct_type("I", 1)
+
+    def _read_messages(self):
+        messages = list()
+        
+        # chunk0 and any continuation chunks, in version 2 the latter start with a signature and end with a checksum
+        chunks = [(self._chunkstart, self._chunkstart + self.chunk0size)]
+        if self.version == 1:
+            msgheadersize = 8
+        elif self.version == 2:
+            msgheadersize = 6 if self.flags["trackattrorder"] else 4
+
+        while chunks:
+            start, end = chunks.pop(0)
+            self.fileobj.seek(start)
+
+            # the end of a chunk may have a gap too small for another message
+            while end - self.fileobj.tell() >= msgheadersize:
+                msg = _MessageEntry(self)
+
+                if self.version == 1:
+                    # msg type
+                    msg["msgtype"] = self.fileobj.read_struct_type("H", 1) # 2-byte nr
+                    # msg data size, including padding to multiples of 8
+                    msg["msgdatasize"] = self.fileobj.read_struct_type("H", 1) # 2-byte nr
+                    # msg flags
+                    msg["msgflags"] = self._read_msgflags()
+                    self._read_reserved(3)
+
+                elif self.version == 2:
+                    # msg type
+                    msg["msgtype"] = self.fileobj.read_struct_type("B", 1) # 1-byte nr
+                    # msg data size
+                    msg["msgdatasize"] = self.fileobj.read_struct_type("H", 1) # 2-byte nr
+                    # msg flags
+                    msg["msgflags"] = self._read_msgflags()
+                    # msg creation order
+                    if self.flags["trackattrorder"]:
+                        msg["msgorder"] = self.fileobj.read_struct_type("H", 1) # 2-byte nr
+
+                # msg data is only read when first accessed
+                msg.msgdatapos = self.fileobj.tell()
+                self.fileobj.seek(msg.msgdatapos + msg["msgdatasize"])
+
+                if msg["msgtype"] == 16:
+                    cont = msg["msgdata"]
+                    if self.version == 1:
+                        chunks.append((cont.offset, cont.offset + cont.length))
+                    else:
+                        self.fileobj.seek(cont.offset)
+                        assert self.fileobj.read_struct_type("s", 4) == "OCHK"
+                        self.fileobj.seek(cont.offset + cont.length)
+                        _verify_lookup3(self.fileobj, cont.offset, "object header continuation")
+                        chunks.append((cont.offset + 4, cont.offset + cont.length - 4))
+                    self.fileobj.seek(msg.msgdatapos + msg["msgdatasize"])
+
+                messages.append(msg)
+
+        return messages
+
+    def _read_msgflags(self):
+        raw = self.fileobj.read_bytes(1)
+        return dict(const=_bitflag(raw, 0),
+                    sharestore=_bitflag(raw, 1),
+                    noshare=_bitflag(raw, 2),
+                    skipfail=_bitflag(raw, 3),
+                    markfail=_bitflag(raw, 4),
+                    violfail=_bitflag(raw, 5),
+                    sharable=_bitflag(raw, 6),
+                    alwaysfail=_bitflag(raw, 7),
+                    )
+
+    def _read_msgdata(self, msg):
+        cur = msg.msgdatapos
+        self.fileobj.seek(cur)
+        
+        if msg["msgflags"]["sharestore"]:
+            shared = _SharedMessage(parent=self, fileobj=self.fileobj)
+            data = shared.get_message(msg["msgtype"])
+
+        else:
+            data = _read_message(self, self.fileobj, msg["msgtype"])
+
+        self.fileobj.seek(cur + msg["msgdatasize"])
+
+        return data
+
+    def _read_checksum(self):
+        "Lookup3 checksum of the prefix and the messages in chunk0"
+        self.checksum = self.fileobj.read_struct_type("s",4)
+        _verify_lookup3(self.fileobj, self.pos, "object header")
+
+
+
+def _read_message(parent, fileobj, typ):
+    "Reads a message of type typ at the current position of fileobj"
+    if typ == 0:
+        # skip the nil msg
+        data = None
+    elif typ == 1:
+        data = _DataspaceMessage(parent=parent, fileobj=fileobj)
+    elif typ == 2:
+        data = _LinkInfoMessage(parent=parent, fileobj=fileobj)
+    elif typ == 3:
+        data = _DataTypeMessage(parent=parent, fileobj=fileobj)
+    elif typ == 5:
+        data = _FillValueMessage(parent=parent, fileobj=fileobj)
+    elif typ == 6:
+        data = _LinkMessage(parent=parent, fileobj=fileobj)
+    elif typ == 8:
+        data = _DataLayoutMessage(parent=parent, fileobj=fileobj)
+    elif typ == 10:
+        data = _GroupInfoMessage(parent=parent, fileobj=fileobj)
+    elif typ == 11:
+        data = _FilterPipelineMessage(parent=parent, fileobj=fileobj)
+    elif typ == 12:
+        data = _AttributeMessage(parent=parent, fileobj=fileobj)
+    elif typ == 15:
+        data = _SharedMessageTableMessage(parent=parent, fileobj=fileobj)
+    elif typ == 16: # hex is 10 but nr is 16
+        data = _HeaderContMessage(parent=parent, fileobj=fileobj)
+    elif typ == 17:
+        data = _SymbolTableMessage(parent=parent, fileobj=fileobj)
+    elif typ == 21:
+        data = _AttributeInfoMessage(parent=parent, fileobj=fileobj)
+    else:
+        data = "NOT YET SUPPORTED" #raise NotImplementedError("Message type %s not yet supported" % typ)
+    return data
+
+
+class _MessageEntry(dict):
+    """Dict of a message's header info, where the message itself is only read
+    the first time its "msgdata" item is accessed."""
+
+    def __init__(self, prefix):
+        dict.__init__(self)
+        self.prefix = prefix
+
+    def __missing__(self, key):
+        if key == "msgdata":
+            fileobj = self.prefix.fileobj
+            pos = fileobj.tell()
+            self["msgdata"] = self.prefix._read_msgdata(self)
+            fileobj.seek(pos)
+            return self["msgdata"]
+        raise KeyError(key)
+
+
+
+class _SharedMessage(object):
+    def __init__(self, parent, fileobj=None, **kwargs):
+        self.parent = parent
+        
+        if fileobj:
+            self.fileobj = fileobj
+            self.read()
+        else:
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
+
+    def __str__(self):
+        from pprint import pformat
+        return "----- \n %r \n %s"%(self, pformat(self.__dict__, indent=4) )
+
+    def get_root(self):
+        obj = self
+        while hasattr(obj, "parent") and not isinstance(obj.parent, _SuperBlock):
+            obj = obj.parent
+
+        return obj
+
+    def read(self):
+        if not hasattr(self, "fileobj"):
+            raise Exception("Must be initiated with a fileobj in order to call read()")
+
+        self._read_version()
+
+        if self.version == 1:
+            self._read_type()
+            self._read_reserved(2)
+
+            self._read_reserved(4)
+
+            self._read_address()
+
+        elif self.version == 2:
+            self._read_type()
+            self._read_address()
+
+        elif self.version == 3:
+            self._read_type()
+            self._read_location()
+
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+
+    def _read_type(self):
+        self.type = self.fileobj.read_struct_type("B", 1)
+
+    def _read_reserved(self, n):
+        self.fileobj.read_bytes(n)
+
+    def _read_address(self):
+        "Address of the object header containing the message"
+        superblock = self.get_root().parent
+        self.address = superblock.base_address + self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def _read_location(self):
+        if self.type == 1: # in shared heap
+            self.heapid = self.fileobj.read_bytes(8)
+        else:
+            self._read_address()
+
+    def get_message(self, msgtype):
+        "The shared message of msgtype, cached by the file"
+        superblock = self.get_root().parent
+        if self.version == 3 and self.type == 1:
+            return superblock.get_shared_message(msgtype, heapid=self.heapid)
+        return superblock.get_shared_message(msgtype, address=self.address)
+
+
+class _SharedMessageTableMessage(object):
+    def __init__(self, parent, fileobj=None, **kwargs):
+        self.parent = parent
+        
+        if fileobj:
+            self.fileobj = fileobj
+            self.read()
+        else:
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
+
+    def __str__(self):
+        from pprint import pformat
+        return "----- \n %r \n %s"%(self, pformat(self.__dict__, indent=4) )
+
+    def get_root(self):
+        obj = self
+        while hasattr(obj, "parent") and not isinstance(obj.parent, _SuperBlock):
+            obj = obj.parent
+
+        return obj
+
+    def read(self):
+        if not hasattr(self, "fileobj"):
+            raise Exception("Must be initiated with a fileobj in order to call read()")
+
+        self._read_version()
+        self._read_table_address()
+        self._read_nindices()
+
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+        assert self.version == 0
+
+    def _read_table_address(self):
+        superblock = self.get_root().parent
+        self.table_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def _read_nindices(self):
+        self.nindices = self.fileobj.read_struct_type("B", 1)
+
+                       
+
+
+
+
+class _DataspaceMessage(object):
+    def __init__(self, parent, fileobj=None, **kwargs):
+        self.parent = parent
+        
+        if fileobj:
+            self.fileobj = fileobj
+            self.read()
+        else:
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
+
+    def __str__(self):
+        from pprint import pformat
+        return "----- \n %r \n %s"%(self, pformat(self.__dict__, indent=4) )
+
+    def get_root(self):
+        obj = self
+        while hasattr(obj, "parent") and not isinstance(obj.parent, _SuperBlock):
+            obj = obj.parent
+
+        return obj
+
+    def read(self):
+        if not hasattr(self, "fileobj"):
+            raise Exception("Must be initiated with a fileobj in order to call read()")
+
+        self._read_version()
+        
+        if self.version == 1:
+            self._read_dimensionality()
+            self._read_flags()
+            self._read_reserved(1)
+
+            self._read_reserved(4)
+
+            self.dimsizes = [self._read_dimension_size() for _ in range(self.dimensionality)]
+
+            if self.flags["maxdims"]:
+                self.maxdimsizes = [self._read_maxdim_size() for _ in range(self.dimensionality)]
+            if self.flags["permutindic"]:
+                self.permutindices = [self._read_permutation_index() for _ in range(self.dimensionality)]
+
+        elif self.version == 2:
+            self._read_dimensionality()
+            self._read_flags()
+            self._read_type()
+
+            self.dimsizes = [self._read_dimension_size() for _ in range(self.dimensionality)]
+
+            if self.flags["maxdims"]:
+                self.maxdimsizes = [self._read_maxdim_size() for _ in range(self.dimensionality)]
+            
+    def write(self, fileobj):
+        self.fileobj = fileobj
+
+        if self.version == 2:
+            self._write_version()
+            self._write_dimensionality()
+            self._write_flags()
+            self._write_type()
+
+            for size in self.dimsizes:
+                self._write_dimension_size(size)
+
+            if self.flags["maxdims"]:
+                for size in self.maxdimsizes:
+                    self._write_dimension_size(size)
+
+        else:
+            raise NotImplementedError("Writing dataspace version %s not yet supported" % self.version)
+
+    def _write_version(self):
+        self.fileobj.write_struct_type("B", 1, self.version)
+
+    def _write_dimensionality(self):
+        self.fileobj.write_struct_type("B", 1, self.dimensionality)
+
+    def _write_flags(self):
+        self.fileobj.write_bytes(_bitbytes(1, (0, self.flags["maxdims"]),
+                                           (1, self.flags.get("permutindic", 0))))
+
+    def _write_type(self):
+        self.fileobj.write_struct_type("B", 1, self.type)
+
+    def _write_dimension_size(self, size):
+        superblock = self.get_root().parent
+        self.fileobj.write_unknown_nr(superblock.length_size, 1, size)
+
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1) # 1-byte nr
+
+    def _read_dimensionality(self):
+        self.dimensionality = self.fileobj.read_struct_type("B", 1) # 1-byte nr
+
+    def _read_flags(self):
+        raw = self.fileobj.read_bytes(1)
+        self.flags = dict(maxdims=_bitflag(raw, 0),
+                          permutindic=_bitflag(raw, 1))
+
+    def _read_reserved(self, n):
+        # skip a single reserved byte
+        self.fileobj.read_bytes(n)
+
+    def _read_dimension_size(self):
+        superblock = self.get_root().parent
+        return self.fileobj.read_unknown_nr(superblock.length_size, 1) 
+
+    def _read_maxdim_size(self):
+        superblock = self.get_root().parent
+        return self.fileobj.read_unknown_nr(superblock.length_size, 1)
+
+    def _read_permutation_index(self):
+        superblock = self.get_root().parent
+        return self.fileobj.read_unknown_nr(superblock.length_size, 1)
+
+    def _read_type(self):
+        self.type = self.fileobj.read_struct_type("B", 1)
+
+
+class _LinkInfoMessage(object):
+    def __init__(self, parent, fileobj=None, **kwargs):
+        self.parent = parent
+        
+        if fileobj:
+            self.fileobj = fileobj
+            self.read()
+        else:
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
+
+    def __str__(self):
+        from pprint import pformat
+        return "----- \n %r \n %s"%(self, pformat(self.__dict__, indent=4) )
+
+    def get_root(self):
+        obj = self
+        while hasattr(obj, "parent") and not isinstance(obj.parent, _SuperBlock):
+            obj = obj.parent
+
+        return obj
+
+    def read(self):
+        if not hasattr(self, "fileobj"):
+            raise Exception("Must be initiated with a fileobj in order to call read()")
+
+        self._read_version()
+        
+        if self.version == 0:
+            self._read_flags()
+            
+            if self.flags["trackorder"]:
+                self._read_maxorderindex()
+
+            self._read_fractheap_address()
+            self._read_nameindex_v2btree_address()
+
+            if self.flags["indexorder"]:
+                self._read_orderindex_v2btree_address()
+
+        else:
+            raise Exception("This version does not exist")
+            
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+
+    def _read_flags(self):
+        raw = self.fileobj.read_bytes(1)
+        self.flags = dict(trackorder=_bitflag(raw, 0),
+                          indexorder=_bitflag(raw, 1))
+
+    def _read_maxorderindex(self):
+        self.maxorderindex = self.fileobj.read_struct_type("Q", 1) # 64-bit int
+
+    def _read_fractheap_address(self):
+        superblock = self.get_root().parent
+        self.fractheap_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def _read_nameindex_v2btree_address(self):
+        superblock = self.get_root().parent
+        self.nameindex_v2btree_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def _read_orderindex_v2btree_address(self):
+        superblock = self.get_root().parent
+        self.orderindex_v2btree_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
 
+    # dense link storage
+
+    def is_dense(self):
+        "Whether links are stored in a fractal heap, instead of as link messages in the object header"
+        return self.fractheap_address != UNDEFINED
+
+    def get_fractal_heap(self):
+        if not hasattr(self, "_fractheap"):
+            self.fileobj.seek(self.fractheap_address)
+            self._fractheap = _FractalHeap(self, self.fileobj)
+        return self._fractheap
+
+    def get_name_index(self):
+        if not hasattr(self, "_nameindex"):
+            self.fileobj.seek(self.nameindex_v2btree_address)
+            self._nameindex = _v2BTreeHeader(self, self.fileobj)
+        return self._nameindex
+
+    def iter_links(self):
+        "All densely stored links, in creation order if indexed, otherwise in name hash order"
+        if self.flags["indexorder"]:
+            self.fileobj.seek(self.orderindex_v2btree_address)
+            index = _v2BTreeHeader(self, self.fileobj)
         else:
-            # v1
-            self.fileobj.return_to_checkpoint()
-            self.version = self.fileobj.read_struct_type("B", 1)
-            assert self.version == 1
+            index = self.get_name_index()
+        for record in index.iter_records():
+            yield self._read_heap_link(record["heapid"])
+
+    def get_link(self, name):
+        "Looks up a densely stored link by searching the name index for the hash of the name"
+        if not isinstance(name, unicode):
+            name = name.decode("utf8")
+        namehash = _lookup3(name.encode("utf8"))
+        for record in self.get_name_index().find(lambda record: cmp(namehash, record["hash"])):
+            # different names may have the same hash
+            link = self._read_heap_link(record["heapid"])
+            if link.name == name:
+                return link
+
+    def _read_heap_link(self, heapid):
+        raw = self.get_fractal_heap().get_object(heapid)
+        return _LinkMessage(parent=self, fileobj=_FileWrap(io.BytesIO(raw)))
+
+    def write(self, fileobj):
+        self.fileobj = fileobj
 
-    def _read_flags(self):
-        # these are supposed to be 4 different bits that can be turned on or off
-        # TODO: how to extract that from the single byte and represent in Python?
-        # ...
-        raw = self.fileobj.read_bytes(1)
-        self.flags = dict(chunksizesize={0:1, 1:2, 2:4, 3:8}[_bitfield(raw,0,1)],
-                          trackattrorder=_bitflag(raw,2),
-                          indexattrorder=_bitflag(raw,3),
-                          storenondefattrchange=_bitflag(raw,4),
-                          storetimes=_bitflag(raw,5),
-                          )
+        if self.version == 0:
+            self.fileobj.write_struct_type("B", 1, self.version)
+            self.fileobj.write_bytes(_bitbytes(1, (0, self.flags["trackorder"]),
+                                               (1, self.flags["indexorder"])))
 
-    def _read_accesstime(self):
-        secs = self.fileobj.read_struct_type("I", 1) # 32 bit unsigned int
-        self.accesstime = datetime.datetime.fromtimestamp(secs)
+            superblock = self.get_root().parent
+            if self.flags["trackorder"]:
+                self.fileobj.write_struct_type("Q", 1, self.maxorderindex)
+            self.fileobj.write_unknown_nr(superblock.offset_size, 1, self.fractheap_address)
+            self.fileobj.write_unknown_nr(superblock.offset_size, 1, self.nameindex_v2btree_address)
+            if self.flags["indexorder"]:
+                self.fileobj.write_unknown_nr(superblock.offset_size, 1, self.orderindex_v2btree_address)
 
-    def _read_modiftime(self):
-        secs = self.fileobj.read_struct_type("I", 1) # 32 bit unsigned int
-        self.modiftime = datetime.datetime.fromtimestamp(secs)
+        else:
+            raise Exception("This version does not exist")
 
-    def _read_changetime(self):
-        secs = self.fileobj.read_struct_type("I", 1) # 32 bit unsigned int
-        self.changetime = datetime.datetime.fromtimestamp(secs)
 
-    def _read_birthtime(self):
-        secs = self.fileobj.read_struct_type("I", 1) # 32 bit unsigned int
-        self.birthtime = datetime.datetime.fromtimestamp(secs)
+class _GroupInfoMessage(object):
+    def __init__(self, parent, fileobj=None, **kwargs):
+        self.parent = parent
+        
+        if fileobj:
+            self.fileobj = fileobj
+            self.read()
+        else:
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
-    def _read_maxcompattr(self):
-        self.maxcompattr = self.fileobj.read_struct_type("H", 1) # 2-byte nr
+    def __str__(self):
+        from pprint import pformat
+        return "----- \n %r \n %s"%(self, pformat(self.__dict__, indent=4) )
 
-    def _read_maxdensattr(self):
-        self.maxdensattr = self.fileobj.read_struct_type("H", 1) # 2-byte nr
+    def get_root(self):
+        obj = self
+        while hasattr(obj, "parent") and not isinstance(obj.parent, _SuperBlock):
+            obj = obj.parent
 
-    def _read_chunk0size(self):
-        self.chunk0size = self.fileobj.read_unknown_nr(self.flags["chunksizesize"], 1)
+        return obj
 
-    def _read_messages(self):
-        messages = list()
-        
-        if self.version == 1:
-            raise NotImplementedError("Reading messages from object header prefix version 1 not yet implemented")
+    def read(self):
+        if not hasattr(self, "fileobj"):
+            raise Exception("Must be initiated with a fileobj in order to call read()")
 
-        elif self.version == 2:
-            self.fileobj.seek(self._chunkstart)
+        self._read_version()
+        
+        if self.version == 0:
+            self._read_flags()
             
-            while (self.fileobj.tell() - self._chunkstart) < self.chunk0size:
-                msg = dict()
-                # msg type
-                msg["msgtype"] = self.fileobj.read_struct_type("B", 1) # 1-byte nr
-                # msg data size
-                msg["msgdatasize"] = self.fileobj.read_struct_type("H", 1) # 2-byte nr
-                # msg flags
-                msg["msgflags"] = self._read_msgflags()
-                # msg creation order
-                if self.flags["trackattrorder"]:
-                    msg["msgorder"] = self.fileobj.read_struct_type("H", 1) # 2-byte nr
-                # msg data
-                msg["msgdata"] = self._read_msgdata(msg)
+            if self.flags["phasechange"]:
+                self._read_maxcompact()
+                self._read_mindense()
 
-                messages.append(msg)
+            if self.flags["estimates"]:
+                self._read_estnumentries()
+                self._read_estnamelength()
 
-        return messages
+        else:
+            raise Exception("This version does not exist")
 
-    def _read_msgflags(self):
+    def write(self, fileobj):
+        self.fileobj = fileobj
+
+        if self.version == 0:
+            self.fileobj.write_struct_type("B", 1, self.version)
+            self.fileobj.write_bytes(_bitbytes(1, (0, self.flags["phasechange"]),
+                                               (1, self.flags["estimates"])))
+
+            if self.flags["phasechange"]:
+                self.fileobj.write_struct_type("H", 2, (self.maxcompact, self.mindense))
+
+            if self.flags["estimates"]:
+                self.fileobj.write_struct_type("H", 2, (self.estnumentries, self.estnamelength))
+
+        else:
+            raise Exception("This version does not exist")
+            
+    def _read_version(self):
+        self.version = self.fileobj.read_struct_type("B", 1)
+
+    def _read_flags(self):
         raw = self.fileobj.read_bytes(1)
-        return dict(const=_bitflag(raw, 0),
-                    sharestore=_bitflag(raw, 1),
-                    noshare=_bitflag(raw, 2),
-                    skipfail=_bitflag(raw, 3),
-                    markfail=_bitflag(raw, 4),
-                    violfail=_bitflag(raw, 5),
-                    sharable=_bitflag(raw, 6),
-                    alwaysfail=_bitflag(raw, 7),
-                    )
+        self.flags = dict(phasechange=_bitflag(raw, 0),
+                          estimates=_bitflag(raw, 1))
 
-    def _read_msgdata(self, msg):
-        cur = self.fileobj.tell()
+    def _read_maxcompact(self):
+        "Maximum number of links to store compactly in the object header"
+        self.maxcompact = self.fileobj.read_struct_type("H", 1)
+
+    def _read_mindense(self):
+        "Minimum number of links to store densely in a fractal heap"
+        self.mindense = self.fileobj.read_struct_type("H", 1)
+
+    def _read_estnumentries(self):
+        self.estnumentries = self.fileobj.read_struct_type("H", 1)
+
+    def _read_estnamelength(self):
+        self.estnamelength = self.fileobj.read_struct_type("H", 1)
+
+
+class _SymbolTableMessage(object):
+    def __init__(self, parent, fileobj=None, **kwargs):
+        self.parent = parent
         
-        if msg["msgflags"]["sharestore"]:
-            data = _SharedMessage(parent=self, fileobj=self.fileobj)
-
-        else:
-            typ = msg["msgtype"]
-            if typ == 0:
-                # skip the nil msg
-                data = None
-            elif typ == 1:
-                data = _DataspaceMessage(parent=self, fileobj=self.fileobj)
-            elif typ == 2:
-                data = _LinkInfoMessage(parent=self, fileobj=self.fileobj)
-            elif typ == 3:
-                data = _DataTypeMessage(parent=self, fileobj=self.fileobj)
-            elif typ == 5:
-                data = _FillValueMessage(parent=self, fileobj=self.fileobj)
-            elif typ == 6:
-                data = _LinkMessage(parent=self, fileobj=self.fileobj)
-            elif typ == 8:
-                data = _DataLayoutMessage(parent=self, fileobj=self.fileobj)
-            elif typ == 11:
-                data = _FilterPipelineMessage(parent=self, fileobj=self.fileobj)
-            elif typ == 16: # hex is 10 but nr is 16
-                data = _HeaderContMessage(parent=self, fileobj=self.fileobj)
-            # add next: 12 attrib, 21 attribute info, 11 filterpipeline, 10 groupinfo
-            # ...
-            else:
-                data = "NOT YET SUPPORTED" #raise NotImplementedError("Message type %s not yet supported" % typ)
+        if fileobj:
+            self.fileobj = fileobj
+            self.read()
+        else:
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
-        self.fileobj.seek(cur + msg["msgdatasize"])
+    def __str__(self):
+        from pprint import pformat
+        return "----- \n %r \n %s"%(self, pformat(self.__dict__, indent=4) )
 
-        return data
+    def get_root(self):
+        obj = self
+        while hasattr(obj, "parent") and not isinstance(obj.parent, _SuperBlock):
+            obj = obj.parent
 
-    def _read_checksum(self):
-        # TODO: Not sure how to parse checksum...
-        self.checksum = self.fileobj.read_struct_type("s",4)
+        return obj
+
+    def read(self):
+        if not hasattr(self, "fileobj"):
+            raise Exception("Must be initiated with a fileobj in order to call read()")
 
+        self._read_btree_address()
+        self._read_heap_address()
 
+    def _read_btree_address(self):
+        superblock = self.get_root().parent
+        self.btree_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
 
-class _SharedMessage(object):
-    def __init__(self, parent, fileobj=None):
+    def _read_heap_address(self):
+        superblock = self.get_root().parent
+        self.heap_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    # group members
+
+    def get_heap(self):
+        if not hasattr(self, "_heap"):
+            self.fileobj.seek(self.heap_address)
+            self._heap = _LocalHeap(self, self.fileobj)
+        return self._heap
+
+    def iter_links(self):
+        "All symbol table entries, sorted by name"
+        for node in self._iter_symbol_nodes(self.btree_address):
+            for entry in node.entries:
+                yield self._named_entry(entry)
+
+    def _iter_symbol_nodes(self, address):
+        self.fileobj.seek(address)
+        node = _v1BTreeNode(self, self.fileobj)
+        for key, child, nextkey in list(node.children()):
+            if node.node_level == 0:
+                self.fileobj.seek(child)
+                yield _SymbolTableNode(self, self.fileobj)
+            else:
+                for subnode in self._iter_symbol_nodes(child):
+                    yield subnode
+
+    def get_link(self, name):
+        """Binary searches the btree keys and then the symbol table node entries for name,
+        so only a few names need to be read from the heap."""
+        if isinstance(name, unicode):
+            name = name.encode("utf8")
+        heap = self.get_heap()
+
+        address = self.btree_address
+        while True:
+            self.fileobj.seek(address)
+            node = _v1BTreeNode(self, self.fileobj)
+            children = list(node.children())
+
+            # child i holds the names after key i, up to and including key i+1
+            low, high = 0, len(children)
+            while low < high:
+                mid = (low + high) // 2
+                if name > heap.get_string(children[mid][2]["offset"]):
+                    low = mid + 1
+                else:
+                    high = mid
+            if low == len(children):
+                return None
+
+            address = children[low][1]
+            if node.node_level == 0:
+                break
+
+        self.fileobj.seek(address)
+        symbolnode = _SymbolTableNode(self, self.fileobj)
+        entries = symbolnode.entries
+        low, high = 0, len(entries)
+        while low < high:
+            mid = (low + high) // 2
+            if name > heap.get_string(entries[mid].name_offset):
+                low = mid + 1
+            else:
+                high = mid
+        if low < len(entries) and heap.get_string(entries[low].name_offset) == name:
+            return self._named_entry(entries[low])
+
+    def _named_entry(self, entry):
+        heap = self.get_heap()
+        entry.name = heap.get_string(entry.name_offset).decode("utf8")
+        if entry.linktype == "soft":
+            entry.link = heap.get_string(entry.link_offset)
+        return entry
+
+
+class _LinkMessage(object):
+    def __init__(self, parent, fileobj=None, **kwargs):
         self.parent = parent
         
         if fileobj:
             self.fileobj = fileobj
             self.read()
         else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
     def __str__(self):
         from pprint import pformat
@@ -828,58 +4201,123 @@ class _SharedMessage(object):
             raise Exception("Must be initiated with a fileobj in order to call read()")
 
         self._read_version()
-
+        
         if self.version == 1:
-            self._read_type()
-            self._read_reserved(2)
+            self._read_flags()
 
-            self._read_reserved(4)
+            if self.flags["linktype"]:
+                self._read_linktype()
+            else:
+                self.linktype = "hard"
 
-            self._read_address()
+            if self.flags["creationorder"]:
+                self._read_creationorder()
 
-        elif self.version == 2:
-            self._read_type()
-            self._read_address()
+            if self.flags["namecharset"]:
+                self._read_namecharset()
+            else:
+                self.namecharset = "ascii"
 
-        elif self.version == 3:
-            self._read_type()
-            self._read_location()
+            self._read_namelength()
+            self._read_name()
+
+            self._read_link()
+
+        else:
+            raise Exception("This version does not exist")
+            
+    def __getattr__(self, name):
+        # hard links are followed lazily, since this might go down a rabbithole of nested objects...
+        if name == "link" and self.__dict__.get("linktype") == "hard":
+            self.link = _read_linked_header(self)
+            return self.link
+        raise AttributeError(name)
 
     def _read_version(self):
         self.version = self.fileobj.read_struct_type("B", 1)
 
-    def _read_type(self):
-        self.type = self.fileobj.read_struct_type("B", 1)
+    def _read_flags(self):
+        raw = self.fileobj.read_bytes(1)
+        self.flags = dict(namelengthsize={0:1, 1:2, 2:4, 3:8}[_bitfield(raw, 0, 1)],
+                          creationorder=_bitflag(raw, 2),
+                          linktype=_bitflag(raw, 3),
+                          namecharset=_bitflag(raw, 4),
+                          )
 
-    def _read_reserved(self, n):
-        self.fileobj.read_bytes(n)
+    def _read_linktype(self):
+        # TODO: allow userdefined linktypes, 65-255
+        val = self.fileobj.read_struct_type("B", 1)
+        self.linktype = {0:"hard", 1:"soft", 64:"external"}[val]
 
-    def _read_address(self):
-        superblock = self.get_root().parent
-        self.address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+    def _read_creationorder(self):
+        self.creationorder = self.fileobj.read_struct_type("Q", 1)
 
-    def _read_location(self):
-        if self.type == 1: # in shared heap
-            self.location = self.fileobj.read_struct_type("Q", 1) # 8-byte int
-        else:
+    def _read_namecharset(self):
+        val = self.fileobj.read_struct_type("B", 1)
+        self.namecharset = {0:"ascii", 1:"utf8"}[val]
+
+    def _read_namelength(self):
+        self.namelength = self.fileobj.read_unknown_nr(self.flags["namelengthsize"], 1)
+
+    def _read_name(self):
+        self.name = self.fileobj.read_struct_type("s", self.namelength).decode(self.namecharset)
+
+    def _read_link(self):
+        if self.linktype == "hard":
+            # the linked object header is only read when the link attribute is first accessed
             superblock = self.get_root().parent
-            self.location = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+            offset = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+            self.address = superblock.base_address + offset
+            
+        elif self.linktype == "soft":
+            length = self.fileobj.read_struct_type("H", 1) # 2-byte nr
+            self.link = self.fileobj.read_struct_type("s", length)
 
-                       
+        elif self.linktype == "external":
+            #length = self.fileobj.read_struct_type("H", 1) # 2-byte nr
+            raise NotImplementedError("External link types not yet supported")
+
+    def write(self, fileobj):
+        "Writes a hard link, where link is an object header that has already been written"
+        self.fileobj = fileobj
+
+        if self.version == 1:
+            rawname = self.name.encode(self.namecharset)
+            self.namelength = len(rawname)
+            namelengthsize = 1
+            while self.namelength >= 256 ** namelengthsize:
+                namelengthsize *= 2
+
+            charset = {"ascii":0, "utf8":1}[self.namecharset]
+            self.fileobj.write_struct_type("B", 1, self.version)
+            self.fileobj.write_bytes(_bitbytes(1, (0, {1:0, 2:1, 4:2, 8:3}[namelengthsize]),
+                                               (4, charset)))
+            if charset:
+                self.fileobj.write_struct_type("B", 1, charset)
+            self.fileobj.write_unknown_nr(namelengthsize, 1, self.namelength)
+            self.fileobj.write_bytes(rawname)
+
+            if self.linktype == "hard":
+                superblock = self.get_root().parent
+                self.fileobj.write_unknown_nr(superblock.offset_size, 1, self.link.pos - superblock.base_address)
+            else:
+                raise NotImplementedError("Writing %s links not yet supported" % self.linktype)
 
+        else:
+            raise Exception("This version does not exist")
 
 
 
-class _DataspaceMessage(object):
-    def __init__(self, parent, fileobj=None):
+class _AttributeMessage(object):
+    def __init__(self, parent, fileobj=None, **kwargs):
         self.parent = parent
         
         if fileobj:
             self.fileobj = fileobj
             self.read()
         else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
     def __str__(self):
         from pprint import pformat
@@ -893,76 +4331,124 @@ class _DataspaceMessage(object):
         return obj
 
     def read(self):
+        "Reads the name, datatype and dataspace, but only remembers where the value is"
         if not hasattr(self, "fileobj"):
             raise Exception("Must be initiated with a fileobj in order to call read()")
 
         self._read_version()
-        
+
         if self.version == 1:
-            self._read_dimensionality()
-            self._read_flags()
             self._read_reserved(1)
+        else:
+            self._read_flags()
 
-            self._read_reserved(4)
+        self._read_name_size()
+        self._read_datatype_size()
+        self._read_dataspace_size()
 
-            self.dimsizes = (self._read_dimension_size() for _ in range(self.dimensionality))
+        if self.version == 3:
+            self._read_encoding()
+        else:
+            self.encoding = "ascii"
 
-            if self.flags["maxdims"]:
-                self.maxdimsizes = [self._read_maxdim_size() for _ in range(self.dimensionality)]
-            if self.flags["permutindices"]:
-                self.permutindices = [self._read_permuation_index() for _ in range(self.dimensionality)]
+        self._read_name()
+        self._read_datatype()
+        self._read_dataspace()
 
-        elif self.version == 2:
-            self._read_dimensionality()
-            self._read_flags()
-            self._read_type()
+        # the value follows right after
+        self.data_address = self.fileobj.tell()
 
-            self.dimsizes = [self._read_dimension_size() for _ in range(self.dimensionality)]
+    def _padded(self, size):
+        # version 1 pads the name, datatype and dataspace to multiples of 8 bytes
+        if self.version == 1:
+            return (size + 7) // 8 * 8
+        return size
 
-            if self.flags["maxdims"]:
-                self.maxdimsizes = [self._read_maxdim_size() for _ in range(self.dimensionality)]
-            
     def _read_version(self):
-        self.version = self.fileobj.read_struct_type("B", 1) # 1-byte nr
+        self.version = self.fileobj.read_struct_type("B", 1)
+        assert 1 <= self.version <= 3
 
-    def _read_dimensionality(self):
-        self.dimensionality = self.fileobj.read_struct_type("B", 1) # 1-byte nr
+    def _read_reserved(self, n):
+        self.fileobj.read_bytes(n)
 
     def _read_flags(self):
         raw = self.fileobj.read_bytes(1)
-        self.flags = dict(maxdims=_bitflag(raw, 0),
-                          permutindic=_bitflag(raw, 1))
+        self.flags = dict(shareddatatype=_bitflag(raw, 0),
+                          shareddataspace=_bitflag(raw, 1))
+
+    def _read_name_size(self):
+        self.name_size = self.fileobj.read_struct_type("H", 1)
+
+    def _read_datatype_size(self):
+        self.datatype_size = self.fileobj.read_struct_type("H", 1)
 
-    def _read_reserved(self, n):
-        # skip a single reserved byte
-        self.fileobj.read_bytes(n)
+    def _read_dataspace_size(self):
+        self.dataspace_size = self.fileobj.read_struct_type("H", 1)
 
-    def _read_dimension_size(self):
-        superblock = self.get_root().parent
-        return self.fileobj.read_unknown_nr(superblock.length_size, 1) 
+    def _read_encoding(self):
+        val = self.fileobj.read_struct_type("B", 1)
+        self.encoding = {0:"ascii", 1:"utf8"}[val]
 
-    def _read_maxdim_size(self):
-        superblock = self.get_root().parent
-        return self.fileobj.read_unknown_nr(superblock.length_size, 1)
+    def _read_name(self):
+        raw = self.fileobj.read_bytes(self._padded(self.name_size))
+        self.name = raw[:self.name_size].rstrip(b"\x00").decode(self.encoding)
 
-    def _read_permutation_index(self):
-        superblock = self.get_root().parent
-        return self.fileobj.read_unknown_nr(superblock.length_size, 1)
+    def _read_datatype(self):
+        start = self.fileobj.tell()
+        if self.version > 1 and self.flags["shareddatatype"]:
+            self.datatype = _SharedMessage(parent=self, fileobj=self.fileobj).get_message(3)
+        else:
+            self.datatype = _DataTypeMessage(parent=self, fileobj=self.fileobj)
+        self.fileobj.seek(start + self._padded(self.datatype_size))
 
-    def _read_type(self):
-        self.type = self.fileobj.read_struct_type("B", 1)
+    def _read_dataspace(self):
+        start = self.fileobj.tell()
+        if self.version > 1 and self.flags["shareddataspace"]:
+            self.dataspace = _SharedMessage(parent=self, fileobj=self.fileobj).get_message(1)
+        else:
+            self.dataspace = _DataspaceMessage(parent=self, fileobj=self.fileobj)
+        self.fileobj.seek(start + self._padded(self.dataspace_size))
+
+    @property
+    def shape(self):
+        "Shape of the value, or None for an attribute without a value"
+        if self.dataspace.version == 2 and self.dataspace.type == 2:
+            return None
+        return tuple(self.dataspace.dimsizes)
+
+    def read_value(self):
+        "Reads the value, as a numpy array (or scalar) if numpy is available, otherwise as a list (or single value)"
+        shape = self.shape
+        if shape is None:
+            return None
+
+        count = _product(shape)
+        self.fileobj.seek(self.data_address)
+        raw = self.fileobj.read_bytes(count * self.datatype.size)
+
+        if np is not None:
+            values = self.datatype.decode(raw)
+            values = values.reshape(shape + values.shape[1:])
+            return values[()] if not shape else values
+
+        if self.datatype.classtype == "string":
+            size = self.datatype.size
+            values = [raw[i:i+size].rstrip(b"\x00") for i in range(0, len(raw), size)]
+        else:
+            values = list(self.datatype.decode(raw))
+        return values[0] if not shape else values
 
 
-class _LinkInfoMessage(object):
-    def __init__(self, parent, fileobj=None):
+class _AttributeInfoMessage(object):
+    def __init__(self, parent, fileobj=None, **kwargs):
         self.parent = parent
         
         if fileobj:
             self.fileobj = fileobj
             self.read()
         else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
     def __str__(self):
         from pprint import pformat
@@ -1005,7 +4491,7 @@ class _LinkInfoMessage(object):
                           indexorder=_bitflag(raw, 1))
 
     def _read_maxorderindex(self):
-        self.maxorderindex = self.fileobj.read_struct_type("Q", 1) # 64-bit int
+        self.maxorderindex = self.fileobj.read_struct_type("H", 1)
 
     def _read_fractheap_address(self):
         superblock = self.get_root().parent
@@ -1019,120 +4505,64 @@ class _LinkInfoMessage(object):
         superblock = self.get_root().parent
         self.orderindex_v2btree_address = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
 
-
-class _LinkMessage(object):
-    def __init__(self, parent, fileobj=None):
-        self.parent = parent
-        
-        if fileobj:
-            self.fileobj = fileobj
-            self.read()
-        else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
-
-    def __str__(self):
-        from pprint import pformat
-        return "----- \n %r \n %s"%(self, pformat(self.__dict__, indent=4) )
-
-    def get_root(self):
-        obj = self
-        while hasattr(obj, "parent") and not isinstance(obj.parent, _SuperBlock):
-            obj = obj.parent
-
-        return obj
-
-    def read(self):
-        if not hasattr(self, "fileobj"):
-            raise Exception("Must be initiated with a fileobj in order to call read()")
-
-        self._read_version()
-        
-        if self.version == 1:
-            self._read_flags()
-
-            if self.flags["linktype"]:
-                self._read_linktype()
-            else:
-                self.linktype = "hard"
-
-            if self.flags["creationorder"]:
-                self._read_creationorder()
-
-            if self.flags["namecharset"]:
-                self._read_namecharset()
-            else:
-                self.namecharset = "ascii"
-
-            self._read_namelength()
-            self._read_name()
-
-            self._read_link()
-
+    # dense attribute storage
+
+    def is_dense(self):
+        "Whether attributes are stored in a fractal heap, instead of as attribute messages in the object header"
+        return self.fractheap_address != UNDEFINED
+
+    def get_fractal_heap(self):
+        if not hasattr(self, "_fractheap"):
+            self.fileobj.seek(self.fractheap_address)
+            self._fractheap = _FractalHeap(self, self.fileobj)
+        return self._fractheap
+
+    def get_name_index(self):
+        if not hasattr(self, "_nameindex"):
+            self.fileobj.seek(self.nameindex_v2btree_address)
+            self._nameindex = _v2BTreeHeader(self, self.fileobj)
+        return self._nameindex
+
+    def iter_attributes(self):
+        "All densely stored attributes, in creation order if indexed, otherwise in name hash order"
+        if self.flags["indexorder"]:
+            self.fileobj.seek(self.orderindex_v2btree_address)
+            index = _v2BTreeHeader(self, self.fileobj)
         else:
-            raise Exception("This version does not exist")
-            
-    def _read_version(self):
-        self.version = self.fileobj.read_struct_type("B", 1)
-
-    def _read_flags(self):
-        raw = self.fileobj.read_bytes(1)
-        self.flags = dict(namelengthsize={0:1, 1:2, 2:4, 3:8}[_bitfield(raw, 0, 1)],
-                          creationorder=_bitflag(raw, 2),
-                          linktype=_bitflag(raw, 3),
-                          namecharset=_bitflag(raw, 4),
-                          )
-
-    def _read_linktype(self):
-        # TODO: allow userdefined linktypes, 65-255
-        val = self.fileobj.read_struct_type("B", 1)
-        self.linktype = {0:"hard", 1:"soft", 64:"external"}[val]
-
-    def _read_creationorder(self):
-        self.creationorder = self.fileobj.read_struct_type("Q", 1)
-
-    def _read_namecharset(self):
-        val = self.fileobj.read_struct_type("B", 1)
-        self.namecharset = {0:"ascii", 1:"utf8"}[val]
-
-    def _read_namelength(self):
-        self.namelength = self.fileobj.read_unknown_nr(self.flags["namelengthsize"], 1)
-
-    def _read_name(self):
-        self.name = self.fileobj.read_struct_type("s", self.namelength).decode(self.namecharset)
-
-    def _read_link(self):
-        if self.linktype == "hard":
+            index = self.get_name_index()
+        for record in index.iter_records():
+            yield self._read_heap_attribute(record)
+
+    def get_attribute(self, name):
+        "Looks up a densely stored attribute by searching the name index for the hash of the name"
+        if not isinstance(name, unicode):
+            name = name.decode("utf8")
+        namehash = _lookup3(name.encode("utf8"))
+        for record in self.get_name_index().find(lambda record: cmp(namehash, record["hash"])):
+            # different names may have the same hash
+            attr = self._read_heap_attribute(record)
+            if attr.name == name:
+                return attr
+
+    def _read_heap_attribute(self, record):
+        if record["msgflags"] & 2:
+            # the heap id is for the shared message heap
             superblock = self.get_root().parent
-            offset = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
-
-            pos = self.fileobj.tell() # this might go down a rabbithole of nested objects...
-            
-            self.fileobj.seek(superblock.base_address + offset)
-            self.link = _ObjectHeader(parent=self, fileobj=self.fileobj)
-
-            self.fileobj.seek(pos) # so remember to return to previous position after
-            
-        elif self.linktype == "soft":
-            length = self.fileobj.read_struct_type("H", 1) # 2-byte nr
-            self.link = self.fileobj.read_struct_type("s", length)
-
-        elif self.linktype == "external":
-            #length = self.fileobj.read_struct_type("H", 1) # 2-byte nr
-            raise NotImplementedError("External link types not yet supported")
-
+            return superblock.get_shared_message(12, heapid=record["heapid"])
+        raw = self.get_fractal_heap().get_object(record["heapid"])
+        return _AttributeMessage(parent=self, fileobj=_FileWrap(io.BytesIO(raw)))
 
 
 class _HeaderContMessage(object):
-    def __init__(self, parent, fileobj=None):
+    def __init__(self, parent, fileobj=None, **kwargs):
         self.parent = parent
         
         if fileobj:
             self.fileobj = fileobj
             self.read()
         else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
     def __str__(self):
         from pprint import pformat
@@ -1153,30 +4583,27 @@ class _HeaderContMessage(object):
         self._read_length()
 
     def _read_offset(self):
-        # TODO: hacky set to 1 byte, should use suplerblock offset size but becomes larger than its own datasize as stated in meta dict
         superblock = self.get_root().parent
-        self.offset = self.fileobj.read_unknown_nr(1, 1) #superblock.offset_size, 1)
+        self.offset = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
 
     def _read_length(self):
-        # TODO: hacky set to 1 byte, should use suplerblock offset size but becomes larger than its own datasize as stated in meta dict
         superblock = self.get_root().parent
-        self.length = self.fileobj.read_unknown_nr(1, 1) #superblock.length_size, 1)
+        self.length = self.fileobj.read_unknown_nr(superblock.length_size, 1)
 
 
 
 
 
 class _DataTypeMessage(object):
-    def __init__(self, parent, fileobj=None):
+    def __init__(self, parent, fileobj=None, **kwargs):
         self.parent = parent
         
         if fileobj:
             self.fileobj = fileobj
             self.read()
         else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
-        print self
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
     def __str__(self):
         from pprint import pformat
@@ -1198,11 +4625,19 @@ class _DataTypeMessage(object):
         self._read_size()
         self._read_properties()
 
+    def write(self, fileobj):
+        self.fileobj = fileobj
+
+        self._write_class_and_version()
+        self._write_bitfields()
+        self._write_size()
+        self._write_properties()
+
     def _read_class_and_version(self):
         raw = self.fileobj.read_bytes(1)
         
-        self.version = _bitfield(raw, 0, 3)
-        assert 1 <= self.version <= 3
+        self.version = _bitfield(raw, 4, 7)
+        assert 1 <= self.version <= 5
 
         self.classtype = {0: "fixpoint",
                           1: "floatpoint",
@@ -1215,11 +4650,12 @@ class _DataTypeMessage(object):
                           8: "enumerated",
                           9: "varlength",
                           10: "array",
-                          } [_bitfield(raw, 4, 7)]
+                          } [_bitfield(raw, 0, 3)]
 
     def _read_bitfields(self):
         raw = self.fileobj.read_bytes(3)
-        self.bitfields = [_bitflag(raw, i) for i in range(23)]
+        self._rawbitfields = raw
+        self.bitfields = [_bitflag(raw, i) for i in range(24)]
 
 ##        if self.classtype == "fixpoint":
 ##            self.bitfields = dict()[_bitflag(raw, x)]
@@ -1231,7 +4667,168 @@ class _DataTypeMessage(object):
         self.size = self.fileobj.read_unknown_nr(4, 1)
 
     def _read_properties(self):
-        pass
+        self.properties = dict()
+
+        if self.classtype == "fixpoint":
+            self.properties["bitoffset"] = self.fileobj.read_struct_type("H", 1)
+            self.properties["precision"] = self.fileobj.read_struct_type("H", 1)
+
+        elif self.classtype == "floatpoint":
+            self.properties["bitoffset"] = self.fileobj.read_struct_type("H", 1)
+            self.properties["precision"] = self.fileobj.read_struct_type("H", 1)
+            self.properties["exponentlocation"] = self.fileobj.read_struct_type("B", 1)
+            self.properties["exponentsize"] = self.fileobj.read_struct_type("B", 1)
+            self.properties["mantissalocation"] = self.fileobj.read_struct_type("B", 1)
+            self.properties["mantissasize"] = self.fileobj.read_struct_type("B", 1)
+            self.properties["exponentbias"] = self.fileobj.read_struct_type("I", 1)
+
+        elif self.classtype == "time":
+            self.properties["precision"] = self.fileobj.read_struct_type("H", 1)
+
+        elif self.classtype == "string":
+            self.properties["padding"] = {0:"nullterm", 1:"nullpad", 2:"spacepad"}.get(_bitfield(self._rawbitfields, 0, 3))
+            self.properties["charset"] = {0:"ascii", 1:"utf8"}.get(_bitfield(self._rawbitfields, 4, 7))
+
+        elif self.classtype == "bitfield":
+            self.properties["bitoffset"] = self.fileobj.read_struct_type("H", 1)
+            self.properties["precision"] = self.fileobj.read_struct_type("H", 1)
+
+        elif self.classtype == "opaque":
+            # tag is padded to a multiple of 8 bytes
+            taglength = _bitfield(self._rawbitfields, 0, 7)
+            self.properties["tag"] = self.fileobj.read_bytes(taglength).rstrip(b"\x00")
+
+        elif self.classtype == "compound":
+            nmembers = _bitfield(self._rawbitfields, 0, 15)
+            self.properties["members"] = [self._read_compound_member() for _ in range(nmembers)]
+
+        elif self.classtype == "reference":
+            self.properties["type"] = {0:"object", 1:"region"}.get(_bitfield(self._rawbitfields, 0, 3))
+
+        elif self.classtype == "enumerated":
+            nmembers = _bitfield(self._rawbitfields, 0, 15)
+            base = _DataTypeMessage(parent=self, fileobj=self.fileobj)
+            self.properties["base"] = base
+            self.properties["names"] = [self._read_member_name() for _ in range(nmembers)]
+            endian, typ = base.get_struct_type()
+            self.properties["values"] = list(struct.unpack(endian + bytes(nmembers) + typ,
+                                                           self.fileobj.read_bytes(nmembers * base.size)))
+
+        elif self.classtype == "varlength":
+            self.properties["type"] = {0:"sequence", 1:"string"}.get(_bitfield(self._rawbitfields, 0, 3))
+            self.properties["padding"] = {0:"nullterm", 1:"nullpad", 2:"spacepad"}.get(_bitfield(self._rawbitfields, 4, 7))
+            self.properties["charset"] = {0:"ascii", 1:"utf8"}.get(_bitfield(self._rawbitfields, 8, 11))
+            self.properties["base"] = _DataTypeMessage(parent=self, fileobj=self.fileobj)
+
+        elif self.classtype == "array":
+            dimensionality = self.fileobj.read_struct_type("B", 1)
+            if self.version < 3:
+                self.fileobj.read_bytes(3) # reserved
+            self.properties["dimsizes"] = [self.fileobj.read_struct_type("I", 1) for _ in range(dimensionality)]
+            if self.version < 3:
+                self.properties["permutindices"] = [self.fileobj.read_struct_type("I", 1) for _ in range(dimensionality)]
+            self.properties["base"] = _DataTypeMessage(parent=self, fileobj=self.fileobj)
+
+    def _read_member_name(self):
+        "Null terminated name, padded to a multiple of 8 bytes before version 3"
+        chars = []
+        char = self.fileobj.read_bytes(1)
+        while char != b"\x00":
+            chars.append(char)
+            char = self.fileobj.read_bytes(1)
+        name = b"".join(chars)
+        if self.version < 3:
+            self.fileobj.read_bytes((len(name) + 8) // 8 * 8 - len(name) - 1)
+        return name.decode("utf8")
+
+    def _read_compound_member(self):
+        member = dict()
+        member["name"] = self._read_member_name()
+
+        if self.version == 1:
+            member["offset"] = self.fileobj.read_struct_type("I", 1)
+            dimensionality = self.fileobj.read_struct_type("B", 1)
+            self.fileobj.read_bytes(3 + 4 + 4) # reserved, permutation index, reserved
+            dimsizes = [self.fileobj.read_struct_type("I", 1) for _ in range(4)]
+            member["dimsizes"] = dimsizes[:dimensionality]
+        elif self.version == 2:
+            member["offset"] = self.fileobj.read_struct_type("I", 1)
+        else:
+            # only as many bytes as needed for offsets within the compound size
+            member["offset"] = self.fileobj.read_unknown_nr(_limit_enc_size(self.size), 1)
+
+        member["datatype"] = _DataTypeMessage(parent=self, fileobj=self.fileobj)
+        return member
+
+    def _decode_varlength(self, raw):
+        """Resolves the (length, collection address, object index) vlen elements in raw.
+        The elements are visited grouped by collection, so each collection is only read once."""
+        superblock = self.get_root().parent
+        refsize = 4 + superblock.offset_size + 4
+        count = len(raw) // refsize
+        offsettype = {2: "H", 4: "I", 8: "Q"}[superblock.offset_size]
+        flat = struct.unpack("<" + ("I%sI" % offsettype) * count, raw[:count * refsize])
+        refs = zip(flat[0::3], flat[1::3], flat[2::3])
+
+        base = self.properties["base"]
+        isstring = self.properties["type"] == "string"
+        empty = b"" if isstring else base.decode(b"")
+
+        values = [empty] * count
+        order = sorted(range(count), key=lambda i: refs[i][1])
+        for address, indexes in itertools.groupby(order, key=lambda i: refs[i][1]):
+            if address == 0:
+                # empty or unset elements point nowhere
+                continue
+            collection = superblock.get_global_heap(address)
+            for i in indexes:
+                length, _, index = refs[i]
+                obj = collection.objects[index]
+                if isstring:
+                    values[i] = obj[:length]
+                else:
+                    values[i] = base.decode(obj[:length * base.size])
+
+        if isstring and self.properties["charset"] == "utf8":
+            values = [value.decode("utf8") for value in values]
+        return values
+
+    def _write_class_and_version(self):
+        classcode = {"fixpoint": 0,
+                     "floatpoint": 1,
+                     "time": 2,
+                     "string": 3,
+                     "bitfield": 4,
+                     "opaque": 5,
+                     "compound": 6,
+                     "reference": 7,
+                     "enumerated": 8,
+                     "varlength": 9,
+                     "array": 10,
+                     } [self.classtype]
+        self.fileobj.write_bytes(_bitbytes(1, (0, classcode), (4, self.version)))
+
+    def _write_bitfields(self):
+        self.fileobj.write_bytes(_bitbytes(3, *enumerate(self.bitfields)))
+
+    def _write_size(self):
+        self.fileobj.write_unknown_nr(4, 1, self.size)
+
+    def _write_properties(self):
+        if self.classtype == "fixpoint":
+            self.fileobj.write_struct_type("H", 2, (self.properties["bitoffset"], self.properties["precision"]))
+
+        elif self.classtype == "floatpoint":
+            self.fileobj.write_struct_type("H", 2, (self.properties["bitoffset"], self.properties["precision"]))
+            self.fileobj.write_struct_type("B", 4, (self.properties["exponentlocation"], self.properties["exponentsize"],
+                                                    self.properties["mantissalocation"], self.properties["mantissasize"]))
+            self.fileobj.write_struct_type("I", 1, self.properties["exponentbias"])
+
+        elif self.classtype == "string":
+            pass
+
+        else:
+            raise NotImplementedError("Writing %s data types not yet supported" % self.classtype)
 
     def get_struct_type(self):
         # NOTE: so far, we are ignoring several bitfields and dtype properties
@@ -1241,7 +4838,9 @@ class _DataTypeMessage(object):
             endian = "<" if self.bitfields[0] == 0 else ">"
 
             signed = self.bitfields[3]
-            if self.size == 2:
+            if self.size == 1:
+                typ = "b" if signed else "B"
+            elif self.size == 2:
                 typ = "h" if signed else "H"
             elif self.size == 4:
                 typ = "i" if signed else "I"
@@ -1259,29 +4858,100 @@ class _DataTypeMessage(object):
             else:
                 raise NotImplementedError("Floating point byte order not yet supported")
 
-            if self.size == 4:
+            if self.size == 2:
+                typ = "e"
+            elif self.size == 4:
                 typ = "f"
             elif self.size == 8:
                 typ = "d"
 
             return endian, typ
 
+        elif self.classtype == "enumerated":
+            return self.properties["base"].get_struct_type()
+
         else:
             raise NotImplementedError("Data type not yet supported")
 
+    def get_dtype(self):
+        """Equivalent numpy dtype, where compound types become structured dtypes
+        with the same member offsets and padding, so that raw bytes can be used as is."""
+        if self.classtype in ("fixpoint", "bitfield"):
+            endian = "<" if self.bitfields[0] == 0 else ">"
+            kind = "i" if self.classtype == "fixpoint" and self.bitfields[3] else "u"
+            return np.dtype("%s%s%d" % (endian, kind, self.size))
+
+        elif self.classtype == "floatpoint":
+            endian, typ = self.get_struct_type()
+            return np.dtype(endian + typ)
+
+        elif self.classtype == "string":
+            return np.dtype("S%d" % self.size)
+
+        elif self.classtype == "opaque":
+            return np.dtype("V%d" % self.size)
+
+        elif self.classtype == "reference":
+            if self.properties["type"] == "object":
+                return np.dtype("<u%d" % self.size)
+            return np.dtype("V%d" % self.size)
+
+        elif self.classtype == "compound":
+            members = self.properties["members"]
+            formats = []
+            for member in members:
+                dtype = member["datatype"].get_dtype()
+                if member.get("dimsizes"):
+                    dtype = np.dtype((dtype, tuple(member["dimsizes"])))
+                formats.append(dtype)
+            return np.dtype(dict(names=[member["name"] for member in members],
+                                 formats=formats,
+                                 offsets=[member["offset"] for member in members],
+                                 itemsize=self.size))
+
+        elif self.classtype == "array":
+            return np.dtype((self.properties["base"].get_dtype(), tuple(self.properties["dimsizes"])))
+
+        elif self.classtype == "enumerated":
+            mapping = dict(zip(self.properties["names"], self.properties["values"]))
+            return np.dtype(self.properties["base"].get_dtype(), metadata=dict(enum=mapping))
+
+        elif self.classtype == "varlength":
+            # each value is a python string or an array of the base type
+            return np.dtype(object)
+
+        else:
+            raise NotImplementedError("Numpy dtype for %s data types not yet supported" % self.classtype)
+
+    def decode(self, raw):
+        "Flat values of raw bytes, as a zero-copy numpy array if numpy is available, otherwise as a tuple"
+        if self.classtype == "varlength":
+            values = self._decode_varlength(raw)
+            if np is not None:
+                array = np.empty(len(values), dtype=object)
+                for i, value in enumerate(values):
+                    array[i] = value
+                return array
+            return tuple(values)
+
+        if np is not None:
+            return np.frombuffer(raw, self.get_dtype())
+        endian, typ = self.get_struct_type()
+        count = len(raw) // self.size
+        return struct.unpack(endian + bytes(count) + typ, raw[:count * self.size])
+
 
 
 class _FilterPipelineMessage(object):
-    def __init__(self, parent, fileobj=None):
+    def __init__(self, parent, fileobj=None, **kwargs):
         self.parent = parent
         
         if fileobj:
             self.fileobj = fileobj
             self.read()
         else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
-        print self
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
     def __str__(self):
         from pprint import pformat
@@ -1294,10 +4964,16 @@ class _FilterPipelineMessage(object):
 
         return obj
 
-    def decode(self, raw):
-        # run raw bytes through each filter in the pipeline???
-        # TODO: should also consider skip chunk filterflags, as well as optional flag...
-        for filt in self.filters:
+    def decode(self, raw, filtermask=None, length=None):
+        """Undoes the filters, except those flagged in the filtermask of a chunk. With length, only
+        that many bytes from the start of the chunk are needed, and if deflate is the only filter
+        to undo, decompressing stops there, so that fewer bytes than the whole chunk are returned"""
+        used = [filt.filter_id for i, filt in enumerate(self.filters) if not (filtermask and filtermask[i])]
+        partial = length is not None and used == [1]
+        # filters are listed in the order they were applied when writing, so undo them backwards
+        for i, filt in reversed(list(enumerate(self.filters))):
+            if filtermask and filtermask[i]:
+                continue
             if filt.filter_id == 1:
                 # deflate/gzip
                 # http://stackoverflow.com/questions/2695152/in-python-how-do-i-decode-gzip-encoding
@@ -1309,13 +4985,38 @@ class _FilterPipelineMessage(object):
 
                 import zlib
                 obj = zlib.decompressobj(32+zlib.MAX_WBITS) # autodetect gzip headers, and obj necessary to handle as stream and ignore incomplete tail
-                raw = obj.decompress(raw)
+                raw = obj.decompress(raw, length) if partial else obj.decompress(raw)
                 #raw = zlib.decompress(raw, 16+zlib.MAX_WBITS) 
+            elif filt.filter_id == 2:
+                raw = _unshuffle(raw, filt.client_data[0])
+            elif filt.filter_id == 3:
+                # fletcher32, the checksum is appended to the data
+                raw, stored = raw[:-4], raw[-4:]
+                if self.get_root().parent.fileobj.checksums == "all":
+                    checksum = struct.pack("<I", _fletcher32(raw))
+                    # versions of the library before 1.6.3 stored it with the bytes swapped
+                    if stored != checksum and stored != checksum[::-1]:
+                        raise IOError("Fletcher32 checksum mismatch in chunk")
             else:
-                raise NotImplementedError("Decoding filter id %s not yet supported" % self.filter_id)
+                raise NotImplementedError("Decoding filter id %s not yet supported" % filt.filter_id)
 
         return raw
 
+    def encode(self, raw):
+        return _encode_chunk((raw, [(filt.filter_id, filt.client_data) for filt in self.filters]))
+
+    def write(self, fileobj):
+        self.fileobj = fileobj
+
+        if self.version == 2:
+            self.fileobj.write_struct_type("B", 1, self.version)
+            self.fileobj.write_unknown_nr(1, 1, len(self.filters))
+            for filt in self.filters:
+                filt.write(fileobj)
+
+        else:
+            raise NotImplementedError("Writing filter pipeline version %s not yet supported" % self.version)
+
     def read(self):
         if not hasattr(self, "fileobj"):
             raise Exception("Must be initiated with a fileobj in order to call read()")
@@ -1357,15 +5058,15 @@ class _FilterPipelineMessage(object):
 
 
 class _BaseFilterDescription(object):
-    def __init__(self, parent, fileobj=None):
+    def __init__(self, parent, fileobj=None, **kwargs):
         self.parent = parent
         
         if fileobj:
             self.fileobj = fileobj
             self.read()
         else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
     def __str__(self):
         from pprint import pformat
@@ -1397,7 +5098,8 @@ class _BaseFilterDescription(object):
 
     def _read_client_data(self):
         if self.numclientvalues:
-            self.client_data = self.fileobj.read_unknown_nr(4, self.numclientvalues)
+            values = self.fileobj.read_unknown_nr(4, self.numclientvalues)
+            self.client_data = list(values) if self.numclientvalues > 1 else [values]
         else:
             self.client_data = []
 
@@ -1435,21 +5137,33 @@ class _v2FilterDescription(_BaseFilterDescription):
         if self.filter_id >= 256 and self.name_length != 0:
             self._read_name() # not defined for ids less than 256
         self._read_client_data()
-        print self
+
+    def write(self, fileobj):
+        self.fileobj = fileobj
+
+        self.fileobj.write_unknown_nr(2, 1, self.filter_id)
+        if self.filter_id >= 256:
+            self.fileobj.write_unknown_nr(2, 1, len(self.name))
+        self.fileobj.write_bytes(_bitbytes(2, (0, self.flags["optional"])))
+        self.fileobj.write_unknown_nr(2, 1, len(self.client_data))
+        if self.filter_id >= 256:
+            self.fileobj.write_bytes(self.name)
+        if self.client_data:
+            self.fileobj.write_unknown_nr(4, len(self.client_data), self.client_data)
 
 
 
 
 class _DataLayoutMessage(object):
-    def __init__(self, parent, fileobj=None):
+    def __init__(self, parent, fileobj=None, **kwargs):
         self.parent = parent
         
         if fileobj:
             self.fileobj = fileobj
             self.read()
         else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
     def __str__(self):
         from pprint import pformat
@@ -1482,7 +5196,8 @@ class _DataLayoutMessage(object):
             #self._read_compact_data_size()
             #self._read_compact_data()
 
-        elif self.version == 3:
+        elif self.version in (3, 4, 5):
+            # version 5 is written by newer libraries for filtered chunks, and is encoded the same as version 4
             self._read_layout_class()
             self._read_properties()
 
@@ -1507,50 +5222,414 @@ class _DataLayoutMessage(object):
 
     def _read_properties(self):
         self.properties = dict()
+        superblock = self.get_root().parent
 
-        if self.version == 3:
-        
-            if self.layout_class == "compact":
-                self.properties["size"] = self.fileobj.read_unknown_nr(2, 1)
-                self.properties["address"] = self.fileobj.tell() # original format does not use an address field, but we do since we dont want to read it right away
+        if self.layout_class == "compact":
+            self.properties["size"] = self.fileobj.read_unknown_nr(2, 1)
+            self.properties["address"] = self.fileobj.tell() # original format does not use an address field, but we do since we dont want to read it right away
 
-            elif self.layout_class == "contiguous":
-                superblock = self.get_root().parent
-                self.properties["address"] = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+        elif self.layout_class == "contiguous":
+            self.properties["address"] = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+            self.properties["size"] = self.fileobj.read_unknown_nr(superblock.length_size, 1)
+
+        elif self.layout_class == "chunked" and self.version == 3:
+            self.properties["dimensionality"] = self.fileobj.read_struct_type("B", 1)
+            self.properties["address"] = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+            # the last of the dimsizes is the size of a single dataset element
+            self.properties["dimsizes"] = [self.fileobj.read_struct_type("I", 1)
+                                           for _ in range(self.properties["dimensionality"])]
+            self.properties["indextype"] = "btree"
+
+        elif self.layout_class == "chunked":
+            raw = self.fileobj.read_bytes(1)
+            self.properties["flags"] = dict(unfiltered_edges=_bitflag(raw, 0),
+                                            single_filtered=_bitflag(raw, 1))
+            self.properties["dimensionality"] = self.fileobj.read_struct_type("B", 1)
+            # the dimsizes take up as few bytes as they need
+            encsize = self.fileobj.read_struct_type("B", 1)
+            self.properties["dimsizes"] = [_unpack_int(self.fileobj.read_bytes(encsize))
+                                           for _ in range(self.properties["dimensionality"])]
+            self.properties["indextype"] = {1: "single",
+                                            2: "implicit",
+                                            3: "fixedarray",
+                                            4: "extensiblearray",
+                                            5: "btree2"}[self.fileobj.read_struct_type("B", 1)]
+
+            # the parameters the index was created with, which its header also has
+            if self.properties["indextype"] == "single" and self.properties["flags"]["single_filtered"]:
                 self.properties["size"] = self.fileobj.read_unknown_nr(superblock.length_size, 1)
-                
-            elif self.layout_class == "chunked":
-                self.properties["dimensionality"] = self.fileobj.read_struct_type("B", 1)
-                superblock = self.get_root().parent
-                self.properties["address"] = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
-                self.properties["dimsizes"] = [self.fileobj.read_struct_type("I", 1)
-                                               for _ in range(self.properties["dimensionality"])]
-                self.properties["delemsize"] = self.fileobj.read_struct_type("I", 1)
+                raw = self.fileobj.read_bytes(4)
+                self.properties["filtermask"] = [_bitflag(raw, i) for i in range(32)]
+            elif self.properties["indextype"] == "fixedarray":
+                self.fileobj.read_bytes(1)
+            elif self.properties["indextype"] == "extensiblearray":
+                self.fileobj.read_bytes(5)
+            elif self.properties["indextype"] == "btree2":
+                self.fileobj.read_bytes(4 + 1 + 1)
+            # of the index, or of the data itself for single chunk and implicit indexes
+            self.properties["address"] = self.fileobj.read_unknown_nr(superblock.offset_size, 1)
+
+    def write(self, fileobj):
+        self.fileobj = fileobj
+
+        if self.version == 3:
+            self._write_version()
+            self._write_layout_class()
+            self._write_properties()
+
+        else:
+            raise NotImplementedError("Writing data layout version %s not yet supported" % self.version)
+
+    def _write_version(self):
+        self.fileobj.write_struct_type("B", 1, self.version)
+
+    def _write_layout_class(self):
+        val = {"compact": 0,
+               "contiguous": 1,
+               "chunked": 2}[self.layout_class]
+        self.fileobj.write_struct_type("B", 1, val)
+
+    def _write_properties(self):
+        superblock = self.get_root().parent
+
+        if self.layout_class == "contiguous":
+            self.fileobj.write_unknown_nr(superblock.offset_size, 1, self.properties["address"])
+            self.fileobj.write_unknown_nr(superblock.length_size, 1, self.properties["size"])
+
+        elif self.layout_class == "chunked":
+            self.fileobj.write_struct_type("B", 1, self.properties["dimensionality"])
+            self.fileobj.write_unknown_nr(superblock.offset_size, 1, self.properties["address"])
+            self.fileobj.write_struct_type("I", self.properties["dimensionality"], self.properties["dimsizes"])
 
-        elif self.version == 4:
-            raise NotImplementedError("Data layout properties for version 4 not yet supported")
+        else:
+            raise NotImplementedError("Writing %s data layouts not yet supported" % self.layout_class)
+
+    def _get_header(self):
+        obj = self.parent
+        while not isinstance(obj, _ObjectHeader):
+            obj = obj.parent
+        return obj
+
+    def get_fill_value(self):
+        "The raw bytes of a single fill value, or zeros, the datatype default, if none was defined"
+        header = self._get_header()
+        fillvalue = header.get_message(5)
+        if fillvalue is not None and fillvalue.fill_value is not None:
+            return fillvalue.fill_value
+        return b"\x00" * header.get_message(3).size
+
+    def iter_chunk_index(self, lower, upper):
+        """Yields (offsets, address, size, filtermask) of the stored chunks overlapping the box from
+        lower up to upper, from the chunk_index dict by chunk offsets if set, otherwise from the index of the layout.
+        Array, single chunk and implicit indexes give the address of each chunk straight from its
+        place in the chunk grid, while btrees are searched."""
+        if hasattr(self, "chunk_index"):
+            if any(low >= up for low, up in zip(lower, upper)):
+                return
+            chunkshape = self.properties["dimsizes"][:-1]
+            ranges = [xrange(low // size * size, up, size) for low, up, size in zip(lower, upper, chunkshape)]
+            if _product(len(cells) for cells in ranges) > len(self.chunk_index):
+                # fewer stored chunks than cells in the box, so checking each chunk is quicker
+                offsets = sorted(offsets for offsets in self.chunk_index
+                                 if all(offset < up and offset + size > low
+                                        for offset, size, low, up in zip(offsets, chunkshape, lower, upper)))
+            else:
+                offsets = itertools.product(*ranges)
+            for key in offsets:
+                chunk = self.chunk_index.get(key)
+                if chunk is not None:
+                    yield chunk
+            return
+        if self.properties["address"] == UNDEFINED or any(low >= up for low, up in zip(lower, upper)):
+            return
+
+        indextype = self.properties.get("indextype", "btree")
+        chunkshape = self.properties["dimsizes"][:-1]
+        chunkbytes = _product(self.properties["dimsizes"])
+        nomask = [0] * 32
+        if indextype == "btree":
+            self.fileobj.seek(self.properties["address"])
+            btree = _v1BTreeNode(self, self.fileobj)
+            for chunk in btree.iter_chunks(lower, upper):
+                yield chunk
+
+        elif indextype == "single":
+            yield ((0,) * len(chunkshape), self.properties["address"],
+                   self.properties.get("size", chunkbytes), self.properties.get("filtermask", nomask))
+
+        elif indextype == "btree2":
+            first = lower[0] // chunkshape[0]
+            last = (upper[0] - 1) // chunkshape[0]
+
+            def compare(record):
+                # records are sorted by their scaled offsets, so only those within the box along the first dimension are read
+                if record["scaled"][0] < first:
+                    return 1
+                return -1 if record["scaled"][0] > last else 0
+
+            for record in self._get_index().find(compare):
+                offsets = tuple(scaled * size for scaled, size in zip(record["scaled"], chunkshape))
+                if all(offset < up and offset + size > low
+                       for offset, size, low, up in zip(offsets, chunkshape, lower, upper)):
+                    yield self._edge_chunk(offsets, record["address"], record.get("size", chunkbytes),
+                                           record.get("filtermask", nomask))
+
+        else:
+            index = self._get_index() if indextype != "implicit" else None
+            for offsets, i in self._iter_chunk_grid(lower, upper):
+                if index is None:
+                    # stored one after another, all of the same size
+                    address, size, filtermask = self.properties["address"] + i * chunkbytes, None, None
+                else:
+                    address, size, filtermask = index.get_entry(i)
+                if address != UNDEFINED:
+                    yield self._edge_chunk(offsets, address, chunkbytes if size is None else size, filtermask or nomask)
+
+    def _get_index(self):
+        "The header of the fixed array, extensible array or v2 btree index of chunks, read once"
+        if not hasattr(self, "_index"):
+            self.fileobj.seek(self.properties["address"])
+            indextype = self.properties["indextype"]
+            if indextype == "fixedarray":
+                self._index = _FixedArray(self, self.fileobj)
+            elif indextype == "extensiblearray":
+                self._index = _ExtensibleArray(self, self.fileobj)
+            else:
+                self._index = _v2BTreeHeader(self, self.fileobj, ndims=len(self.properties["dimsizes"]) - 1)
+        return self._index
+
+    def _iter_chunk_grid(self, lower, upper):
+        """Yields (offsets, index) of the chunks overlapping the box from lower up to upper, where index
+        is the place of the chunk in the grid of chunks covering the maximum shape, in row major order.
+        With an extensible array the unlimited dimension is moved first, so growing it adds entries at the end."""
+        chunkshape = self.properties["dimsizes"][:-1]
+        dataspace = self._get_header().get_message(1)
+        maxdims = dataspace.maxdimsizes if dataspace.flags["maxdims"] else dataspace.dimsizes
+        order = range(len(chunkshape))
+        if self.properties["indextype"] == "extensiblearray":
+            unlimited = list(maxdims).index(UNDEFINED)
+            order = [unlimited] + [dim for dim in order if dim != unlimited]
+
+        # how many entries apart neighbouring chunks are along each dimension
+        strides = dict()
+        stride = 1
+        for dim in reversed(order):
+            strides[dim] = stride
+            if maxdims[dim] != UNDEFINED:
+                stride *= -(-maxdims[dim] // chunkshape[dim])
+
+        ranges = [xrange(low // size * size, up, size) for low, up, size in zip(lower, upper, chunkshape)]
+        for offsets in itertools.product(*ranges):
+            yield offsets, sum(offset // size * strides[dim] for dim, (offset, size) in enumerate(zip(offsets, chunkshape)))
+
+    def _edge_chunk(self, offsets, address, size, filtermask):
+        "The chunk entry, skipping all filters for chunks over the edge of the dataset if the layout leaves those unfiltered"
+        if self.properties["flags"]["unfiltered_edges"]:
+            dimsizes = self._get_header().get_message(1).dimsizes
+            if any(offset + chunksize > dimsize
+                   for offset, chunksize, dimsize in zip(offsets, self.properties["dimsizes"][:-1], dimsizes)):
+                filtermask = [1] * 32
+        return offsets, address, size, filtermask
+
+    def read_chunks(self, chunks):
+        """Yields (offsets, raw, filtermask) for each (offsets, address, size, filtermask) in chunks,
+        where storages that read several ranges at once get as many chunks at a time"""
+        batch = []
+        for chunk in chunks:
+            batch.append(chunk)
+            if len(batch) >= self.fileobj.concurrency:
+                for item in self._read_batch(batch):
+                    yield item
+                batch = []
+        for item in self._read_batch(batch):
+            yield item
+
+    def _read_batch(self, batch):
+        raws = self.fileobj.read_ranges([(address, size) for offsets, address, size, filtermask in batch])
+        return [(offsets, raw, filtermask) for (offsets, address, size, filtermask), raw in zip(batch, raws)]
+
+    def get_chunk_index(self):
+        "List of (offsets, address, size, filtermask) of all stored chunks"
+        dimsizes = self._get_header().get_message(1).dimsizes
+        return list(self.iter_chunk_index([0] * len(dimsizes), dimsizes))
+
+    def read_region(self, start, stop, step=None, skip_fill=False):
+        """Reads the box of values from start up to stop as a numpy array, only reading the chunks it overlaps.
+        Chunks that were never written are filled in with the fill value without any reading."""
+        header = self._get_header()
+        datatype = header.get_message(3)
+        step = step or [1] * len(start)
+        shape = tuple(len(xrange(low, up, st)) for low, up, st in zip(start, stop, step))
+        # a new array of zeros already holds a fill value of zeros
+        fill = bool(self.get_fill_value().strip(b"\x00"))
+        out = (np.empty if fill else np.zeros)(shape, datatype.get_dtype())
+        for region, values in self.iter_region(start, stop, step=step, skip_fill=skip_fill, fill=fill):
+            out[region] = values
+        return out
+
+    def iter_region(self, start, stop, func=None, workers=None, step=None, skip_fill=False, prefetch=None, fill=False):
+        """Yields (region, values) for each separately stored part of the box from start up to stop,
+        where region is the slices covered by values within the box, and chunks that were never
+        written are left out, or with fill, yielded last as read only arrays of the fill value that
+        take no memory. Chunks are read one after another, while decoding them and calling
+        func on their values, if given, runs in parallel in workers threads. With prefetch,
+        a background thread reads up to that many chunks ahead, in order of the chunk index,
+        within PREFETCH_BYTES, so reading overlaps with decoding.
+
+        With step, only every step'th value along each dimension is selected, region refers
+        to the strided box, and chunks without any selected values are never read.
+
+        With skip_fill, chunks of only fill values are also left out. Chunks whose stored bytes
+        are those of a chunk of fill values run through the same filters are left out without
+        decoding, while others of that size, which may have been compressed differently or
+        hold some other constant, are decoded and only left out if they match the fill."""
+        if self.version not in (3, 4, 5):
+            raise NotImplementedError("Reading data layout version %s not yet supported" % self.version)
+
+        header = self._get_header()
+        datatype = header.get_message(3)
+        dimsizes = header.get_message(1).dimsizes
+        step = step or [1] * len(start)
+        shape = tuple(len(xrange(low, up, st)) for low, up, st in zip(start, stop, step))
+        if any(size == 0 for size in shape):
+            return
+
+        if self.layout_class == "contiguous" and self.properties["address"] == UNDEFINED:
+            # never written, so all of it is the fill value
+            if fill:
+                value = datatype.decode(self.get_fill_value())[0]
+                values = np.broadcast_to(value, shape + np.shape(value))
+                yield tuple(slice(0, size) for size in shape), func(values) if func else values
+
+        elif self.layout_class in ("compact", "contiguous"):
+            # only the rows along the first dimension that the box spans, at most CONTIGUOUS_BYTES at a time
+            rowsize = _product(dimsizes[1:]) * datatype.size
+            if not shape:
+                pieces = [(0, 1)]
+            else:
+                nrows = max(1, CONTIGUOUS_BYTES // (rowsize * step[0]))
+                pieces = [(first, min(first + nrows, shape[0])) for first in range(0, shape[0], nrows)]
+            for first, last in pieces:
+                rows = slice(start[0] + first * step[0], start[0] + (last - 1) * step[0] + 1) if shape else slice(0, 1)
+                self.fileobj.seek(self.properties["address"] + rows.start * rowsize)
+                flat = datatype.decode(self.fileobj.read_bytes((rows.stop - rows.start) * rowsize))
+                block = flat.reshape((rows.stop - rows.start,) + tuple(dimsizes[1:]) + flat.shape[1:])
+                if shape:
+                    values = block[(slice(None, None, step[0]),) +
+                                   tuple(slice(low, up, st) for low, up, st in zip(start[1:], stop[1:], step[1:]))]
+                    region = (slice(first, last),) + tuple(slice(0, size) for size in shape[1:])
+                else:
+                    values = block[0]
+                    region = ()
+                yield region, func(values) if func else values
+
+        elif self.layout_class == "chunked":
+            if self.properties["address"] == UNDEFINED and not fill:
+                return
+            chunkshape = self.properties["dimsizes"][:-1]
+            pipeline = header.get_message(11)
+            fillchunk = fillraw = None
+            if skip_fill:
+                fillchunk = self.get_fill_value() * _product(chunkshape)
+                try:
+                    fillraw = pipeline.encode(fillchunk) if pipeline else fillchunk
+                except NotImplementedError:
+                    # so each chunk is decoded whole and compared instead
+                    pass
+
+            def selected(offsets):
+                # the first and last+1 selected index within the chunk along each dimension
+                lower = [low + -(-max(offset - low, 0) // st) * st for offset, low, st in zip(offsets, start, step)]
+                upper = [min(offset + chunksize, up) for offset, chunksize, up in zip(offsets, chunkshape, stop)]
+                return lower, upper
+
+            def wanted(chunk):
+                offsets, address, size, filtermask = chunk
+                lower, upper = selected(offsets)
+                return all(low < up for low, up in zip(lower, upper))
+
+            # offsets of the stored chunks read, to know which were never written once all are
+            stored = set()
+
+            def iter_wanted():
+                for chunk in self.iter_chunk_index(start, stop):
+                    if wanted(chunk):
+                        stored.add(tuple(chunk[0][:len(chunkshape)]))
+                        yield chunk
+
+            def read_chunks():
+                return self.read_chunks(iter_wanted())
+
+            def decode(chunk):
+                offsets, raw, filtermask = chunk
+                lower, upper = selected(offsets)
+                if fillchunk is not None and (fillraw is None or len(raw) == len(fillraw) and not any(filtermask)):
+                    empty = raw == fillraw
+                    if not empty and pipeline:
+                        raw = pipeline.decode(raw, filtermask)
+                        empty = raw == fillchunk
+                    if empty:
+                        # so that with fill it is yielded as the fill value along with the unwritten chunks
+                        stored.discard(tuple(offsets[:len(chunkshape)]))
+                        return None
+                elif pipeline:
+                    # chunks are row major, so when the box ends early along the first dimension only the rows before that are needed
+                    length = None
+                    if upper[0] - offsets[0] < chunkshape[0]:
+                        length = (upper[0] - offsets[0]) * _product(chunkshape[1:]) * datatype.size
+                    raw = pipeline.decode(raw, filtermask, length)
+                flat = datatype.decode(raw)
+                # as many rows as were decoded
+                values = flat.reshape((-1,) + tuple(chunkshape[1:]) + flat.shape[1:])
+
+                values = values[tuple(slice(low - offset, up - offset, st)
+                                      for low, up, offset, st in zip(lower, upper, offsets, step))]
+                region = tuple(slice((low - first) // st, (low - first) // st + size)
+                               for low, first, st, size in zip(lower, start, step, values.shape))
+                return region, func(values) if func else values
+
+            chunks = _prefetch(read_chunks(), prefetch, size=lambda chunk: len(chunk[1]))
+            try:
+                for result in _ordered_map(decode, chunks, workers):
+                    # None for chunks of only fill values left out with skip_fill
+                    if result is not None:
+                        yield result
+            finally:
+                chunks.close()
+
+            if fill:
+                value = datatype.decode(self.get_fill_value())[0]
+                ranges = [xrange(low // size * size, up, size) for low, up, size in zip(start, stop, chunkshape)]
+                for offsets in itertools.product(*ranges):
+                    lower, upper = selected(offsets)
+                    if offsets in stored or any(low >= up for low, up in zip(lower, upper)):
+                        continue
+                    values = np.broadcast_to(value, tuple(len(xrange(low, up, st)) for low, up, st in zip(lower, upper, step))
+                                                    + np.shape(value))
+                    region = tuple(slice((low - first) // st, (low - first) // st + size)
+                                   for low, first, st, size in zip(lower, start, step, values.shape))
+                    yield region, func(values) if func else values
 
     def read_data(self):
         if self.version in (1,2):
             fsdfsa
 
-        elif self.version == 3:
+        elif self.version in (3, 4, 5):
             self.fileobj.seek(self.properties["address"])
 
             # TODO: remember to read into the data according to dimensions wanted
             
-            if self.layout_class == "compact":
-                raw = self.read_bytes(self.properties["size"])
-
-            elif self.layout_class == "contiguous":
-                raw = self.read_bytes(self.properties["size"])
+            if self.layout_class in ("compact", "contiguous"):
+                raw = self.fileobj.read_bytes(self.properties["size"])
+                header = self._get_header()
+                data = header.get_message(3).decode(raw)
+                if np is not None:
+                    # array datatypes add their own dimensions
+                    data = data.reshape(tuple(header.get_message(1).dimsizes) + data.shape[1:])
 
             elif self.layout_class == "chunked":
-                btree = _v1BTreeNode(self, self.fileobj)
-                data = btree.read_data()
-
-        elif self.version == 4:
-            fsdfsd
+                dimsizes = self._get_header().get_message(1).dimsizes
+                data = self.read_region([0] * len(dimsizes), dimsizes)
 
         return data
 
@@ -1558,15 +5637,15 @@ class _DataLayoutMessage(object):
 
 
 class _FillValueMessage(object):
-    def __init__(self, parent, fileobj=None):
+    def __init__(self, parent, fileobj=None, **kwargs):
         self.parent = parent
         
         if fileobj:
             self.fileobj = fileobj
             self.read()
         else:
-            # set superblock attrs from kwargs...
-            raise NotImplementedError("Building from scratch not yet supported")
+            # set attrs from kwargs, for writing
+            self.__dict__.update(kwargs)
 
     def __str__(self):
         from pprint import pformat
@@ -1587,12 +5666,9 @@ class _FillValueMessage(object):
         assert 0 < self.version <= 3
 
         if self.version in (1,2):
-            raise NotImplementedError("Fill value for version 1 and 2 not yet supported")
-            #self._read_space_allocation_time()
-            #self._read_fill_value_write_time()
-            #self._read_fill_value_defined()
-            #self._read_size()
-            #self._read_fill_value()
+            self._read_old_flags()
+            self._read_size()
+            self._read_fill_value()
 
         elif self.version == 3:
             self._read_flags()
@@ -1611,6 +5687,15 @@ class _FillValueMessage(object):
                           reserved=_bitfield(raw,6,7),
                           )
 
+    def _read_old_flags(self):
+        "Versions 1 and 2 have a byte for each, where the value is always there in version 1"
+        spacealloctime, fillvalwritetime, defined = self.fileobj.read_struct_type("B", 3)
+        self.flags = dict(spacealloctime=spacealloctime,
+                          fillvalwritetime=fillvalwritetime,
+                          fillvalundef=int(defined == 0),
+                          fillvaldef=int(self.version == 1 or defined != 0),
+                          )
+
     def _read_size(self):
         if self.flags["fillvaldef"]:
             self.size = self.fileobj.read_struct_type("I", 1)
@@ -1619,11 +5704,629 @@ class _FillValueMessage(object):
             self.size = None
 
     def _read_fill_value(self):
-        if self.flags["fillvaldef"]:
+        if self.flags["fillvaldef"] and self.size:
             # read as bytes, later interpret as same dtype as dataset
             self.fill_value = self.fileobj.read_bytes(self.size) 
 
         else:
             self.fill_value = None
 
+    def write(self, fileobj):
+        self.fileobj = fileobj
+
+        if self.version == 3:
+            self.fileobj.write_struct_type("B", 1, self.version)
+            self.fileobj.write_bytes(_bitbytes(1, (0, self.flags["spacealloctime"]),
+                                               (2, self.flags["fillvalwritetime"]),
+                                               (4, self.flags["fillvalundef"]),
+                                               (5, self.flags["fillvaldef"])))
+            if self.flags["fillvaldef"]:
+                self.fileobj.write_struct_type("I", 1, len(self.fill_value))
+                self.fileobj.write_bytes(self.fill_value)
+
+        else:
+            raise NotImplementedError("Writing fill value version %s not yet supported" % self.version)
+
+
+
+
+
 
+# Writing
+# Groups and datasets are collected while their raw data is written straight to file,
+# and their metadata (btrees and object headers) are only written at the end when closing.
+
+
+def _product(values):
+    return reduce(lambda init,nxt: init * nxt, values, 1)
+
+
+def _guess_chunks(shape, itemsize, target=256*1024):
+    "Halves the largest chunk dimension until a chunk is no larger than target bytes"
+    chunks = [max(1, size) for size in shape]
+    while _product(chunks) * itemsize > target and max(chunks) > 1:
+        i = chunks.index(max(chunks))
+        chunks[i] = (chunks[i] + 1) // 2
+    return tuple(chunks)
+
+
+def _datatype_from_dtype(parent, dtype):
+    "Creates a datatype message describing a numpy dtype"
+    bigendian = dtype.str[0] == ">"
+
+    if dtype.kind in "iu":
+        classtype = "fixpoint"
+        raw = _bitbytes(3, (0, bigendian), (3, dtype.kind == "i"))
+        properties = dict(bitoffset=0, precision=dtype.itemsize * 8)
+
+    elif dtype.kind == "f":
+        classtype = "floatpoint"
+        exponentlocation, exponentsize, mantissasize, exponentbias = {2: (10, 5, 10, 15),
+                                                                      4: (23, 8, 23, 127),
+                                                                      8: (52, 11, 52, 1023)}[dtype.itemsize]
+        # mantissa normalization is 2 (implied msb), and sign bit comes last
+        raw = _bitbytes(3, (0, bigendian), (4, 2), (8, dtype.itemsize * 8 - 1))
+        properties = dict(bitoffset=0, precision=dtype.itemsize * 8,
+                          exponentlocation=exponentlocation, exponentsize=exponentsize,
+                          mantissalocation=0, mantissasize=mantissasize,
+                          exponentbias=exponentbias)
+
+    elif dtype.kind == "S":
+        classtype = "string"
+        raw = _bitbytes(3, (0, 1)) # null padded ascii
+        properties = dict()
+
+    else:
+        raise NotImplementedError("Writing numpy dtype %s not yet supported" % dtype)
+
+    return _DataTypeMessage(parent, version=1, classtype=classtype, size=dtype.itemsize,
+                            bitfields=[_bitflag(raw, i) for i in range(24)], properties=properties)
+
+
+class _FileWriter(object):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.superblock = _SuperBlock(version=2, offset_size=8, length_size=8, base_address=0,
+                                      superblockext_address=UNDEFINED, end_address=UNDEFINED,
+                                      rootheader_address=UNDEFINED,
+                                      # default btree K values, as there is no superblock extension to say otherwise
+                                      groupleafnodek=4, groupinternalnodek=16, indexedstorageinternalnodek=32)
+
+        # reserve room for the superblock, which is rewritten when closing
+        self.fileobj.seek(0)
+        self.superblock.write(self.fileobj)
+        self.eof = self.fileobj.tell()
+
+        self.root = _GroupWriter(self)
+
+    def allocate(self, size):
+        "Reserves size bytes at the end of file and returns their address"
+        address = self.eof
+        self.eof += size
+        return address
+
+    def append(self, obj):
+        "Writes a low level object at the end of file and returns its address"
+        address = self.eof
+        self.fileobj.seek(address)
+        obj.write(self.fileobj)
+        self.eof = self.fileobj.tell()
+        return address
+
+    def append_bytes(self, raw):
+        address = self.eof
+        self.fileobj.seek(address)
+        self.fileobj.write_bytes(raw)
+        self.eof = self.fileobj.tell()
+        return address
+
+    def flush(self):
+        root = self.root.write_metadata()
+
+        self.superblock.rootheader_address = root.pos - self.superblock.base_address
+        self.superblock.end_address = self.eof - self.superblock.base_address
+        self.fileobj.seek(0)
+        self.superblock.write(self.fileobj)
+        self.fileobj.fileobj.flush()
+
+    def close(self):
+        self.flush()
+
+
+class _GroupWriter(object):
+    def __init__(self, writer):
+        self.writer = writer
+        self.children = collections.OrderedDict()
+
+    def _get_parent(self, name):
+        "Returns the group that should contain name, creating intermediate groups, and the last name component"
+        names = [n for n in name.split("/") if n]
+        if not names:
+            raise ValueError("Invalid name %r" % name)
+        group = self
+        for groupname in names[:-1]:
+            if groupname not in group.children:
+                group.children[groupname] = _GroupWriter(self.writer)
+            group = group.children[groupname]
+            if not isinstance(group, _GroupWriter):
+                raise ValueError("%r is not a group" % groupname)
+        if names[-1] in group.children:
+            raise ValueError("Name %r already exists" % name)
+        return group, names[-1]
+
+    def create_group(self, name):
+        parent, name = self._get_parent(name)
+        group = parent.children[name] = _GroupWriter(self.writer)
+        return group
+
+    def create_dataset(self, name, **kwargs):
+        parent, name = self._get_parent(name)
+        dataset = parent.children[name] = _DatasetWriter(self.writer, **kwargs)
+        return dataset
+
+    def write_metadata(self):
+        "Writes the object headers of all children and then of this group, returning the group's header"
+        superblock = self.writer.superblock
+        header = _ObjectHeader(superblock, messages=[])
+
+        linkinfo = _LinkInfoMessage(header, version=0, flags=dict(trackorder=0, indexorder=0),
+                                    fractheap_address=UNDEFINED, nameindex_v2btree_address=UNDEFINED)
+        header.messages.append(dict(msgtype=2, msgdata=linkinfo))
+
+        # links are stored compactly, so raise the limit if there are more than the default 8
+        if len(self.children) > 65535:
+            raise NotImplementedError("Writing more than 65535 links in a group not yet supported")
+        maxcompact = max(8, len(self.children))
+        groupinfo = _GroupInfoMessage(header, version=0, flags=dict(phasechange=maxcompact > 8, estimates=0),
+                                      maxcompact=maxcompact, mindense=6)
+        header.messages.append(dict(msgtype=10, msgflags=dict(const=1), msgdata=groupinfo))
+
+        for name, child in self.children.items():
+            if isinstance(name, bytes):
+                name = name.decode("utf8")
+            charset = "ascii" if all(ord(char) < 128 for char in name) else "utf8"
+            link = _LinkMessage(header, version=1, name=name, namecharset=charset,
+                                linktype="hard", link=child.write_metadata())
+            header.messages.append(dict(msgtype=6, msgdata=link))
+
+        self.writer.append(header)
+        return header
+
+
+class _DatasetWriter(object):
+    def __init__(self, writer, data=None, shape=None, dtype=None, chunks=None,
+                 compression=None, compression_opts=None, shuffle=False,
+                 workers=None, executor="thread", maxshape=None):
+        if np is None:
+            raise ImportError("Writing datasets requires numpy")
+
+        self.writer = writer
+        self.workers = workers
+        self.executor = executor
+
+        if data is not None:
+            data = np.asarray(data, dtype=dtype)
+            shape = data.shape
+            dtype = data.dtype
+        elif shape is None:
+            raise ValueError("Either data or shape must be given")
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype or "f8")
+        # fails for unsupported dtypes before anything is written, rather than when closing the file
+        _datatype_from_dtype(None, self.dtype)
+
+        # None means unlimited
+        self.maxshape = self.shape if maxshape is None else tuple(maxshape)
+        if len(self.maxshape) != len(self.shape):
+            raise ValueError("Maxshape %r must have the same dimensionality as shape %r" % (self.maxshape, self.shape))
+        if any(maxsize is not None and size > maxsize for size, maxsize in zip(self.shape, self.maxshape)):
+            raise ValueError("Shape %r is larger than maxshape %r" % (self.shape, self.maxshape))
+
+        # filters, in the order they are applied when writing
+        self.filters = []
+        if shuffle:
+            self.filters.append((2, [self.dtype.itemsize]))
+        if compression == "gzip":
+            level = 4 if compression_opts is None else compression_opts
+            self.filters.append((1, [level]))
+        elif compression:
+            raise NotImplementedError("Compression %r not yet supported" % compression)
+
+        # only chunked datasets can be filtered or resized
+        if (self.filters or self.maxshape != self.shape) and not chunks:
+            chunks = True
+        if chunks is True:
+            # guess as if unlimited dimensions will have some length
+            guessshape = [size if maxsize is not None else max(size, 1024)
+                          for size, maxsize in zip(self.shape, self.maxshape)]
+            chunks = _guess_chunks(guessshape, self.dtype.itemsize)
+
+        if chunks:
+            if len(chunks) != len(self.shape):
+                raise ValueError("Chunks %r must have the same dimensionality as shape %r" % (chunks, self.shape))
+            self.chunks = tuple(chunks)
+            self.chunk_index = dict() # chunk offsets -> (address, size, filtermask)
+            self._allocated = dict() # chunk offsets -> bytes reserved for the chunk in the file
+            self._pending = dict() # chunk offsets -> decoded partial edge chunks not yet written
+        else:
+            self.chunks = None
+            self.address = UNDEFINED
+            self.size = _product(self.shape) * self.dtype.itemsize
+
+        if data is not None:
+            self._write_data(data)
+        elif not self.chunks:
+            # contiguous data must be allocated up front, chunks are only written when there is data
+            self.address = self.writer.allocate(self.size)
+
+    def append(self, block, axis=0):
+        """Grows the dataset along axis and writes block at the end of it.
+
+        Only the chunks covered by block are written, so existing data is left
+        alone except for the last chunks along axis when they were only partly
+        filled. Without filters those are rewritten in place, while filtered ones
+        are kept in memory until they fill up or the file is flushed, so that
+        appending many small blocks doesnt leave old copies behind.
+        """
+        block = np.asarray(block, dtype=self.dtype)
+        if block.ndim == len(self.shape) - 1:
+            block = np.expand_dims(block, axis)
+        if block.ndim != len(self.shape):
+            raise ValueError("Block of shape %r cannot be appended to dataset of shape %r" % (block.shape, self.shape))
+        for dim, (size, blocksize) in enumerate(zip(self.shape, block.shape)):
+            if dim != axis and size != blocksize:
+                raise ValueError("Block of shape %r cannot be appended to dataset of shape %r along axis %s" % (block.shape, self.shape, axis))
+
+        start = [0] * len(self.shape)
+        start[axis] = self.shape[axis]
+        newshape = list(self.shape)
+        newshape[axis] += block.shape[axis]
+        self.resize(newshape)
+        self._write_region(block, start)
+
+    def resize(self, shape):
+        """Changes the current shape of the dataset, up to its maxshape.
+
+        Growing writes nothing, as unwritten chunks are read as fill values.
+        Shrinking drops chunks that end up wholly outside the new shape, and
+        clears the outside part of those that are cut through, so that stale
+        values dont reappear if the dataset grows again.
+        """
+        shape = tuple(shape)
+        if not self.chunks:
+            raise Exception("Only chunked datasets can be resized")
+        if len(shape) != len(self.shape):
+            raise ValueError("Shape %r must have the same dimensionality as %r" % (shape, self.shape))
+        if any(maxsize is not None and size > maxsize for size, maxsize in zip(shape, self.maxshape)):
+            raise ValueError("Shape %r is larger than maxshape %r" % (shape, self.maxshape))
+
+        shrinking = any(size < oldsize for size, oldsize in zip(shape, self.shape))
+        self.shape = shape
+
+        if shrinking:
+            cut = []
+            for offsets in set(self.chunk_index) | set(self._pending):
+                if any(offset >= size for offset, size in zip(offsets, shape)):
+                    self.chunk_index.pop(offsets, None)
+                    self._pending.pop(offsets, None)
+                elif any(offset + chunksize > size for offset, chunksize, size in zip(offsets, self.chunks, shape)):
+                    cut.append(offsets)
+
+            def clear(chunk, offsets):
+                for dim, (offset, size) in enumerate(zip(offsets, shape)):
+                    region = [slice(None)] * len(shape)
+                    region[dim] = slice(max(size - offset, 0), None)
+                    chunk[tuple(region)] = 0
+
+            self._update_chunks(sorted(cut), clear)
+
+    def _write_data(self, data):
+        if self.chunks:
+            self._write_region(data, [0] * len(self.shape))
+        else:
+            self.address = self.writer.append_bytes(np.ascontiguousarray(data).tobytes())
+
+    def _write_region(self, data, start):
+        "Writes data into the chunks it covers when placed at start"
+        stop = [offset + size for offset, size in zip(start, data.shape)]
+        if any(size == 0 for size in data.shape):
+            return
+        offsets = itertools.product(*[range(first // chunksize * chunksize, last, chunksize)
+                                      for first, last, chunksize in zip(start, stop, self.chunks)])
+
+        def insert(chunk, offsets):
+            lower = [max(offset, first) for offset, first in zip(offsets, start)]
+            upper = [min(offset + chunksize, last) for offset, chunksize, last in zip(offsets, self.chunks, stop)]
+            chunkregion = tuple(slice(low - offset, up - offset) for low, up, offset in zip(lower, upper, offsets))
+            dataregion = tuple(slice(low - first, up - first) for low, up, first in zip(lower, upper, start))
+            chunk[chunkregion] = data[dataregion]
+
+        self._update_chunks(offsets, insert)
+
+    def _read_chunk(self, offsets):
+        "Decoded array of an already written or pending chunk, or zeros if it hasnt been written yet"
+        if offsets in self._pending:
+            return self._pending[offsets]
+        if offsets not in self.chunk_index:
+            return np.zeros(self.chunks, dtype=self.dtype)
+        address, size, filtermask = self.chunk_index[offsets]
+        self.writer.fileobj.seek(address)
+        raw = _decode_chunk((self.writer.fileobj.read_bytes(size), self.filters))
+        return np.frombuffer(raw, dtype=self.dtype).reshape(self.chunks).copy()
+
+    def _update_chunks(self, offsets, update):
+        """Calls update(chunk, offsets) on each chunk, and writes the results. Filtered chunks
+        that reach past the current shape along a dimension that can still grow are kept pending
+        instead, as they are likely to be added to again. Chunks are filtered in parallel but
+        written one after another in order."""
+        written = collections.deque()
+
+        def tasks():
+            for chunkoffsets in offsets:
+                chunk = self._read_chunk(chunkoffsets)
+                update(chunk, chunkoffsets)
+                if self.filters and any(offset + chunksize > size and (maxsize is None or maxsize > size)
+                                        for offset, chunksize, size, maxsize
+                                        in zip(chunkoffsets, self.chunks, self.shape, self.maxshape)):
+                    self._pending[chunkoffsets] = chunk
+                    continue
+                self._pending.pop(chunkoffsets, None)
+                written.append(chunkoffsets)
+                yield chunk.tobytes(), self.filters
+
+        for raw in _ordered_map(_encode_chunk, tasks(), self.workers, self.executor):
+            self._store_chunk(written.popleft(), raw)
+
+    def _write_pending(self):
+        "Writes the pending partial chunks"
+        pending = sorted(self._pending.items())
+        self._pending = dict()
+        encoded = _ordered_map(_encode_chunk, [(chunk.tobytes(), self.filters) for offsets, chunk in pending],
+                               self.workers, self.executor)
+        for (offsets, chunk), raw in zip(pending, encoded):
+            self._store_chunk(offsets, raw)
+
+    def _store_chunk(self, offsets, raw):
+        "Writes an encoded chunk over its old copy if it fits there, which it always does without filters, otherwise at the end of file"
+        if offsets in self.chunk_index and len(raw) <= self._allocated[offsets]:
+            address = self.chunk_index[offsets][0]
+            self.writer.fileobj.seek(address)
+            self.writer.fileobj.write_bytes(raw)
+        else:
+            address = self.writer.append_bytes(raw)
+            self._allocated[offsets] = len(raw)
+        self.chunk_index[offsets] = (address, len(raw), [0] * 32)
+
+    def _write_chunk_index(self, layout):
+        "Writes the chunk index as a v1 btree, from the leaves up, returning the address of the top node"
+        if not self.chunk_index:
+            return UNDEFINED
+
+        fileobj = self.writer.fileobj
+        maxentries = 2 * self.writer.superblock.indexedstorageinternalnodek
+
+        # each node has one more key than children, the last key bounds the last child on the right
+        nodes = []
+        entries = sorted(self.chunk_index.items())
+        for i in range(0, len(entries), maxentries):
+            group = entries[i:i+maxentries]
+            keys = [dict(chunksize=size, filtermask=filtermask, offsets=list(offsets) + [0])
+                    for offsets, (address, size, filtermask) in group]
+            lastoffsets = group[-1][0]
+            keys.append(dict(chunksize=0, filtermask=[0] * 32,
+                             offsets=[offset + chunksize for offset, chunksize in zip(lastoffsets, self.chunks)] + [0]))
+            nodes.append((keys, [address for offsets, (address, size, filtermask) in group]))
+
+        level = 0
+        while True:
+            btnodes = [_v1BTreeNode(layout, node_type=1, node_level=level, keys=keys, child_pointers=pointers)
+                       for keys, pointers in nodes]
+            nodesize = btnodes[0].get_node_size()
+            start = self.writer.allocate(nodesize * len(btnodes))
+            addresses = [start + i * nodesize for i in range(len(btnodes))]
+
+            for i, node in enumerate(btnodes):
+                node.address_left = addresses[i-1] if i > 0 else UNDEFINED
+                node.address_right = addresses[i+1] if i < len(btnodes) - 1 else UNDEFINED
+                fileobj.seek(addresses[i])
+                node.write(fileobj)
+
+            if len(btnodes) == 1:
+                return addresses[0]
+
+            nodes = []
+            for i in range(0, len(btnodes), maxentries):
+                group = btnodes[i:i+maxentries]
+                keys = [node.keys[0] for node in group] + [group[-1].keys[-1]]
+                nodes.append((keys, addresses[i:i+maxentries]))
+            level += 1
+
+    def write_metadata(self):
+        "Writes the chunk index and object header of the dataset, returning the header"
+        superblock = self.writer.superblock
+        header = _ObjectHeader(superblock, messages=[])
+
+        dataspace = _DataspaceMessage(header, version=2, dimensionality=len(self.shape),
+                                      flags=dict(maxdims=1 if self.shape else 0, permutindic=0),
+                                      type=1 if self.shape else 0,
+                                      dimsizes=list(self.shape),
+                                      maxdimsizes=[UNDEFINED if maxsize is None else maxsize for maxsize in self.maxshape])
+        header.messages.append(dict(msgtype=1, msgdata=dataspace))
+
+        datatype = _datatype_from_dtype(header, self.dtype)
+        header.messages.append(dict(msgtype=3, msgflags=dict(const=1), msgdata=datatype))
+
+        # default fill value, allocated incrementally for chunks and late for contiguous data
+        fillvalue = _FillValueMessage(header, version=3,
+                                      flags=dict(spacealloctime=3 if self.chunks else 2,
+                                                 fillvalwritetime=2, fillvalundef=0, fillvaldef=0))
+        header.messages.append(dict(msgtype=5, msgflags=dict(const=1), msgdata=fillvalue))
+
+        if self.filters:
+            pipeline = _FilterPipelineMessage(header, version=2, filters=[])
+            for filter_id, client_data in self.filters:
+                filt = _v2FilterDescription(pipeline, filter_id=filter_id, flags=dict(optional=1),
+                                            client_data=client_data)
+                pipeline.filters.append(filt)
+            header.messages.append(dict(msgtype=11, msgflags=dict(const=1), msgdata=pipeline))
+
+        if self.chunks:
+            self._write_pending()
+            layout = _DataLayoutMessage(header, version=3, layout_class="chunked",
+                                        properties=dict(dimensionality=len(self.chunks) + 1,
+                                                        dimsizes=list(self.chunks) + [self.dtype.itemsize]))
+            layout.properties["address"] = self._write_chunk_index(layout)
+        else:
+            layout = _DataLayoutMessage(header, version=3, layout_class="contiguous",
+                                        properties=dict(address=self.address, size=self.size))
+        header.messages.append(dict(msgtype=8, msgdata=layout))
+
+        self.writer.append(header)
+        return header
+
+
+
+# Command line inspector, run as python -m pyhdf5
+
+_FILTER_NAMES = {1: "deflate", 2: "shuffle", 3: "fletcher32", 4: "szip", 5: "nbit", 6: "scaleoffset"}
+
+
+def _parse_selection(text):
+    "Selection from text such as '0, 10:20, ::2, ...'"
+    selection = []
+    for part in text.split(","):
+        part = part.strip()
+        if part == "...":
+            selection.append(Ellipsis)
+        elif ":" in part:
+            selection.append(slice(*[int(value) if value.strip() else None for value in part.split(":")]))
+        else:
+            selection.append(int(part))
+    return tuple(selection)
+
+
+def _cli_ls(f, path, long=False, indent=0, visited=None):
+    "Prints the tree below the group at path, following only the links of each group"
+    visited = set() if visited is None else visited
+    group = f[path]
+    for link in sorted(group._header.iter_links(), key=lambda link: link.name):
+        prefix = "  " * indent + link.name
+        if link.linktype != "hard":
+            print "%s -> %s" % (prefix, link.link)
+            continue
+        obj = f._get_object(link.link, group.name.rstrip("/") + "/" + link.name)
+        if isinstance(obj, Dataset):
+            print "%s  %s %s" % (prefix, obj.shape, obj.dtype) if long else prefix
+        elif obj._header.pos in visited:
+            print prefix + "/  (already listed)"
+        else:
+            visited.add(obj._header.pos)
+            print prefix + "/"
+            _cli_ls(f, obj.name, long, indent + 1, visited)
+
+
+def _cli_info(f, name):
+    "Prints the properties of a dataset, with its compression worked out from the chunk index alone"
+    ds = f[name]
+    if not isinstance(ds, Dataset):
+        raise SystemExit("%r is not a dataset" % name)
+    print "name:", ds.name
+    print "dtype:", ds.dtype
+    print "shape:", ds.shape
+    print "maxshape:", ds.maxshape
+    print "fill value:", ds.fillvalue
+    pipeline = ds._header.get_message(11)
+    filters = ["%s%s" % (_FILTER_NAMES.get(filt.filter_id, "filter %s" % filt.filter_id),
+                         "(%s)" % filt.client_data[0] if filt.filter_id == 1 and filt.client_data else "")
+               for filt in (pipeline.filters if pipeline else [])]
+    print "filters:", ", ".join(filters) or "none"
+    print "chunks:", ds.chunks
+    if ds.chunks:
+        index = ds._header.get_message(8).get_chunk_index()
+        total = _product(-(-size // chunksize) for size, chunksize in zip(ds.shape, ds.chunks))
+        stored = sum(size for offsets, address, size, filtermask in index)
+        raw = len(index) * _product(ds.chunks) * ds.dtype.itemsize
+        print "stored chunks: %s of %s" % (len(index), total)
+        print "stored bytes: %s" % stored
+        print "compression ratio: %s" % (round(raw / float(stored), 2) if stored else None)
+
+
+def _cli_bench(path, name, selection=None, workers=None, repeat=1):
+    "Times opening the file, walking the metadata of a dataset and reading all or a window of it"
+    import time
+
+    def timed(label, func):
+        times = []
+        for _ in range(repeat):
+            start = time.time()
+            result = func()
+            times.append(time.time() - start)
+        print "%-10s %.4f s" % (label, min(times))
+        return result, min(times)
+
+    timed("open", lambda: HDF5(path).close())
+
+    def walk():
+        # a freshly opened file, so nothing is cached yet
+        f = HDF5(path)
+        try:
+            ds = f[name]
+            ds.shape, ds.dtype, ds._header.get_message(11)
+            if ds.chunks:
+                ds._header.get_message(8).get_chunk_index()
+        finally:
+            f.close()
+
+    timed("metadata", walk)
+    ds = HDF5(path)[name]
+    selection = () if selection is None else _parse_selection(selection)
+
+    def read():
+        if not workers or not ds.chunks:
+            return ds[selection]
+        slices, dropped = _normalize_selection(selection, ds.shape)
+        out = np.empty([len(xrange(*slices[dim])) for dim in range(len(slices)) if dim not in dropped], ds.dtype)
+        ds.read_direct(out, selection, workers=workers)
+        return out
+
+    try:
+        data, seconds = timed("read", read)
+    finally:
+        ds.file.close()
+    print "%-10s %.2f MB/s" % ("speed", data.nbytes / 1e6 / seconds if seconds else float("inf"))
+
+
+def main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m pyhdf5", description="Inspect HDF5 files")
+    commands = parser.add_subparsers(dest="command")
+
+    ls = commands.add_parser("ls", help="list the groups and datasets in a file")
+    ls.add_argument("path", help="file path or url")
+    ls.add_argument("group", nargs="?", default="/")
+    ls.add_argument("-l", "--long", action="store_true", help="also show the shape and dtype of datasets")
+
+    info = commands.add_parser("info", help="show the properties of a dataset")
+    info.add_argument("path", help="file path or url")
+    info.add_argument("name", help="path of the dataset within the file")
+
+    bench = commands.add_parser("bench", help="time opening a file and reading a dataset")
+    bench.add_argument("path", help="file path or url")
+    bench.add_argument("name", help="path of the dataset within the file")
+    bench.add_argument("-s", "--selection", help="window to read, such as '0, 10:20, :', instead of all")
+    bench.add_argument("-w", "--workers", type=int, help="threads to decode chunks with")
+    bench.add_argument("-r", "--repeat", type=int, default=1, help="times to repeat, reporting the fastest")
+
+    args = parser.parse_args(args)
+    if args.command == "bench":
+        _cli_bench(args.path, args.name, args.selection, args.workers, args.repeat)
+        return
+    with HDF5(args.path) as f:
+        if args.command == "ls":
+            _cli_ls(f, args.group, args.long)
+        elif args.command == "info":
+            _cli_info(f, args.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -44,3 +44,90 @@ for msg in root.messages:
 
 
 
+# path lookup
+
+var = testfile["/spei"]
+print "PATH", var, var.shape, var.chunks
+
+# attributes
+
+print "ATTRS", testfile.root.attrs.keys()
+print "UNITS", var.attrs.get("units"), var.attrs.get("long_name")
+
+# selections
+
+print "FIRST", var[0].shape, var[0, 10:20, 10:20]
+print "OVERVIEW", var[::10, ::10, ::10].shape
+
+import numpy as np
+buf = np.zeros((10, 10), "f8")
+var.read_direct(buf, np.s_[0, :10, :10])
+print "DIRECT", buf
+
+# multiple files, here the same file twice, read across the boundary between them
+
+from pyhdf5 import MultiFileDataset
+
+with MultiFileDataset([r"C:\Users\kimo\Downloads\spei01.nc"] * 2, "spei", workers=2) as stacked:
+    boundary = var.shape[0]
+    print "STACKED", stacked.shape, stacked[boundary - 2:boundary + 2, 0, 0]
+    print "EXPECTED", var[-2:, 0, 0], var[:2, 0, 0]
+
+# reductions
+
+print "MEAN", var.reduce("mean", axis=0, workers=4)
+print "FILL", var.fillvalue, var.reduce("count", skip_fill=True)
+
+# chunk iteration
+
+for region, values in var.iter_chunks(prefetch=4):
+    print "CHUNK", region, values.shape
+
+# storage
+
+from pyhdf5 import MemoryStorage
+
+memfile = HDF5(MemoryStorage(open(r"C:\Users\kimo\Downloads\spei01.nc", "rb").read()))
+print "MEMORY", memfile.root.keys()
+
+# pickling
+
+import pickle
+
+restored = pickle.loads(pickle.dumps(var, 2))
+print "PICKLED", restored, restored[0, :2, :2]
+
+# checksums
+
+checked = HDF5(r"C:\Users\kimo\Downloads\spei01.nc", checksums="all")
+print "CHECKED", checked["spei"][0, :2, :2]
+
+# newer layouts, with fixed array, extensible array, v2 btree, single chunk and implicit chunk indexes
+
+latest = HDF5(r"C:\Users\kimo\Downloads\latest.h5")
+for name in latest.root.keys():
+    print "LATEST", name, latest[name]._header.get_message(8).properties.get("indextype"), latest[name][:2]
+
+# command line
+
+import pyhdf5
+pyhdf5.main(["info", r"C:\Users\kimo\Downloads\spei01.nc", "spei"])
+
+# exporting
+
+var.export_npy("testfiles/spei.npy", workers=4)
+var.export_chunks("testfiles/spei.zarr", workers=4)
+
+# reading to disk
+
+ondisk = var.read((slice(0, 12),), out="testfiles/spei_year.npy", workers=4, prefetch=8)
+print "ONDISK", type(ondisk), ondisk.shape
+
+# writing
+
+import numpy as np
+
+with HDF5("testfiles/written.h5", mode="w") as outfile:
+    data = np.random.random((24, 100, 120)).astype("f4")
+    outfile.create_dataset("spei", data=data, chunks=(6, 50, 60), compression="gzip", shuffle=True, workers=4)
+